@@ -0,0 +1,237 @@
+"""
+Helpers for reading ArcGIS feature layers over the REST API.
+
+A plain layer query only returns up to the server's maxRecordCount features,
+and silently drops the rest. iter_features() pages through the layer with
+resultOffset/resultRecordCount instead, fetching a bounded window of pages in
+parallel and yielding the features one at a time, so memory use depends on
+the page size and not on the size of the layer.
+
+Layer descriptions (?f=json) are read through a MetadataClient, which keeps
+them for a few minutes and can fetch the descriptions of many layers at once
+with one <service>/layers request per service. The last edit date of a layer
+(editingInfo.lastEditDate, in milliseconds since the epoch) comes from there
+instead of from the html service page.
+
+Meant to be run with Python 3.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+
+import fetch_utils
+import metrics
+
+# Page size used when the layer does not report a maxRecordCount.
+DEFAULT_PAGE_SIZE = 1000
+# Number of pages fetched at once.
+DEFAULT_PAGE_WORKERS = 4
+# Seconds a layer description is reused before being fetched again.
+DEFAULT_METADATA_TTL = 300
+
+
+def set_query_params(url, **params):
+    """Returns url with the given query string parameters added or replaced.
+
+    Args:
+        url: The url to update.
+        params: Parameter names and values. A value of None removes the
+            parameter.
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query)
+             if key not in params]
+    query.extend((key, str(value)) for key, value in params.items()
+                 if value is not None)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path,
+                       urlencode(query), parts.fragment))
+
+
+def layer_url(query_url):
+    """Returns the layer url (.../FeatureServer/0) for a layer query url."""
+    parts = urlsplit(query_url)
+    path = parts.path
+    if path.rstrip('/').endswith('/query'):
+        path = path.rstrip('/')[:-len('/query')]
+    return urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+
+
+def get_json(url):
+    """Fetches url and decodes its JSON body.
+
+    Raises:
+        ValueError: If the body is not JSON or is an ArcGIS error response.
+    """
+    response = fetch_utils.get(url)
+    metrics.count('http_bytes', len(response.content),
+                  host=urlsplit(url).netloc.lower())
+    payload = response.json()
+    if isinstance(payload, dict) and u'error' in payload:
+        raise ValueError("ArcGIS error for %s: %s" % (url, payload[u'error']))
+    return payload
+
+
+def get_layer_info(query_url):
+    """Fetches the layer description (?f=json) for a layer query url."""
+    return get_json(set_query_params(layer_url(query_url), f='json'))
+
+
+class MetadataClient(object):
+    """Layer descriptions, cached for ttl seconds and fetched in batches.
+
+    The client is safe to share between threads.
+    """
+
+    def __init__(self, ttl=DEFAULT_METADATA_TTL, clock=time.time):
+        """
+        Args:
+            ttl: Seconds a layer description is reused.
+            clock: Function returning the current time in seconds.
+        """
+        self.ttl = ttl
+        self._clock = clock
+        self._cache = {}  # Keys are layer urls, values are (time, info)
+        self._lock = threading.Lock()
+
+    def _lookup(self, url):
+        with self._lock:
+            entry = self._cache.get(url)
+        if entry is not None and self._clock() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def _store(self, url, info):
+        with self._lock:
+            self._cache[url] = (self._clock(), info)
+
+    def get_layer_info(self, url):
+        """Returns the description of the layer of a layer or query url."""
+        url = layer_url(url)
+        info = self._lookup(url)
+        if info is None:
+            info = get_layer_info(url)
+            self._store(url, info)
+        return info
+
+    def get_last_edit(self, url):
+        """Returns the last edit time of a layer in milliseconds since the
+        epoch, or None if the layer does not report it."""
+        editing_info = self.get_layer_info(url).get(u'editingInfo') or {}
+        return editing_info.get(u'lastEditDate')
+
+    def prefetch(self, urls, max_workers=DEFAULT_PAGE_WORKERS):
+        """Fetches the descriptions of many layers ahead of time.
+
+        Layers are grouped by service and each service is asked for all of
+        its layers in a single <service>/layers?f=json request, over the
+        pooled session of its host. Layers the batch request does not cover
+        are left to be fetched one by one when asked for.
+
+        Args:
+            urls: Layer or query urls.
+            max_workers: Maximum number of services queried at once.
+        """
+        services = OrderedDict()
+        for url in urls:
+            url = layer_url(url)
+            service, _, layer_id = url.rstrip('/').rpartition('/')
+            if layer_id.isdigit() and self._lookup(url) is None:
+                services.setdefault(service, []).append(url)
+        fetch_utils.run_concurrently(self._fetch_service, services.items(),
+                                     max_workers)
+
+    def _fetch_service(self, item):
+        service, urls = item
+        payload = get_json(set_query_params(service + '/layers', f='json'))
+        layers = {}
+        for layer in (payload.get(u'layers') or []) + \
+                (payload.get(u'tables') or []):
+            layers[str(layer.get(u'id'))] = layer
+        for url in urls:
+            info = layers.get(url.rstrip('/').rpartition('/')[2])
+            if info is not None:
+                self._store(url, info)
+
+
+# Client shared by the scrapers.
+metadata = MetadataClient()
+
+
+def get_page_size(layer_info):
+    """Returns the page size to use for a layer, or None if the layer does
+    not support pagination."""
+    capabilities = layer_info.get(u'advancedQueryCapabilities') or {}
+    if capabilities.get(u'supportsPagination') is False:
+        return None
+    return layer_info.get(u'maxRecordCount') or DEFAULT_PAGE_SIZE
+
+
+def get_feature_count(query_url):
+    """Returns the number of features matched by a layer query url."""
+    count_url = set_query_params(query_url, returnCountOnly='true',
+                                 orderByFields=None, outFields=None)
+    return int(get_json(count_url)[u'count'])
+
+
+def get_features_page(query_url, offset, page_size):
+    """Fetches one page of features from a layer query url."""
+    page_url = set_query_params(query_url, resultOffset=offset,
+                                resultRecordCount=page_size)
+    return get_json(page_url)[u'features']
+
+
+def iter_features(query_url, page_size=None, max_workers=DEFAULT_PAGE_WORKERS):
+    """Yields every feature matched by a layer query url, in query order.
+
+    Layers that do not support pagination are read with a single query, as
+    before.
+
+    Args:
+        query_url: The REST API query url (.../FeatureServer/0/query?...).
+        page_size: Number of features to request per page. Defaults to the
+            layer's maxRecordCount.
+        max_workers: Maximum number of pages fetched at once. At most this
+            many pages are held in memory.
+
+    Yields:
+        Feature dicts as found in the 'features' field of the response.
+
+    Raises:
+        KeyError, ValueError: If a response is not a valid feature set.
+    """
+    try:
+        layer_info = metadata.get_layer_info(query_url)
+    except (KeyError, ValueError):
+        layer_info = {}
+    if page_size is None:
+        page_size = get_page_size(layer_info)
+    if page_size is None:
+        for feature in get_json(query_url)[u'features']:
+            yield feature
+        return
+
+    # Pages must come back in a stable order for offsets to be meaningful.
+    if u'orderByFields' not in dict(parse_qsl(urlsplit(query_url).query)):
+        query_url = set_query_params(
+            query_url,
+            orderByFields=layer_info.get(u'objectIdField') or 'OBJECTID')
+
+    count = get_feature_count(query_url)
+    offsets = iter(range(0, count, page_size))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = deque()
+        for offset in offsets:
+            pending.append(executor.submit(get_features_page, query_url,
+                                           offset, page_size))
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            features = pending.popleft().result()
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(executor.submit(get_features_page, query_url,
+                                               offset, page_size))
+            for feature in features:
+                yield feature
@@ -0,0 +1,332 @@
+"""
+Crash-safe writes of the processed files.
+
+A writer that opens its output with 'w' and dies partway (an exception, a
+sys.exit, a killed job) leaves a truncated csv behind, and with it the lost
+history of every location. Everything here writes to a temporary file in the
+directory of the target, fsyncs it and renames it over the target, so readers
+only ever see the old file or the new one. The new file keeps the mode of
+the one it replaces (or gets the usual 0666 & ~umask), not the 0600 of a
+temporary file, so readers running as other users can still open it:
+
+    with atomic_io.atomic_write('processed_data/cases/US/x_cases.csv') as f:
+        f.write(...)
+
+Payloads whose name is only known once they are written, e.g. blobs named
+after the hash of their content, go through temp_file(), which renames the
+file wherever its path ends up pointing:
+
+    with atomic_io.temp_file(directory) as tmp:
+        tmp.file.write(...)
+        tmp.path = ...
+
+Files that belong together, e.g. the outputs of dhProcess.py, are written as
+one batch, which replaces all of them or none of them:
+
+    with atomic_io.batch() as files:
+        for path in paths:
+            with files.open(path) as f:
+                f.write(...)
+
+A batch keeps a small journal in .cache/journal/ listing its temporary
+files. The journal says 'pending' while they are being written and
+'committed', fsynced, just before the renames start; it is deleted once they
+are done. If the process dies, recover() rolls a committed batch forward
+(finishes the renames) and a pending one back (deletes its temporary files).
+Every new batch runs recover() on the journals of dead processes first, or
+run this script to do it by hand:
+
+    $ python scripts/atomic_io.py
+
+Meant to be run with Python 3.
+"""
+import contextlib
+import json
+import os
+import stat
+import sys
+import tempfile
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_JOURNAL_DIR = os.path.join(REPO_ROOT, '.cache', 'journal')
+JOURNAL_SUFFIX = '.journal'
+TMP_SUFFIX = '.tmp'
+
+PENDING = 'pending'
+COMMITTED = 'committed'
+
+
+def _read_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once at import, as os.umask() can only be read by setting it.
+_UMASK = _read_umask()
+
+
+def _fsync_directory(directory):
+    """Makes a rename in directory durable. Not every platform can open a
+    directory, in which case this does nothing."""
+    try:
+        fd = os.open(directory, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def set_mode(fd, path):
+    """Gives the open temporary file fd the mode of path if it exists, or
+    the mode open() gives a new file. mkstemp() creates files as 0600."""
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0o666 & ~_UMASK
+    if hasattr(os, 'fchmod'):
+        os.fchmod(fd, mode)
+
+
+def _make_temp(path):
+    """Creates an empty temporary file next to path, with the mode path
+    will need. Returns fd, tmp_path."""
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % name,
+                                    suffix=TMP_SUFFIX)
+    try:
+        set_mode(fd, path)
+    except OSError:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    return fd, tmp_path
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def _temp_file(fd, mode, newline, encoding):
+    """Opens fd and fsyncs it when the block ends without an error."""
+    with os.fdopen(fd, mode, newline=newline, encoding=encoding) as tmp_file:
+        yield tmp_file
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', newline=None, encoding=None):
+    """Opens a temporary file that replaces path when the block ends.
+
+    If the block raises, path is left untouched and the temporary file is
+    removed.
+
+    Args:
+        path: The file to write.
+        mode: 'w' or 'wb'.
+        newline, encoding: As for open().
+    """
+    fd, tmp_path = _make_temp(path)
+    try:
+        with _temp_file(fd, mode, newline, encoding) as tmp_file:
+            yield tmp_file
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    _fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+class TempFile(object):
+    """A temporary file whose target is only known once it is written.
+
+    Attributes:
+        file: The temporary file, open for binary writing.
+        path: Where the file goes when the block of temp_file() ends. Left
+            None, the file is removed instead.
+    """
+
+    def __init__(self, tmp_file):
+        self.file = tmp_file
+        self.path = None
+
+
+@contextlib.contextmanager
+def temp_file(directory):
+    """Yields a TempFile in directory, e.g. for a blob named after the hash
+    of what is streamed into it.
+
+    When the block ends the file is fsynced and renamed to its path, with
+    the mode that path needs. If the path is still None, or the block
+    raises, the file is removed.
+
+    Args:
+        directory: Where to create the file, on the same file system as
+            the path it will get.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=TMP_SUFFIX)
+    try:
+        with _temp_file(fd, 'wb', None, None) as tmp_file:
+            pending = TempFile(tmp_file)
+            yield pending
+            if pending.path is not None:
+                set_mode(tmp_file.fileno(), pending.path)
+        if pending.path is None:
+            _remove(tmp_path)
+            return
+        os.replace(tmp_path, pending.path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    _fsync_directory(os.path.dirname(os.path.abspath(pending.path)))
+
+
+def replace_with(path, write, mode='wb'):
+    """Calls write(file_object) on a temporary file, then renames it to
+    path."""
+    with atomic_write(path, mode) as tmp_file:
+        write(tmp_file)
+
+
+def _write_json(path, value):
+    with atomic_write(path) as json_file:
+        json.dump(value, json_file, indent=1, sort_keys=True)
+
+
+class Batch(object):
+    """Files written together and renamed into place together.
+
+    Use through batch(), or call commit() or rollback() when done.
+    """
+
+    def __init__(self, journal_dir=None):
+        self.journal_dir = journal_dir or DEFAULT_JOURNAL_DIR
+        self.journal_path = os.path.join(
+            self.journal_dir,
+            '%d-%s%s' % (os.getpid(), uuid.uuid4().hex, JOURNAL_SUFFIX))
+        self.files = []  # (tmp_path, path) pairs, in the order opened
+
+    def _write_journal(self, state):
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        _write_json(self.journal_path, {
+            'pid': os.getpid(),
+            'state': state,
+            'files': [[tmp_path, path] for tmp_path, path in self.files],
+        })
+
+    @contextlib.contextmanager
+    def open(self, path, mode='w', newline=None, encoding=None):
+        """Opens a temporary file that replaces path when the batch is
+        committed. Opening the same path twice keeps the last one."""
+        path = os.path.abspath(path)
+        fd, tmp_path = _make_temp(path)
+        self.files.append((tmp_path, path))
+        self._write_journal(PENDING)
+        with _temp_file(fd, mode, newline, encoding) as tmp_file:
+            yield tmp_file
+
+    def commit(self):
+        """Renames every file of the batch into place."""
+        if self.files:
+            self._write_journal(COMMITTED)
+            _roll_forward(self.files)
+        _remove(self.journal_path)
+        self.files = []
+
+    def rollback(self):
+        """Removes the temporary files; the targets are left untouched."""
+        _roll_back(self.files)
+        _remove(self.journal_path)
+        self.files = []
+
+
+def _roll_forward(files):
+    directories = set()
+    for tmp_path, path in files:
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, path)
+            directories.add(os.path.dirname(path))
+    for directory in directories:
+        _fsync_directory(directory)
+
+
+def _roll_back(files):
+    for tmp_path, _ in files:
+        _remove(tmp_path)
+
+
+@contextlib.contextmanager
+def batch(journal_dir=None):
+    """Yields a Batch, committed when the block ends and rolled back if it
+    raises. Interrupted batches of dead processes are recovered first."""
+    recover(journal_dir)
+    files = Batch(journal_dir)
+    try:
+        yield files
+    except BaseException:
+        files.rollback()
+        raise
+    files.commit()
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # Exists, but belongs to someone else
+    return True
+
+
+def recover(journal_dir=None):
+    """Finishes or undoes the batches left behind by dead processes.
+
+    Returns:
+        A list of (journal path, 'rolled forward' or 'rolled back') pairs.
+    """
+    journal_dir = journal_dir or DEFAULT_JOURNAL_DIR
+    if not os.path.isdir(journal_dir):
+        return []
+    recovered = []
+    for name in sorted(os.listdir(journal_dir)):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        journal_path = os.path.join(journal_dir, name)
+        try:
+            with open(journal_path, 'r') as journal_file:
+                journal = json.load(journal_file)
+        except (IOError, ValueError):
+            continue
+        if _pid_alive(journal['pid']):
+            continue
+        files = [tuple(pair) for pair in journal['files']]
+        if journal['state'] == COMMITTED:
+            _roll_forward(files)
+            recovered.append((journal_path, 'rolled forward'))
+        else:
+            _roll_back(files)
+            recovered.append((journal_path, 'rolled back'))
+        _remove(journal_path)
+    return recovered
+
+
+if __name__ == '__main__':
+    results = recover(sys.argv[1] if len(sys.argv) > 1 else None)
+    for journal_path, action in results:
+        print('%s - %s' % (journal_path, action))
+    if not results:
+        print('Nothing to recover')
@@ -0,0 +1,345 @@
+"""
+Benchmarks of the processing pipeline on synthetic data.
+
+Generates inputs at the requested scale in a scratch directory, starts a
+local stub server for the remote sources (see stub_server.py) and times
+each stage:
+
+    dh_read_cold     dhProcess.readDataFromDirectory, empty snapshot cache
+    dh_read_warm     dhProcess.readDataFromDirectory, every file cached
+    dh_format        dhProcess.format_output_data
+    boro_read_cold   boroProcess.processBoroData, empty snapshot cache
+    boro_format      boroProcess.format_boro_data
+    arcgis_fetch     paged ArcGIS query and case_counts transform
+    csv_fetch        raw csv download through the HTTP cache and transform
+    series_import    first snapshot appended to an existing wide csv
+    series_append    next snapshot appended to the same csv
+
+Every stage runs in a fresh child process, so the reported peak RSS belongs
+to that stage alone (setup included; setup_rss_mb is the peak before the
+timed part started). The report is printed, or written with --output, as
+JSON:
+
+    $ python scripts/benchmark/run_benchmarks.py --hospitals 6000 --days 30 \\
+        --output bench.json
+
+Meant to be run with Python 3.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.append(SCRIPTS_DIR)
+sys.path.append(os.path.join(SCRIPTS_DIR, 'boro'))
+sys.path.append(os.path.join(SCRIPTS_DIR, 'definitive_healthcare'))
+
+import stub_server
+import synthetic_data
+
+STAGES = collections.OrderedDict()
+Stage = collections.namedtuple('Stage', ['setup', 'unit'])
+
+
+def stage(name, unit):
+    """Registers setup(context) -> run as the stage called name. run() does
+    the timed work and returns the number of units it processed."""
+    def decorator(setup):
+        STAGES[name] = Stage(setup, unit)
+        return setup
+    return decorator
+
+
+def _use_cache_dirs(context, name):
+    """Points the snapshot and HTTP caches, the write journal, the locks and
+    the raw archive at a directory of the scratch directory, so the
+    benchmarks never touch the caches of the repo."""
+    import atomic_io
+    import file_lock
+    import http_cache
+    import raw_archive
+    import snapshot_cache
+    cache_dir = os.path.join(context['workdir'], 'cache', name)
+    snapshot_cache.DEFAULT_CACHE_DIR = os.path.join(cache_dir, 'snapshots')
+    http_cache.DEFAULT_CACHE_DIR = os.path.join(cache_dir, 'http')
+    atomic_io.DEFAULT_JOURNAL_DIR = os.path.join(cache_dir, 'journal')
+    file_lock.DEFAULT_LOCK_DIR = os.path.join(cache_dir, 'locks')
+    raw_archive.DEFAULT_ARCHIVE_DIR = os.path.join(cache_dir, 'archive')
+
+
+def _output_dir(context, name):
+    path = os.path.join(context['workdir'], 'output', name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path + os.sep
+
+
+@stage('dh_read_cold', 'rows')
+def setup_dh_read_cold(context):
+    import dhProcess
+    _use_cache_dirs(context, 'dh_cold')
+    return lambda: len(dhProcess.readDataFromDirectory(
+        context['dh_dir'], context['workers']))
+
+
+@stage('dh_read_warm', 'rows')
+def setup_dh_read_warm(context):
+    import dhProcess
+    _use_cache_dirs(context, 'dh_warm')
+    dhProcess.readDataFromDirectory(context['dh_dir'], context['workers'])
+    return lambda: len(dhProcess.readDataFromDirectory(
+        context['dh_dir'], context['workers']))
+
+
+@stage('dh_format', 'rows')
+def setup_dh_format(context):
+    import dhProcess
+    _use_cache_dirs(context, 'dh_warm')
+    daily_data = dhProcess.readDataFromDirectory(context['dh_dir'],
+                                                 context['workers'])
+    output_dir = _output_dir(context, 'dh')
+    for _, output_path in dhProcess.OUTPUT_FILES:
+        os.makedirs(os.path.dirname(output_dir + output_path))
+
+    def run():
+        dhProcess.format_output_data(daily_data, output_dir)
+        return len(daily_data)
+    return run
+
+
+@stage('boro_read_cold', 'rows')
+def setup_boro_read_cold(context):
+    import boroProcess
+    _use_cache_dirs(context, 'boro_cold')
+    return lambda: len(boroProcess.processBoroData(context['boro_dir'],
+                                                   context['workers']))
+
+
+@stage('boro_format', 'rows')
+def setup_boro_format(context):
+    import boroProcess
+    _use_cache_dirs(context, 'boro_warm')
+    boro_data = boroProcess.processBoroData(context['boro_dir'],
+                                            context['workers'])
+    output_filename = _output_dir(context, 'boro') + 'boro_cases.csv'
+
+    def run():
+        boroProcess.format_boro_data(boro_data, output_filename)
+        return len(boro_data)
+    return run
+
+
+@stage('arcgis_fetch', 'features')
+def setup_arcgis_fetch(context):
+    import scrapers
+    source = {'name': 'benchmark', 'url': context['arcgis_url'],
+              'fields': {'location': 'ZipCode', 'value': 'Cases'},
+              'transform': {'type': 'case_counts'}}
+
+    def run():
+        snapshot = scrapers.fetch_arcgis(source)
+        return len(scrapers.transform_case_counts(
+            source, source['transform'], snapshot.rows))
+    return run
+
+
+@stage('csv_fetch', 'rows')
+def setup_csv_fetch(context):
+    import scrapers
+    _use_cache_dirs(context, 'csv')
+    source = {'name': 'benchmark', 'url': context['csv_url'],
+              'fields': {'location': 0, 'value': 1},
+              'transform': {'type': 'integers'}}
+
+    def run():
+        snapshot = scrapers.fetch_csv(source)
+        return len(scrapers.transform_integers(
+            source, source['transform'], snapshot.rows))
+    return run
+
+
+def _series_rows(context):
+    return [('"%05d"' % (10000 + location), str(location))
+            for location in range(context['locations'])]
+
+
+@stage('series_import', 'rows')
+def setup_series_import(context):
+    import series_store
+    _use_cache_dirs(context, 'series')
+    csv_path = _output_dir(context, 'series_import') + 'bench_cases.csv'
+    shutil.copyfile(context['wide_csv'], csv_path)
+    rows = _series_rows(context)
+    return lambda: series_store.append_snapshot(
+        csv_path, '"01/01/30"', rows) or len(rows)
+
+
+@stage('series_append', 'rows')
+def setup_series_append(context):
+    import series_store
+    _use_cache_dirs(context, 'series')
+    csv_path = _output_dir(context, 'series_append') + 'bench_cases.csv'
+    shutil.copyfile(context['wide_csv'], csv_path)
+    rows = _series_rows(context)
+    series_store.append_snapshot(csv_path, '"01/01/30"', rows)
+    return lambda: series_store.append_snapshot(
+        csv_path, '"01/02/30"', rows) or len(rows)
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)  # bytes
+    return peak / 1024.0  # kilobytes
+
+
+def run_stage(name, context):
+    """Runs one stage in this process and returns its measurements."""
+    os.chdir(context['workdir'])  # The processors log to log/ in the cwd
+    run = STAGES[name].setup(context)
+    setup_rss = peak_rss_mb()
+    start = time.perf_counter()
+    items = run()
+    seconds = time.perf_counter() - start
+    return {
+        'stage': name,
+        'seconds': round(seconds, 6),
+        'items': items,
+        'unit': STAGES[name].unit,
+        'items_per_second': round(items / seconds, 1) if seconds else None,
+        'setup_rss_mb': round(setup_rss, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def run_stage_in_child(name, context):
+    """Runs one stage in a new Python process and returns its measurements,
+    or a dict with an 'error' if it failed."""
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', name,
+         '--context', json.dumps(context)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if process.returncode != 0:
+        return {'stage': name, 'error': process.stderr.strip()[-2000:]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def generate_inputs(args, workdir, server):
+    """Writes the synthetic inputs and returns the context of the stages."""
+    dh_dir = os.path.join(workdir, 'raw', 'definitive_healthcare')
+    boro_dir = os.path.join(workdir, 'raw', 'boro_data')
+    for directory in (dh_dir, boro_dir, os.path.join(workdir, 'log')):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    synthetic_data.write_dh_snapshots(dh_dir, args.hospitals, args.days,
+                                      args.seed)
+    synthetic_data.write_boro_snapshots(boro_dir, args.regions, args.days,
+                                        args.seed)
+    wide_csv = os.path.join(workdir, 'raw', 'wide_cases.csv')
+    synthetic_data.write_wide_csv(wide_csv, args.locations, args.days,
+                                  args.seed)
+
+    layer_url = server.add_layer(
+        '/arcgis/rest/services/Benchmark/FeatureServer',
+        synthetic_data.arcgis_features(args.features, seed=args.seed))
+    csv_url = server.add_file(
+        '/benchmark/tests-by-zcta.csv',
+        synthetic_data.zip_code_csv(args.locations, args.seed))
+    return {
+        'workdir': workdir,
+        'workers': args.workers,
+        'locations': args.locations,
+        'dh_dir': dh_dir + os.sep,
+        'boro_dir': boro_dir + os.sep,
+        'wide_csv': wide_csv,
+        'arcgis_url': layer_url + '/query?f=json&where=1%3D1'
+                      '&returnGeometry=false&outFields=ZipCode,Cases'
+                      '&orderByFields=ZipCode',
+        'csv_url': csv_url,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the processing pipeline on synthetic data.")
+    parser.add_argument("--hospitals", type=int, default=1000,
+                        help="hospitals per Definitive Healthcare snapshot")
+    parser.add_argument("--days", type=int, default=30,
+                        help="number of daily snapshots")
+    parser.add_argument("--regions", type=int, default=5,
+                        help="regions per boro snapshot")
+    parser.add_argument("--features", type=int, default=10000,
+                        help="features of the stub ArcGIS layer")
+    parser.add_argument("--locations", type=int, default=2000,
+                        help="locations of the wide csv and the raw csv")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes of the processors")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds the stub server waits before "
+                        "every answer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stage", action="append", dest="stages",
+                        choices=list(STAGES), help="only run this stage; "
+                        "may be repeated")
+    parser.add_argument("--workdir", help="scratch directory, kept after "
+                        "the run (default: a temporary directory)")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--context", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_stage(args.child, json.loads(args.context))))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='covid-benchmark-')
+    try:
+        with stub_server.StubServer(latency=args.latency / 1000.0) \
+                as server:
+            context = generate_inputs(args, workdir, server)
+            results = []
+            for name in args.stages or list(STAGES):
+                result = run_stage_in_child(name, context)
+                print('%s - %s' % (name, 'ERROR' if 'error' in result else
+                                   '%.3fs' % result['seconds']),
+                      file=sys.stderr)
+                results.append(result)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': {
+            'hospitals': args.hospitals, 'days': args.days,
+            'regions': args.regions, 'features': args.features,
+            'locations': args.locations, 'workers': args.workers,
+            'latency': args.latency, 'seed': args.seed,
+        },
+        'stages': results,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
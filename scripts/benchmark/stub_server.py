@@ -0,0 +1,436 @@
+"""
+Local HTTP server standing in for the remote sources.
+
+StubServer serves, from a background thread:
+
+    static files     added with add_file(path, body); GET and HEAD, with an
+                     ETag and 304 answers to If-None-Match like GitHub raw,
+                     and 'bytes=N-' ranges
+    ArcGIS layers    added with add_layer(service_path, features); answers
+                     the layer description (?f=json), <service>/layers,
+                     returnCountOnly queries and resultOffset pages
+    captures         responses of the live sources recorded in a directory,
+                     see below
+
+so the fetchers can be timed without the network.
+
+Record and replay: pointed at through fetch_utils' base url, a request for
+https://host/path?query reaches the server as /host/path?query. Started
+with record=True, the server fetches what it does not have from the live
+host and keeps the response in its captures directory; otherwise it only
+serves what the directory holds. The features of the recorded pages of an
+ArcGIS query are served as a layer, so they can be paged in any way.
+
+    $ python scripts/benchmark/stub_server.py --captures captures --record
+    $ COVID_DATA_BASE_URL=http://127.0.0.1:8000 python scrapers.py
+    (stop the server, then on an offline box)
+    $ python scripts/benchmark/stub_server.py --captures captures \\
+        --latency 200 --error-rate 0.05 --scale 10
+
+To load-test the fetchers, every answer can be delayed (latency, plus up to
+jitter more), a share of them answered with error_status instead
+(error_rate), and the ArcGIS layers and csv files served scale times over.
+Which requests fail and how long each one waits only depend on the seed,
+the request and how many times it was made before, so runs are repeatable.
+
+Meant to be run with Python 3.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+DEFAULT_MAX_RECORD_COUNT = 2000
+LAST_EDIT_DATE = 1587076289000
+DEFAULT_PORT = 8000
+INDEX_NAME = 'index.json'
+BODIES_DIR = 'bodies'
+UPSTREAM_SCHEME = 'https'
+UPSTREAM_TIMEOUT = 60
+# Headers of a recorded response that are replayed.
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def capture_key(path, query=''):
+    """Returns the key of a request in the captures: its path and its
+    sorted query."""
+    query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return path.rstrip('/') + ('?' + query if query else '')
+
+
+def scale_features(features, scale):
+    """Repeats features scale times. The string attributes of the k-th
+    copy end with ' #k', so the copies are distinct locations."""
+    scaled = list(features)
+    for copy in range(1, scale):
+        suffix = ' #%d' % copy
+        for feature in features:
+            attributes = dict(
+                (key, value + suffix if isinstance(value, str) else value)
+                for key, value in feature.get('attributes', {}).items())
+            scaled.append(dict(feature, attributes=attributes))
+    return scaled
+
+
+def scale_csv(body, scale):
+    """Repeats the rows of a csv body, not its header, scale times."""
+    header, newline, rows = body.partition(b'\n')
+    if rows and not rows.endswith(b'\n'):
+        rows += b'\n'
+    return header + newline + rows * scale
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json',
+              headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_json(self, payload):
+        self._send(200, json.dumps(payload).encode('utf-8'))
+
+    def _send_file(self, body, etag, content_type='text/plain',
+                   headers=None):
+        headers = dict(headers or {}, ETag=etag)
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, headers=headers)
+            return
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes=') and byte_range.endswith('-'):
+            start = int(byte_range[len('bytes='):-1])
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, len(body) - 1, len(body))
+            self._send(206, body[start:], content_type, headers)
+            return
+        self._send(200, body, content_type, headers)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server.stub
+        parts = urlsplit(self.path)
+        query = dict((key, values[-1])
+                     for key, values in parse_qs(parts.query).items())
+        path = parts.path.rstrip('/')
+        server.count_request()
+
+        error = server.delay(self.path)
+        if error:
+            self._send(server.error_status)
+            return
+
+        service, _, tail = path.rpartition('/')
+        if path.endswith('/query'):
+            service, _, layer_id = service.rpartition('/')
+            if (service, layer_id) in server.layers:
+                self._send_layer_query(server, (service, layer_id), query)
+                return
+
+        if path in server.files:
+            body, etag = server.files[path]
+            self._send_file(body, etag)
+            return
+
+        capture = server.find_capture(path, parts.query)
+        if capture is not None:
+            body = server.read_body(capture)
+            headers = dict((key, value)
+                           for key, value in capture['headers'].items()
+                           if key not in ('Content-Type', 'ETag'))
+            if capture['status'] != 200:
+                self._send(capture['status'], body,
+                           capture['headers'].get('Content-Type', ''),
+                           headers)
+            else:
+                self._send_file(body, capture['headers'].get('ETag') or
+                                '"%s"' % capture['body'],
+                                capture['headers'].get('Content-Type', ''),
+                                headers)
+            return
+
+        if tail == 'layers':
+            self._send_json({'layers': [
+                server.layer_info(layer_id)
+                for (layer_service, layer_id) in sorted(server.layers)
+                if layer_service == service]})
+        elif (service, tail) in server.layers:
+            self._send_json(server.layer_info(tail))
+        else:
+            self._send(404)
+
+    def _send_layer_query(self, server, layer, query):
+        features = server.layers[layer]
+        if query.get('returnCountOnly') == 'true':
+            self._send_json({'count': len(features)})
+            return
+        max_record_count = server.record_counts.get(
+            layer, server.max_record_count)
+        offset = int(query.get('resultOffset', 0))
+        count = int(query.get('resultRecordCount', max_record_count))
+        count = min(count, max_record_count)
+        self._send_json({'features': features[offset:offset + count]})
+
+
+class StubServer(object):
+    """A local stand-in for GitHub raw files, ArcGIS feature layers and
+    recorded sources.
+
+    Use as a context manager, or call start() and stop().
+    """
+
+    def __init__(self, max_record_count=DEFAULT_MAX_RECORD_COUNT,
+                 captures_dir=None, record=False, latency=0, jitter=0,
+                 error_rate=0, error_status=503, scale=1, seed=0,
+                 port=0):
+        """
+        Args:
+            max_record_count: Page size limit of the ArcGIS layers.
+            captures_dir: Directory of the recorded responses, or None.
+            record: Whether to fetch and record the requests that are not
+                in captures_dir yet.
+            latency, jitter: Seconds every answer waits for, plus a random
+                share of jitter seconds.
+            error_rate: Share of the requests answered with error_status.
+            scale: How many times over the ArcGIS layers and the csv files
+                are served.
+            seed: Seed of the latency and the errors.
+            port: Port to listen on, any free one if 0.
+        """
+        self.files = {}  # Keys are paths, values are (body, etag)
+        self.layers = {}  # Keys are (service path, layer id)
+        self.record_counts = {}  # Page size limits of recorded layers
+        self.captures = {}  # Keys are capture_key(), values are entries
+        self.max_record_count = max_record_count
+        self.captures_dir = captures_dir
+        self.record = record
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.scale = scale
+        self.seed = seed
+        self.requests = 0
+        self._seen = {}  # Times each request was made
+        self._lock = threading.Lock()
+        if captures_dir is not None:
+            self.load_captures(captures_dir)
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+
+    def add_file(self, path, body):
+        """Serves body at path and returns its url."""
+        if self.scale > 1:
+            body = scale_csv(body, self.scale)
+        self.files[path] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+        return self.url + path
+
+    def add_layer(self, service_path, features, layer_id=0):
+        """Serves features as layer layer_id of the FeatureServer at
+        service_path and returns the layer url."""
+        self.layers[(service_path, str(layer_id))] = scale_features(
+            features, self.scale)
+        return '%s%s/%s' % (self.url, service_path, layer_id)
+
+    def layer_info(self, layer_id):
+        return {
+            'id': int(layer_id),
+            'maxRecordCount': self.max_record_count,
+            'objectIdField': 'OBJECTID',
+            'advancedQueryCapabilities': {'supportsPagination': True},
+            'editingInfo': {'lastEditDate': LAST_EDIT_DATE},
+        }
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def delay(self, request):
+        """Sleeps for the latency of a request. Returns True if it is to be
+        answered with an error."""
+        with self._lock:
+            seen = self._seen.get(request, 0)
+            self._seen[request] = seen + 1
+        draw = random.Random('%s %s %d' % (self.seed, request, seen))
+        wait = self.latency + self.jitter * draw.random()
+        if wait > 0:
+            time.sleep(wait)
+        return draw.random() < self.error_rate
+
+    # Captures
+
+    def _index_path(self):
+        return os.path.join(self.captures_dir, INDEX_NAME)
+
+    def _body_path(self, digest):
+        return os.path.join(self.captures_dir, BODIES_DIR, digest + '.gz')
+
+    def load_captures(self, captures_dir):
+        """Serves the responses recorded in captures_dir."""
+        self.captures_dir = captures_dir
+        try:
+            with open(self._index_path(), 'r') as index_file:
+                self.captures = json.load(index_file)
+        except IOError:
+            self.captures = {}
+        pages = {}  # Layer -> {offset: features}
+        for key, capture in self.captures.items():
+            path, _, query = key.partition('?')
+            query = dict(parse_qsl(query))
+            if capture['status'] != 200 or \
+                    query.get('returnCountOnly') == 'true':
+                continue
+            if path.endswith('/query'):
+                service, _, layer_id = path[:-len('/query')].rpartition('/')
+                payload = json.loads(self.read_body(capture).decode('utf-8'))
+                if isinstance(payload, dict) and 'features' in payload:
+                    pages.setdefault((service, layer_id), {})[
+                        int(query.get('resultOffset', 0))] = \
+                        payload['features']
+            elif query.get('f') == 'json':
+                service, _, layer_id = path.rpartition('/')
+                info = json.loads(self.read_body(capture).decode('utf-8'))
+                if isinstance(info, dict) and info.get('maxRecordCount'):
+                    self.record_counts[(service, layer_id)] = \
+                        info['maxRecordCount']
+        for layer, layer_pages in pages.items():
+            features = []
+            for offset in sorted(layer_pages):
+                features.extend(layer_pages[offset])
+            self.layers[layer] = scale_features(features, self.scale)
+
+    def find_capture(self, path, query):
+        """Returns the capture of a request, recording it first if needed,
+        or None."""
+        key = capture_key(path, query)
+        capture = self.captures.get(key)
+        if capture is None and self.record:
+            capture = self._record(key)
+        return capture
+
+    def read_body(self, capture):
+        with gzip.open(self._body_path(capture['body']), 'rb') as body_file:
+            body = body_file.read()
+        content_type = capture['headers'].get('Content-Type', '')
+        if self.scale > 1 and capture['status'] == 200 and \
+                ('csv' in content_type or capture['key'].endswith('.csv')):
+            body = scale_csv(body, self.scale)
+        return body
+
+    def _record(self, key):
+        """Fetches https://<key> and keeps the response."""
+        request = Request('%s:/%s' % (UPSTREAM_SCHEME, key),
+                          headers={'Accept-Encoding': 'identity',
+                                   'User-Agent': 'python-requests'})
+        try:
+            with urlopen(request, timeout=UPSTREAM_TIMEOUT) as response:
+                status, headers, body = (response.status, response.headers,
+                                         response.read())
+        except HTTPError as error:
+            status, headers, body = error.code, error.headers, error.read()
+        digest = hashlib.sha256(body).hexdigest()
+        body_path = self._body_path(digest)
+        if not os.path.exists(body_path):
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            with gzip.open(body_path + '.tmp', 'wb') as body_file:
+                body_file.write(body)
+            os.replace(body_path + '.tmp', body_path)
+        capture = {
+            'key': key,
+            'status': status,
+            'headers': dict((name, headers[name]) for name in KEPT_HEADERS
+                            if headers.get(name)),
+            'body': digest,
+        }
+        with self._lock:
+            self.captures[key] = capture
+            tmp_path = self._index_path() + '.tmp'
+            with open(tmp_path, 'w') as index_file:
+                json.dump(self.captures, index_file, indent=1,
+                          sort_keys=True)
+            os.replace(tmp_path, self._index_path())
+        return capture
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve recorded responses of the sources, recording "
+                    "the missing ones with --record.")
+    parser.add_argument("--captures", required=True,
+                        help="directory of the recorded responses")
+    parser.add_argument("--record", action="store_true",
+                        help="fetch and record what is not recorded yet")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds every answer waits for")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="up to this many more milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="share of the requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--scale", type=int, default=1,
+                        help="serve the ArcGIS layers and csv files this "
+                        "many times over")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.captures):
+        os.makedirs(args.captures)
+    server = StubServer(captures_dir=args.captures, record=args.record,
+                        latency=args.latency / 1000.0,
+                        jitter=args.jitter / 1000.0,
+                        error_rate=args.error_rate,
+                        error_status=args.error_status, scale=args.scale,
+                        seed=args.seed, port=args.port)
+    print('Serving %d recorded responses; run the scripts with '
+          'COVID_DATA_BASE_URL=%s' % (len(server.captures), server.url))
+    with server:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
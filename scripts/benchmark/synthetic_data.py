@@ -0,0 +1,143 @@
+"""
+Generators of synthetic inputs for the benchmarks.
+
+Every generator is deterministic for a given seed and writes files in the
+same format as the real raw data, so the processing scripts can read them
+unchanged.
+"""
+import csv
+import datetime
+import os
+import random
+
+DH_COLUMNS = [
+    'X', 'Y', 'OBJECTID', 'HOSPITAL_NAME', 'HOSPITAL_TYPE', 'HQ_ADDRESS',
+    'HQ_ADDRESS1', 'HQ_CITY', 'HQ_STATE', 'HQ_ZIP_CODE', 'COUNTY_NAME',
+    'STATE_NAME', 'STATE_FIPS', 'CNTY_FIPS', 'FIPS', 'NUM_LICENSED_BEDS',
+    'NUM_STAFFED_BEDS', 'NUM_ICU_BEDS', 'ADULT_ICU_BEDS', 'PEDI_ICU_BEDS',
+    'BED_UTILIZATION', 'Potential_Increase_In_Bed_Capac',
+    'AVG_VENTILATOR_USAGE'
+]
+DH_FILENAME = 'Definitive_Healthcare__USA_Hospital_Beds_%m-%d-%Y.csv'
+DH_START = datetime.date(2020, 4, 7)
+BORO_START = datetime.date(2020, 4, 1)
+BOROUGHS = ['BRONX', 'BROOKLYN', 'MANHATTAN', 'QUEENS', 'STATEN ISLAND']
+
+
+def days_from(start, days):
+    """Returns the first days dates from start."""
+    return [start + datetime.timedelta(offset) for offset in range(days)]
+
+
+def write_dh_snapshots(directory, hospitals, days, seed=0):
+    """Writes one Definitive Healthcare snapshot per day.
+
+    About 2% of the utilization values are left empty, as in the real files.
+
+    Args:
+        directory: The directory to write to.
+        hospitals: Number of hospitals per snapshot.
+        days: Number of daily snapshots, starting on DH_START.
+        seed: Seed of the random values.
+
+    Returns:
+        The number of rows written.
+    """
+    rng = random.Random(seed)
+    for day in days_from(DH_START, days):
+        path = os.path.join(directory, day.strftime(DH_FILENAME))
+        with open(path, 'w', newline='') as dh_file:
+            writer = csv.writer(dh_file)
+            writer.writerow(DH_COLUMNS)
+            for hospital in range(hospitals):
+                utilization = '' if rng.random() < 0.02 else \
+                    '%.9f' % rng.random()
+                writer.writerow([
+                    '%.6f' % rng.uniform(-120, -70),
+                    '%.6f' % rng.uniform(25, 48), hospital,
+                    'Hospital %06d' % hospital,
+                    'Short Term Acute Care Hospital', '1 Main St', '',
+                    'Town', 'TN', '37129', 'County', 'Tennessee', '47',
+                    '149', '47149', rng.randint(10, 900),
+                    rng.randint(10, 900), rng.randint(0, 90),
+                    rng.randint(0, 90), 0, utilization, rng.randint(0, 90),
+                    rng.randint(0, 30)])
+    return hospitals * days
+
+
+def write_boro_snapshots(directory, regions, days, seed=0):
+    """Writes one boro snapshot per day, named like boro04012020.
+
+    The first five regions are the real boroughs, the others are made up.
+
+    Returns:
+        The number of rows written.
+    """
+    rng = random.Random(seed)
+    names = (BOROUGHS + ['REGION %05d' % region
+                         for region in range(max(regions - 5, 0))])[:regions]
+    for day in days_from(BORO_START, days):
+        path = os.path.join(directory, day.strftime('boro%m%d%Y'))
+        with open(path, 'w', newline='') as boro_file:
+            writer = csv.writer(boro_file)
+            writer.writerow(['BOROUGH_GROUP', 'COVID_CASE_COUNT',
+                             'COVID_CASE_RATE'])
+            for name in names:
+                writer.writerow([name, rng.randint(0, 20000),
+                                 '%.2f' % rng.uniform(0, 1000)])
+    return regions * days
+
+
+def arcgis_features(count, zip_field='ZipCode', case_field='Cases', seed=0):
+    """Returns count ArcGIS features with zip codes and case counts.
+
+    A few counts are 'Data Suppressed' or negative, which the case_counts
+    transform of scrapers.py turns into NA.
+    """
+    rng = random.Random(seed)
+    features = []
+    for feature in range(count):
+        roll = rng.random()
+        if roll < 0.01:
+            cases = 'Data Suppressed'
+        elif roll < 0.02:
+            cases = -1
+        else:
+            cases = rng.randint(0, 5000)
+        features.append({'attributes': {
+            'OBJECTID': feature + 1,
+            zip_field: '%05d' % (10000 + feature),
+            case_field: cases,
+        }})
+    return features
+
+
+def zip_code_csv(locations, seed=0):
+    """Returns the bytes of a csv shaped like NYC's tests-by-zcta.csv."""
+    rng = random.Random(seed)
+    lines = ['MODZCTA,Positive,Total,zcta_cum.perc_pos']
+    for location in range(locations):
+        positive = rng.randint(0, 5000)
+        total = positive + rng.randint(0, 5000)
+        lines.append('%05d,%d,%d,%.2f' % (10000 + location, positive, total,
+                                          100.0 * positive / max(total, 1)))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def write_wide_csv(path, locations, days, seed=0):
+    """Writes a processed wide csv with quoted locations and dates.
+
+    Returns:
+        The number of cells written.
+    """
+    rng = random.Random(seed)
+    dates = ['"%s"' % day.strftime('%m/%d/%y')
+             for day in days_from(BORO_START, days)]
+    with open(path, 'w', newline='') as csv_file:
+        csv_file.write(','.join(['""'] + dates) + '\n')
+        for location in range(locations):
+            values = [str(rng.randint(0, 5000)) if rng.random() > 0.05
+                      else 'NA' for _ in dates]
+            csv_file.write(','.join(['"%05d"' % (10000 + location)] + values)
+                           + '\n')
+    return locations * days
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import csv
 import datetime
 import logging
 import numpy as np
@@ -7,13 +8,29 @@ import os
 import pandas as pd
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import atomic_io
+import date_utils
+import file_lock
+import http_cache
+import metrics
+import raw_archive
+import snapshot_cache
 import utils
-import urllib2
 
 
 BORO = 'boro'
+REGION = 'REGION'
+DATE = 'DATE'
+BOROUGH_GROUP = 'BOROUGH_GROUP'
+COVID_CASE_COUNT = 'COVID_CASE_COUNT'
+# Region names that differ from the lower-cased BOROUGH_GROUP.
+REGION_NAMES = {'bronx': 'the bronx'}
 BORO_DATA_URL = \
     'https://raw.githubusercontent.com/nychealth/coronavirus-data/master/boro.csv'
+# Name and version of the parsed snapshot cache. Bump the version whenever
+# readBoroFile changes what it returns.
+CACHE_NAME = 'boro'
+CACHE_VERSION = 2
 
 logging.basicConfig(filename='log/boroProcess.log',
                     level=logging.INFO,
@@ -23,15 +40,17 @@ logger = logging.getLogger()
 
 
 def fetchBoroDataFromURL(input_directory):
-    """Fetches boro data from BORO_DATA_URL and write to boro_data/.
+    """Fetches boro data from BORO_DATA_URL and archives it.
 
-    Fetches latest boro data provided by BORO_DATA_URL and saves it to 
-    boro_data/ with filename 'boro${month}${day}${year}'. For example, 
-    if the program is executed on April 8, 2020, then the filename 
-    will be 'boro04082020'.
+    Fetches latest boro data provided by BORO_DATA_URL and keeps it in the
+    raw archive (see raw_archive.py) as the boro data of the execution day.
+    The request goes through http_cache, so an unchanged file is served
+    from disk instead of being downloaded again, and a file the archive
+    already holds for the day is not archived again. Nothing is written to
+    input_directory any more; the files already there are still read.
 
     Args:
-        None
+        input_directory: str, the directory of the older boro files, unused
 
     Returns:
         None
@@ -39,13 +58,19 @@ def fetchBoroDataFromURL(input_directory):
     """
     now = datetime.datetime.now()
     try:
-        filename = input_directory + 'boro' + now.strftime('%m%d%Y')
-        response = urllib2.urlopen(BORO_DATA_URL)
-        content = response.read()
-        with open(filename, 'w') as file:
-            file.write(content)
+        with metrics.stage('fetch', source=CACHE_NAME):
+            response = http_cache.get(BORO_DATA_URL, commit=False)
+        if not response.changed and \
+                raw_archive.find(CACHE_NAME, now.date()) is not None:
+            logger.info('Skip: boro data unchanged for day: '
+                        + now.strftime('%m%d%Y'))
+            return
+        raw_archive.store(CACHE_NAME, response.path, now.date(),
+                          BORO_DATA_URL)
+        response.commit()
         logger.info('Sucess: Fetch boro data for day: ' + now.strftime('%m%d%Y'))
     except:
+        metrics.count('errors', stage='fetch', source=CACHE_NAME)
         logger.error('Fail: Can not fetch boro data for day: ' + now.strftime('%m%d%Y'))
 
 
@@ -53,74 +78,160 @@ def fetchTimeFromFilename(filename):
     """Fetches the name from the given filename and formats it.
 
     For example, given the filename 'boro04082020', this function
-    will return '4/8/20'.
+    will return '04/08/20'.
 
     Args:
         filename: str, the filename of boro data e.g. 'boro04082020'
 
     Returns:
-        str, the formatted time, e.g. '4/8/20'
+        str, the formatted time, e.g. '04/08/20'
 
     """
-    month = str(int(filename[4:6]))
-    day = str(int(filename[6:8]))
+    month = filename[4:6]
+    day = filename[6:8]
     year = filename[10:12]
     return month + '/' + day + '/' + year
 
 
-def processBoroData(input_directory):
-    """Fetches all the boro data from the specified directory.
+def readSnapshotFile(filename, region_column=BOROUGH_GROUP,
+                     value_column=COVID_CASE_COUNT):
+    """Reads the value of every region from one snapshot file.
+
+    Only the two columns are read, as strings, so the values are written
+    out exactly as published. Rows without a region are dropped. Region
+    names are lower-cased and renamed
+    according to REGION_NAMES. This works for any NYC Health snapshot with
+    one row per region, e.g. the zip code level files.
 
     Args:
-        input_directory: str, the directory which saves all boro data
+        filename: str, the path to a snapshot file
+        region_column: str, the column holding the region names
+        value_column: str, the column holding the values
 
     Returns:
-        boro_data: dict. The key is the day and the value is a 
-                         dictionary, say D, for the corresponding day.
-                         The key of D is the region, the value of D
-                         is the number of cases. If there is a missing
-                         value, the value of D will be 'NA'.
-        regions: dict, the key is the name of the region.
-                   
+        pandas.DataFrame with the columns REGION and value_column, or None
+        if the file can not be read.
+
     """
-    list_of_filenames = utils.fetchFilenamesFromDirectory(input_directory)
-    boro_data = {}
-    regions = {}
-    for filename in list_of_filenames:
-        if filename[:4] != BORO or len(filename) != 12:
-            continue
-        logger.info('Fetch Boro data from file: ' + input_directory
-                    + filename)
-        try:
-            daily_data = pd.read_csv(input_directory
-                    + filename).applymap(str)
-        except:
-            logger.error('Fail to fetch Boro data from file: '
-                         + input_directory + filename)
-        time = fetchTimeFromFilename(filename)
-
-        for (_, row) in daily_data.iterrows():
-            region = row['BOROUGH_GROUP'].lower()
-            if region == 'bronx':
-                region = 'the bronx'
-            if time not in boro_data:
-                boro_data[time] = {}
-            boro_data[time][region] = row['COVID_CASE_COUNT']
-            if region not in regions:
-                regions[region] = True
-    return (boro_data, regions)
-
-
-def format_boro_data(boro_data, regions, output_filename):
+    logger.info('Fetch Boro data from file: ' + filename)
+    try:
+        daily_data = pd.read_csv(filename, usecols=[region_column,
+                                                    value_column], dtype=str)
+    except:
+        logger.error('Fail to fetch Boro data from file: ' + filename)
+        return None
+
+    daily_data = daily_data.dropna(subset=[region_column])
+    regions = daily_data[region_column].str.lower()
+    return pd.DataFrame({REGION: regions.replace(REGION_NAMES),
+                         value_column: daily_data[value_column]})
+
+
+def readBoroFile(filename):
+    """Reads the case counts of every region from one boro file.
+
+    Args:
+        filename: str, the path to a boro file e.g. 'boro_data/boro04082020',
+                  or to a gzip-compressed one such as an archived blob
+
+    Returns:
+        pandas.DataFrame with the columns REGION and COVID_CASE_COUNT, or
+        None if the file can not be read.
+
+    """
+    return readSnapshotFile(filename)
+
+
+def processBoroData(input_directory, workers=1, archive_dir=None):
+    """Fetches all the boro data from the specified directory and the
+    raw archive.
+
+    The days in the raw archive come after the files of input_directory,
+    so an archived day wins over a file of the same day. Files and blobs
+    parsed on a previous run are loaded from the snapshot cache (see
+    snapshot_cache.py); only new or changed ones are parsed.
+
+    Args:
+        input_directory: str, the directory which saves the older boro
+                         files. It may be missing.
+        workers: int, the number of processes reading files in parallel.
+                 1 reads them serially.
+        archive_dir: str, the raw archive, raw_archive.DEFAULT_ARCHIVE_DIR
+                     if None
+
+    Returns:
+        boro_data: pandas.DataFrame with the columns REGION,
+                   COVID_CASE_COUNT and DATE, one row per region per file,
+                   in filename order, then per archived day in calendar
+                   order. DATE is the formatted time of the file, e.g.
+                   '04/08/20'.
+
+    """
+    list_of_filenames = []
+    if os.path.isdir(input_directory):
+        list_of_filenames = utils.fetchFilenamesFromDirectory(input_directory)
+    list_of_filenames = [filename for filename in sorted(list_of_filenames)
+                         if filename[:4] == BORO and len(filename) == 12]
+    paths = [input_directory + filename for filename in list_of_filenames]
+    days = [fetchTimeFromFilename(filename) for filename in list_of_filenames]
+    # Blobs are gzip files named after their content, so they never change
+    # and pandas reads them as they are.
+    for entry in raw_archive.latest_per_day(CACHE_NAME, archive_dir):
+        paths.append(raw_archive.blob_path(entry['blob'], archive_dir))
+        days.append(date_utils.canonical(entry['date']))
+
+    cache = snapshot_cache.SnapshotCache(CACHE_NAME, CACHE_VERSION)
+    with metrics.stage('parse', source=CACHE_NAME):
+        all_daily_cases = snapshot_cache.map_cached(cache, readBoroFile,
+                                                    paths, workers)
+    metrics.count('files', len(paths), stage='parse', source=CACHE_NAME)
+    metrics.count('errors', sum(daily_cases is None
+                                for daily_cases in all_daily_cases),
+                  stage='parse', source=CACHE_NAME)
+
+    daily_frames = [daily_cases.assign(**{DATE: day})
+                    for (day, daily_cases) in zip(days, all_daily_cases)
+                    if daily_cases is not None]
+    if not daily_frames:
+        return pd.DataFrame(columns=[REGION, COVID_CASE_COUNT, DATE])
+    return pd.concat(daily_frames, ignore_index=True)
+
+
+def pivot_snapshots(daily_data, days, value_column=COVID_CASE_COUNT):
+    """Pivots the daily snapshots into a region x day table.
+
+    When a region appears more than once in a day, the value from the last
+    file wins. Days without a value are 'NA'.
+
+    Args:
+        daily_data: pandas.DataFrame, as returned by processBoroData
+        days: list of str, the formatted days to use as columns
+        value_column: str, the column to pivot
+
+    Returns:
+        pandas.DataFrame indexed by the sorted region names with one column
+        per day.
+
+    """
+    regions = pd.Index(sorted(daily_data[REGION].unique()))
+    days = pd.Index(days)
+    values = daily_data.drop_duplicates(subset=[REGION, DATE], keep='last')
+    values = values[values[value_column].notnull()]
+
+    rows = regions.get_indexer(values[REGION])
+    columns = days.get_indexer(values[DATE])
+    in_range = columns >= 0
+    table = np.full((len(regions), len(days)), 'NA', dtype=object)
+    table[rows[in_range], columns[in_range]] = \
+        values[value_column].values[in_range]
+    return pd.DataFrame(table, index=regions, columns=days)
+
+
+def format_boro_data(boro_data, output_filename):
     """Formats boro data and output to a csv file.
 
     Args:
-        boro_data: dict. The key is the day and the value is a 
-                         dictionary, say D, for the corresponding day.
-                         The key of D is the region, the value of D
-                         is the number of cases. If there is a missing
-                         value, the value of D will be 'NA'.
-        regions: dict, the key is the name of the region.
+        boro_data: pandas.DataFrame, as returned by processBoroData
         output_filename: str, the path to the output csv file
 
     Returns:
@@ -128,36 +239,36 @@ def format_boro_data(boro_data, regions, output_filename):
 
     """
     days = utils.getDays(2020, 4, 1)
-    formatted_data = {'': days}
-
-    for region in regions:
-        region_cases = []
-        for day in days:
-            if day not in boro_data or region not in boro_data[day] \
-                or boro_data[day][region] == np.NaN:
-                region_cases.append('NA')
-            else:
-                region_cases.append(boro_data[day][region])
-        formatted_data[region] = region_cases
-    pd.DataFrame(formatted_data).T.to_csv(output_filename,
-            header=False, index=True)
+    with metrics.stage('merge', source=CACHE_NAME):
+        table = pivot_snapshots(boro_data, days)
+    with metrics.stage('write', source=CACHE_NAME), \
+            file_lock.locked(output_filename):
+        with atomic_io.atomic_write(output_filename) as output_file:
+            output_file.write(','.join([''] + date_utils.header_cells(days))
+                              + '\n')
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerows(np.column_stack([table.index.values,
+                                              table.values]).tolist())
+    metrics.count('rows', len(table), stage='write', source=CACHE_NAME)
 
 
 def main():
     # Get input directory and output filename from command line arguments
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         print('Incorrect number of arguments. '  \
               'Usage: python boroProcess.py '  \
-              '${input_directory} ${output_fliename}')
+              '${input_directory} ${output_fliename} [${workers}]')
     input_directory = sys.argv[1]
     output_filename = sys.argv[2]
+    workers = utils.fetchWorkerCount(sys.argv[3] if len(sys.argv) > 3
+                                     else None)
 
     # Fetch boro data from the given URL
     fetchBoroDataFromURL(input_directory)
 
     # Process/format boro data and output to a csv file
-    (boro_data, regions) = processBoroData(input_directory)
-    format_boro_data(boro_data, regions, output_filename)
+    boro_data = processBoroData(input_directory, workers)
+    format_boro_data(boro_data, output_filename)
 
 
 if __name__ == '__main__':
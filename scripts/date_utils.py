@@ -0,0 +1,243 @@
+"""
+Dates of the processed files.
+
+The processed csvs used to spell their dates in several ways ('1/22/20',
+'"04/16/20"', '4/1/2020', ...) while the README asks for quoted MM/DD/YY
+cells. This module turns any of these spellings into a day ordinal
+(datetime.date.toordinal()) and back, so comparing, sorting and looking up
+dates is integer work:
+
+    >>> to_ordinal('"4/1/2020"') == to_ordinal('04/01/20')
+    True
+    >>> format_day(to_ordinal('4/1/2020'), QUOTED)
+    '"04/01/20"'
+
+Parsed spellings are memoized, and formatted days come from a calendar table
+that is built once per process, from FIRST_DAY to a year past today, and
+grown when a later day is asked for. to_ordinals() and format_days() convert
+a whole header row or column at once, and header_cells() gives the cells
+every writer puts in its header, '"MM/DD/YY"'.
+
+Run this script to list the processed csvs whose header dates are not in the
+canonical "MM/DD/YY" form, or with --fix to rewrite them:
+
+    $ python scripts/date_utils.py [--fix] [${csv_path} ...]
+
+Meant to be run with Python 3.
+"""
+import argparse
+import datetime
+import functools
+import os
+import threading
+
+import numpy as np
+
+import atomic_io
+import file_lock
+import processed_matrix
+
+SHORT = 'short'  # 4/8/20, as in the older files
+PADDED = 'padded'  # 04/08/20, the canonical spelling
+QUOTED = 'quoted'  # "04/08/20", the canonical header cell
+STYLES = (SHORT, PADDED, QUOTED)
+FIRST_DAY = datetime.date(2019, 12, 1)
+TABLE_MARGIN_DAYS = 366
+
+_lock = threading.Lock()
+_table = {'first': FIRST_DAY.toordinal(), 'end': None}  # Plus one per style
+
+
+def _format(date, style):
+    if style == SHORT:
+        return '%d/%d/%02d' % (date.month, date.day, date.year % 100)
+    padded = '%02d/%02d/%02d' % (date.month, date.day, date.year % 100)
+    return '"%s"' % padded if style == QUOTED else padded
+
+
+def _grow_table(end):
+    """Builds the calendar table up to, not including, the ordinal end."""
+    with _lock:
+        if _table['end'] is not None and _table['end'] >= end:
+            return
+        dates = [datetime.date.fromordinal(ordinal)
+                 for ordinal in range(_table['first'], end)]
+        for style in STYLES:
+            column = np.empty(len(dates), dtype=object)
+            column[:] = [_format(date, style) for date in dates]
+            _table[style] = column
+        _table['end'] = end
+
+
+def _table_for(last_ordinal):
+    if _table['end'] is None or last_ordinal >= _table['end']:
+        _grow_table(max(last_ordinal + 1, datetime.date.today().toordinal()
+                        + TABLE_MARGIN_DAYS))
+    return _table
+
+
+@functools.lru_cache(maxsize=None)
+def _parse(date_string):
+    month, day, year = date_string.strip().strip('"').split('/')
+    year = int(year)
+    if year < 100:
+        year += 2000
+    return datetime.date(year, int(month), int(day)).toordinal()
+
+
+def to_ordinal(date):
+    """Returns the day ordinal of a date.
+
+    Args:
+        date: A datetime.date, or a string 'M/D/YY' or 'M/D/YYYY', quoted
+            or not, with or without zero padding.
+
+    Raises:
+        ValueError: If the string is not a date.
+    """
+    if isinstance(date, datetime.date):
+        return date.toordinal()
+    return _parse(date)
+
+
+def to_date(date):
+    """Returns a date given in any of the forms to_ordinal() accepts as a
+    datetime.date."""
+    if isinstance(date, datetime.date):
+        return date
+    return datetime.date.fromordinal(_parse(date))
+
+
+def to_ordinals(dates):
+    """Returns the day ordinals of a sequence of date strings as an int64
+    array. Every distinct spelling is parsed once."""
+    values = np.empty(len(dates), dtype=object)
+    values[:] = list(dates)
+    if not len(values):
+        return np.zeros(0, dtype=np.int64)
+    unique, inverse = np.unique(values.astype(str), return_inverse=True)
+    ordinals = np.array([_parse(date) for date in unique], dtype=np.int64)
+    return ordinals[inverse]
+
+
+def format_day(ordinal, style=PADDED):
+    """Formats a day ordinal in one of STYLES."""
+    return format_days([ordinal], style)[0]
+
+
+def format_days(ordinals, style=PADDED):
+    """Formats a sequence of day ordinals in one of STYLES.
+
+    Returns:
+        A list of str.
+    """
+    if style not in STYLES:
+        raise ValueError('Unknown date style %r' % style)
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    if not len(ordinals):
+        return []
+    table = _table_for(int(ordinals.max()))
+    if ordinals.min() < table['first']:
+        return [_format(datetime.date.fromordinal(int(ordinal)), style)
+                for ordinal in ordinals]
+    return table[style][ordinals - table['first']].tolist()
+
+
+def day_range(start, end=None, style=SHORT):
+    """Returns every day from start to end, inclusive, formatted in style.
+
+    Args:
+        start: The first day, in any form to_ordinal() accepts.
+        end: The last day, today if None.
+        style: One of STYLES.
+    """
+    end = datetime.date.today() if end is None else end
+    return format_days(np.arange(to_ordinal(start), to_ordinal(end) + 1),
+                       style)
+
+
+def canonical(date, style=PADDED):
+    """Returns a date respelled in style, MM/DD/YY by default."""
+    return format_day(to_ordinal(date), style)
+
+
+def header_cells(dates):
+    """Returns dates, in any form to_ordinal() accepts, as canonical header
+    cells: '"MM/DD/YY"'. Join them with commas; csv.writer would escape the
+    quotes.
+
+    Returns:
+        A list of str.
+    """
+    return format_days(to_ordinals(dates), QUOTED)
+
+
+def canonicalize_header(header):
+    """Respells the date cells of a csv header as "MM/DD/YY".
+
+    The first cell names the rows and is left alone, as are cells that are
+    not dates.
+
+    Returns:
+        The new header cells, a list of str.
+    """
+    cells = list(header[:1])
+    for cell in header[1:]:
+        try:
+            ordinal = to_ordinal(cell)
+        except ValueError:
+            cells.append(cell)
+            continue
+        cells.append(format_day(ordinal, QUOTED))
+    return cells
+
+
+def _read_header(csv_path):
+    with open(csv_path, 'r', newline='') as csv_file:
+        line = csv_file.readline()
+    return line.rstrip('\r\n').split(',')
+
+
+def _fix_header(csv_path, header):
+    """Rewrites the header of a csv that has no series log."""
+    with file_lock.locked(csv_path):
+        with open(csv_path, 'r', newline='') as csv_file:
+            first_line = csv_file.readline()
+            rest = csv_file.read()
+        line_terminator = first_line[len(first_line.rstrip('\r\n')):]
+        with atomic_io.atomic_write(csv_path, newline='') as csv_file:
+            csv_file.write(','.join(header) + line_terminator)
+            csv_file.write(rest)
+
+
+def main(argv=None):
+    import series_store  # Imports this module
+    parser = argparse.ArgumentParser(
+        description="List, or fix, processed csvs whose header dates are "
+                    "not \"MM/DD/YY\".")
+    parser.add_argument("csv_paths", nargs="*",
+                        help="default: every csv under processed_data/")
+    parser.add_argument("--fix", action="store_true",
+                        help="rewrite the headers")
+    args = parser.parse_args(argv)
+
+    for path in args.csv_paths or processed_matrix.find_processed_csvs():
+        header = _read_header(path)
+        fixed = canonicalize_header(header)
+        if fixed == header:
+            continue
+        if len(set(fixed[1:])) < len(fixed) - 1:
+            print('%s - not canonical, and holds the same day twice; '
+                  'fix by hand' % path)
+        elif not args.fix:
+            print('%s - not canonical' % path)
+        elif os.path.exists(series_store.log_path(path)):
+            series_store.rename_dates(path, dict(zip(header[1:], fixed[1:])))
+            print('%s - fixed through its series log' % path)
+        else:
+            _fix_header(path, fixed)
+            print('%s - fixed' % path)
+
+
+if __name__ == '__main__':
+    main()
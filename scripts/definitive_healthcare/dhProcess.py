@@ -1,16 +1,35 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import csv
+import io
 import logging
 import numpy as np
 import os
 import pandas as pd
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import atomic_io
+import date_utils
+import file_lock
+import metrics
+import snapshot_cache
 import utils
 
 DEFINITIVE_HEALTHCARE_PREFIX = \
     'Definitive_Healthcare__USA_Hospital_Beds_'
+HOSPITAL_NAME = 'HOSPITAL_NAME'
+DATE = 'DATE'
+OUTPUT_COLUMNS = [HOSPITAL_NAME, 'BED_UTILIZATION', 'AVG_VENTILATOR_USAGE']
+# Name and version of the parsed snapshot cache. Bump the version whenever
+# readDailyFile changes what it returns.
+CACHE_NAME = 'definitive_healthcare'
+CACHE_VERSION = 2
+# Column reported on and the file it is written to, relative to the output
+# directory.
+OUTPUT_FILES = [('BED_UTILIZATION', 'beds/US/us-hospital_beds.csv'),
+                ('AVG_VENTILATOR_USAGE',
+                 'ventilators/US/us-hospital_ventilators.csv')]
 
 logging.basicConfig(filename='log/dhProcess.log', level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -23,7 +42,7 @@ def fetchTimeFromFilename(filename):
 
     For example, given the filename 
     'Definitive_Healthcare__USA_Hospital_Beds_04-07-2020.csv'
-    this function will return '4/7/20'.
+    this function will return '04/07/20'.
 
     Args:
         filename: str, the filename of definitive healthcare data
@@ -33,94 +52,180 @@ def fetchTimeFromFilename(filename):
 
     """
 
-    month = str(int(filename[41:43]))
-    day = str(int(filename[44:46]))
+    month = filename[41:43]
+    day = filename[44:46]
     year = filename[49:51]
     return month + '/' + day + '/' + year
 
 
-def readDataFromDirectory(input_directory):
+def readDailyFile(filename):
+    """Reads the reported columns of one definitive healthcare file.
+
+    Values are kept as the strings the previous per-row implementation
+    produced (e.g. '0.5473432', 'nan').
+
+    Args:
+        filename: str, the path to a definitive healthcare file
+
+    Returns:
+        pandas.DataFrame with the columns HOSPITAL_NAME, BED_UTILIZATION,
+        AVG_VENTILATOR_USAGE and DATE, or None if the file can not be read.
+
+    """
+    logger.info('Fetch definitive healthcare data from file: ' + filename)
+    try:
+        daily_data = pd.read_csv(filename, usecols=OUTPUT_COLUMNS)
+    except:
+        logger.error('Fail to fetch definitive healthcare data from file: '
+                      + filename)
+        return None
+    # Convert to str per file, so an all-integer column stays '0' rather
+    # than being upcast to '0.0' when the files are concatenated.
+    daily_data = daily_data.astype(str)
+    daily_data[DATE] = fetchTimeFromFilename(os.path.basename(filename))
+    return daily_data
+
+
+def readDataFromDirectory(input_directory, workers=1):
     """Fetches all the definitive healthcare data from the specified directory.
 
+    Files parsed on a previous run are loaded from the snapshot cache (see
+    snapshot_cache.py); only new or changed files are parsed.
+
     Args:
         input_directory: str, the directory which saves all data
+        workers: int, the number of processes reading files in parallel.
+                 1 reads them serially.
 
     Returns:
-        beds_utilization_summary: dict. The key is the day and the value 
-                         is a dictionary, say D, for the corresponding day.
-                         The key of D is the hospital name, the value of D
-                         is the bed utilization for that hospital. If there 
-                         is a missing value, the value of D will be 'NA'.
-        ventilator_usage_summary: dict. The key is the day and the value 
-                         is a dictionary, say D, for the corresponding day.
-                         The key of D is the hospital name, the value of D
-                         is the ventilator usage for that hospital. If there 
-                         is a missing value, the value of D will be 'NA'.
-        hospital_names: dict, the key is the name of the hospital.
+        daily_data: pandas.DataFrame with one row per hospital per day and
+                    the columns HOSPITAL_NAME, BED_UTILIZATION,
+                    AVG_VENTILATOR_USAGE and DATE. DATE is the formatted
+                    time of the file the row came from, e.g. '04/07/20'.
 
     """
 
     list_of_filenames = \
         utils.fetchFilenamesFromDirectory(input_directory)
-    beds_utilization_summary = {}
-    ventilator_usage_summary = {}
-    hospital_names = {}
-
-    for filename in list_of_filenames:
-        if filename[:41] != DEFINITIVE_HEALTHCARE_PREFIX \
-            or len(filename) != 55:
-            continue
-        logger.info('Fetch definitive healthcare data from file: '
-                    + input_directory + filename)
-        try:
-            daily_data = pd.read_csv(input_directory
-                    + filename).applymap(str)
-        except:
-            logger.error('Fail to fetch definitive healthcare data from file: '
-                          + input_directory + filename)
-        time = fetchTimeFromFilename(filename)
-
-        for (_, row) in daily_data.iterrows():
-            hospital_name = row['HOSPITAL_NAME']
-            bed_utilization = row['BED_UTILIZATION']
-            avg_ventilator_usage = row['AVG_VENTILATOR_USAGE']
-            if hospital_name not in hospital_names:
-                hospital_names[hospital_name] = True
-            if time not in beds_utilization_summary:
-                beds_utilization_summary[time] = {}
-            if time not in ventilator_usage_summary:
-                ventilator_usage_summary[time] = {}
-            if bed_utilization != 'nan':
-                beds_utilization_summary[time][hospital_name] = \
-                    bed_utilization
-            if avg_ventilator_usage != 'nan':
-                ventilator_usage_summary[time][hospital_name] = \
-                    avg_ventilator_usage
-
-    return (beds_utilization_summary, ventilator_usage_summary,
-            hospital_names)
-
-
-def format_output_data(
-    beds_utilization_summary,
-    ventilator_usage_summary,
-    hospital_names,
-    output_directory,
-    ):
+    filenames = [input_directory + filename for filename in
+                 sorted(list_of_filenames)
+                 if filename[:41] == DEFINITIVE_HEALTHCARE_PREFIX
+                 and len(filename) == 55]
+
+    cache = snapshot_cache.SnapshotCache(CACHE_NAME, CACHE_VERSION)
+    with metrics.stage('parse', source=CACHE_NAME):
+        daily_frames = [daily_data for daily_data in
+                        snapshot_cache.map_cached(cache, readDailyFile,
+                                                  filenames, workers)
+                        if daily_data is not None]
+    metrics.count('files', len(filenames), stage='parse', source=CACHE_NAME)
+    metrics.count('errors', len(filenames) - len(daily_frames),
+                  stage='parse', source=CACHE_NAME)
+    if not daily_frames:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS + [DATE])
+    with metrics.stage('merge', source=CACHE_NAME):
+        daily_data = pd.concat(daily_frames, ignore_index=True)
+    metrics.count('rows', len(daily_data), stage='merge', source=CACHE_NAME)
+    return daily_data
+
+
+def pivot_daily_data(daily_data, value_column, days):
+    """Pivots one column of the daily data into a hospital x day table.
+
+    When a hospital appears more than once in a day, the last value that is
+    not missing is used. Only the days with a snapshot get a column: the
+    output runs from 4/7/20 to today, and every other day is NA for every
+    hospital, so write_table fills those in as it writes.
+
+    Args:
+        daily_data: pandas.DataFrame, as returned by readDataFromDirectory
+        value_column: str, the column to pivot, e.g. 'BED_UTILIZATION'
+        days: list of str, the formatted days of the output
+
+    Returns:
+        pandas.DataFrame indexed by the sorted hospital names with one column
+        per day of days that has a value, in the order of days. Missing
+        values are 'NA'.
+
+    """
+    hospital_names = pd.Index(sorted(daily_data[HOSPITAL_NAME].unique()))
+    days = pd.Index(days)
+    values = daily_data.loc[daily_data[value_column] != 'nan',
+                            [HOSPITAL_NAME, DATE, value_column]]
+    values = values.drop_duplicates(subset=[HOSPITAL_NAME, DATE],
+                                    keep='last')
+
+    # Scatter the values into a single NA-filled block in one step; this is
+    # the pivot/reindex, without pandas splitting the result per column.
+    columns = days.get_indexer(values[DATE])
+    in_range = columns >= 0
+    reported = np.unique(columns[in_range])
+    rows = hospital_names.get_indexer(values[HOSPITAL_NAME][in_range])
+    table = np.empty((len(hospital_names), len(reported)), dtype=object)
+    table.fill('NA')
+    table[rows, reported.searchsorted(columns[in_range])] = \
+        values[value_column].values[in_range]
+    return pd.DataFrame(table, index=hospital_names, columns=days[reported])
+
+
+def _csv_cells(values):
+    """Returns a dict mapping each distinct value to its csv cell, quoted
+    the way csv.writer quotes it."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    cells = {}
+    for value in set(values):
+        buffer.seek(0)
+        buffer.truncate()
+        # After an empty first cell, as a lone empty cell is written '""'.
+        writer.writerow(['', value])
+        cells[value] = buffer.getvalue()[1:-1]
+    return cells
+
+
+def write_table(table, days, output_file):
+    """Writes a hospital x day table as csv, with a column for every day.
+
+    The header holds every day as a canonical date cell (see
+    date_utils.header_cells). The rows are the ones DataFrame.to_csv writes
+    for the table reindexed to every day with NA fill. The runs of days without a column are written
+    as one precomputed string of NA cells per run, so only the cells of the
+    days with a snapshot are formatted, row by row.
+
+    Args:
+        table: pandas.DataFrame, as returned by pivot_daily_data
+        days: list of str, the formatted days of the output
+        output_file: file, opened for writing text
+
+    Returns:
+        None
+
+    """
+    output_file.write(','.join([''] + date_utils.header_cells(days)) + '\n')
+    positions = list(pd.Index(days).get_indexer(table.columns))
+    # The NA cells before the first column, then after each column.
+    bounds = positions + [len(days)]
+    leading = ',NA' * bounds[0]
+    gaps = [',NA' * (bounds[i + 1] - bounds[i] - 1)
+            for i in range(len(positions))]
+    cells = _csv_cells(table.index)
+    cells.update(_csv_cells(table.values.ravel()))
+    for hospital_name, row in zip(table.index, table.values.tolist()):
+        parts = [cells[hospital_name], leading]
+        for value, gap in zip(row, gaps):
+            parts.extend((',', cells[value], gap))
+        parts.append('\n')
+        output_file.write(''.join(parts))
+
+
+def format_output_data(daily_data, output_directory):
     """Formats definitive healthcare data and output to a csv file.
 
+    The output files are replaced together, as one atomic_io batch, so an
+    interrupted run leaves all of them as they were.
+
     Args:
-        beds_utilization_summary: dict. The key is the day and the value 
-                         is a dictionary, say D, for the corresponding day.
-                         The key of D is the hospital name, the value of D
-                         is the bed utilization for that hospital. If there 
-                         is a missing value, the value of D will be 'NA'.
-        ventilator_usage_summary: dict. The key is the day and the value 
-                         is a dictionary, say D, for the corresponding day.
-                         The key of D is the hospital name, the value of D
-                         is the ventilator usage for that hospital. If there 
-                         is a missing value, the value of D will be 'NA'.
-        hospital_names: dict, the key is the name of the hospital.
+        daily_data: pandas.DataFrame, as returned by readDataFromDirectory
         output_directory: str, the path to the output directory. 
                           e.g. processed_data/
 
@@ -130,61 +235,40 @@ def format_output_data(
     """
 
     days = utils.getDays(2020, 4, 7)
-    formatted_beds_data = {'': days}
-    formatted_ventilators_data = {'': days}
-
-    for hospital_name in hospital_names:
-        beds_data = []
-        ventilators_data = []
-        for day in days:
-            if day not in beds_utilization_summary or hospital_name \
-                not in beds_utilization_summary[day] \
-                or beds_utilization_summary[day][hospital_name] \
-                == np.NaN \
-                or len(beds_utilization_summary[day][hospital_name]) \
-                == 0:
-                beds_data.append('NA')
-            else:
-                beds_data.append(beds_utilization_summary[day][hospital_name])
-
-            if day not in ventilator_usage_summary or hospital_name \
-                not in ventilator_usage_summary[day] \
-                or ventilator_usage_summary[day][hospital_name] \
-                == np.NaN \
-                or len(ventilator_usage_summary[day][hospital_name]) \
-                == 0:
-                ventilators_data.append('NA')
-            else:
-                ventilators_data.append(ventilator_usage_summary[day][hospital_name])
-
-        formatted_beds_data[hospital_name] = beds_data
-        formatted_ventilators_data[hospital_name] = ventilators_data
-
-    pd.DataFrame(formatted_beds_data).T.to_csv(output_directory
-            + 'beds/US/us-hospital_beds.csv', header=False, index=True)
-    logger.info('Sucess: write processed data to ' + output_directory
-                + 'beds/US/us-hospital_beds.csv')
-    pd.DataFrame(formatted_ventilators_data).T.to_csv(output_directory
-            + 'ventilators/US/us-hospital_ventilators.csv',
-            header=False, index=True)
-    logger.info('Sucess: write processed data to ' + output_directory
-                + 'ventilators/US/us-hospital_ventilators.csv')
+    output_filenames = [output_directory + output_path
+                        for (_, output_path) in OUTPUT_FILES]
+    with file_lock.locked(*output_filenames):
+        with atomic_io.batch() as output_files:
+            for (value_column, _), output_filename in zip(OUTPUT_FILES,
+                                                          output_filenames):
+                with metrics.stage('merge', source=CACHE_NAME,
+                                   column=value_column):
+                    table = pivot_daily_data(daily_data, value_column, days)
+                with metrics.stage('write', source=CACHE_NAME,
+                                   column=value_column):
+                    with output_files.open(output_filename) as output_file:
+                        write_table(table, days, output_file)
+                metrics.count('rows', len(table), stage='write',
+                              source=CACHE_NAME, column=value_column)
+
+    for output_filename in output_filenames:
+        logger.info('Sucess: write processed data to ' + output_filename)
 
 
 def main():
     # Get input directory and output directory from command line arguments
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         print('Incorrect number of arguments. ' \
-            'Usage: python dhProcess.py ${input_directory} ${output_directory}')
+            'Usage: python dhProcess.py ${input_directory} ${output_directory} ' \
+            '[${workers}]')
     input_directory = sys.argv[1]
     output_directory = sys.argv[2]
+    workers = utils.fetchWorkerCount(sys.argv[3] if len(sys.argv) > 3
+                                     else None)
 
     # Process/format definitive healthcare from the given URL
-    (beds_utilization_summary, ventilator_usage_summary,
-     hospital_names) = readDataFromDirectory(input_directory)
-    format_output_data(beds_utilization_summary,
-                       ventilator_usage_summary, hospital_names,
-                       output_directory)
+    daily_data = readDataFromDirectory(input_directory, workers)
+    format_output_data(daily_data, output_directory)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,382 @@
+"""
+Series derived from the cumulative case and death counts.
+
+For every csv under processed_data/cases and processed_data/deaths this
+writes three new {sample}_{feature} files, each under its own feature
+directory as the README asks (shown for cases; deaths are alike):
+
+    new-cases/<region>/...              daily new cases
+    new-cases-7day-avg/<region>/...     mean daily new cases over the last
+                                        WINDOW_DAYS days
+    cases-doubling-time/<region>/...    days the cumulative count takes to
+                                        double, at the growth rate of the
+                                        last WINDOW_DAYS days
+
+e.g. processed_data/cases/US/nyc-zc_cases.csv gives
+processed_data/new-cases/US/nyc-zc_new-cases.csv. The derived files have a
+column for every day from the first day of the input to its last.
+
+Each input is read once through its binary mirror (see processed_matrix.py)
+and the derived series are computed with NumPy over the whole location x day
+matrix. NA cells and missing days are gaps: a derived value is NA on a day
+the cumulative count is not reported, and otherwise measured from the last
+reported count on or before the day it looks back to. So new cases after a
+gap hold every case reported since the last report, and the 7-day mean and
+the doubling time span the gap. A doubling time is NA unless the count grew
+over the window.
+
+What was derived is remembered in .cache/derived: the locations and a
+fingerprint of each day of the input. When the input only gained days, or
+changed from some day on, only the days from there on are recomputed, with
+the WINDOW_DAYS days before them as context, and spliced into the derived
+files. Other changes (new locations, an earlier first day) recompute
+everything.
+
+    $ python scripts/derived_features.py [${csv_path} ...]
+
+Meant to be run with Python 3.
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import atomic_io
+import date_utils
+import file_lock
+import metrics
+import processed_matrix
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSED_DATA_DIR = processed_matrix.PROCESSED_DATA_DIR
+DEFAULT_STATE_DIR = os.path.join(REPO_ROOT, '.cache', 'derived')
+INPUT_FEATURES = ('cases', 'deaths')
+WINDOW_DAYS = 7
+MISSING_VALUE = 'NA'
+
+# Derived feature name (given the input feature) and decimals written.
+FEATURES = (
+    ('new', 'new-%s', 0),
+    ('average', 'new-%s-7day-avg', 2),
+    ('doubling_time', '%s-doubling-time', 2),
+)
+DESCRIPTIONS = {
+    'new': 'the daily increase of the cumulative count',
+    'average': 'the mean daily increase over the last %d days' % WINDOW_DAYS,
+    'doubling_time': 'the days the cumulative count takes to double at its '
+                     'growth rate over the last %d days' % WINDOW_DAYS,
+}
+
+_FINGERPRINT_WEIGHTS = {}
+
+
+def _fingerprint_weights(n_rows):
+    """Returns one fixed odd 64-bit weight per row."""
+    weights = _FINGERPRINT_WEIGHTS.get(n_rows)
+    if weights is None:
+        weights = np.random.RandomState(n_rows % (2 ** 32)).randint(
+            0, 2 ** 62, size=n_rows, dtype=np.int64).astype(np.uint64)
+        weights = weights * np.uint64(2) + np.uint64(1)
+        _FINGERPRINT_WEIGHTS[n_rows] = weights
+    return weights
+
+
+def fingerprints(values):
+    """Returns a 64-bit fingerprint of every column of a matrix, as a list
+    of str. Columns with the same values, NaN included, match."""
+    values = np.where(np.isnan(values), np.nan, values)
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+    weights = _fingerprint_weights(values.shape[0])
+    with np.errstate(over='ignore'):
+        return [str(int(fingerprint)) for fingerprint in
+                (bits * weights[:, None]).sum(axis=0, dtype=np.uint64)]
+
+
+def to_calendar(matrix):
+    """Spreads the columns of a Matrix over every day from its first date
+    to its last.
+
+    Returns:
+        first, values
+        the ordinal of the first day, and a float64 array with one column
+        per day, NaN on the days the matrix does not hold.
+    """
+    ordinals = date_utils.to_ordinals(matrix.dates)
+    if not len(ordinals):
+        return None, np.zeros((len(matrix.rows), 0))
+    first = int(ordinals.min())
+    values = np.full((len(matrix.rows), int(ordinals.max()) - first + 1),
+                     np.nan)
+    values[:, ordinals - first] = matrix.values
+    return first, values
+
+
+def last_reported(values):
+    """Returns the last non-NaN value of every row, NaN for empty rows."""
+    reported = ~np.isnan(values)
+    if not values.shape[1]:
+        return np.full(values.shape[0], np.nan)
+    last = values.shape[1] - 1 - np.argmax(reported[:, ::-1], axis=1)
+    return np.where(reported.any(axis=1),
+                    values[np.arange(values.shape[0]), last], np.nan)
+
+
+def forward_fill(values, seed=None):
+    """Replaces every NaN of a matrix with the last non-NaN value before it
+    in its row, or with seed, the value of the row before the matrix."""
+    n_rows, n_days = values.shape
+    padded = np.empty((n_rows, n_days + 1))
+    padded[:, 0] = np.nan if seed is None else seed
+    padded[:, 1:] = values
+    index = np.where(~np.isnan(padded), np.arange(n_days + 1), 0)
+    np.maximum.accumulate(index, axis=1, out=index)
+    return padded[np.arange(n_rows)[:, None], index][:, 1:]
+
+
+def _lag(values, days):
+    lagged = np.full(values.shape, np.nan)
+    if days < values.shape[1]:
+        lagged[:, days:] = values[:, :-days]
+    return lagged
+
+
+def derive(cumulative, seed=None):
+    """Computes the derived series of a cumulative location x day matrix.
+
+    Args:
+        cumulative: float64 array, one column per day, NaN where the count
+            is not reported.
+        seed: The last count reported for each row before the first day,
+            or None.
+
+    Returns:
+        dict mapping 'new', 'average' and 'doubling_time' to arrays shaped
+        like cumulative. Values looking back before the first day are NaN.
+    """
+    reported = ~np.isnan(cumulative)
+    filled = forward_fill(cumulative, seed)
+    previous = _lag(filled, 1)
+    window_start = _lag(filled, WINDOW_DAYS)
+    if seed is not None:
+        previous[:, 0] = seed
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = filled / window_start
+        doubling_time = WINDOW_DAYS * np.log(2) / np.log(growth)
+    return {
+        'new': np.where(reported, filled - previous, np.nan),
+        'average': np.where(reported,
+                            (filled - window_start) / WINDOW_DAYS, np.nan),
+        'doubling_time': np.where(reported & (window_start > 0) &
+                                  (growth > 1), doubling_time, np.nan),
+    }
+
+
+def input_feature(csv_path):
+    """Returns the feature of a processed csv, 'cases' or 'deaths', from
+    the directory it is in, or None."""
+    parts = os.path.relpath(os.path.abspath(csv_path),
+                            PROCESSED_DATA_DIR).split(os.sep)
+    if len(parts) > 1 and parts[0] in INPUT_FEATURES:
+        return parts[0]
+    return None
+
+
+def output_paths(csv_path):
+    """Returns the paths of the files derived from a processed csv, keyed
+    like the result of derive().
+
+    The feature in the file name is replaced by the derived feature, e.g.
+    China_death_by_city.csv gives China_new-deaths_by_city.csv.
+    """
+    feature = input_feature(csv_path)
+    parts = os.path.relpath(os.path.abspath(csv_path),
+                            PROCESSED_DATA_DIR).split(os.sep)
+    tokens = os.path.splitext(parts[-1])[0].split('_')
+    matches = [i for i, token in enumerate(tokens)
+               if token in (feature, feature.rstrip('s'))]
+    paths = {}
+    for key, name, _ in FEATURES:
+        derived = name % feature
+        if matches:
+            name_tokens = list(tokens)
+            name_tokens[matches[-1]] = derived
+        else:
+            name_tokens = tokens + [derived]
+        paths[key] = os.path.join(PROCESSED_DATA_DIR, derived, *(
+            parts[1:-1] + ['_'.join(name_tokens) + '.csv']))
+    return paths
+
+
+def state_path(csv_path, state_dir=None):
+    """Returns the file remembering what was derived from csv_path."""
+    path = os.path.abspath(csv_path)
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(state_dir or DEFAULT_STATE_DIR,
+                        '%s-%s.json' % (os.path.basename(path), key))
+
+
+def _read_state(path):
+    try:
+        with open(path, 'r') as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _quote(cell):
+    return '"%s"' % cell.replace('"', '""')
+
+
+def format_values(values, decimals):
+    """Formats a matrix as csv cells, NA where it is NaN."""
+    if not values.size:
+        return values.astype(str)
+    # Adding 0.0 turns the -0.0 of small negative values into 0.0.
+    rounded = np.round(np.nan_to_num(values), decimals) + 0.0
+    cells = np.char.mod('%%.%df' % decimals, rounded)
+    return np.where(np.isnan(values), MISSING_VALUE, cells)
+
+
+def write_table(output_file, rows, first, values, decimals):
+    """Writes a derived matrix as a wide csv, quoted like the README asks."""
+    dates = date_utils.format_days(np.arange(first, first + values.shape[1]),
+                                   date_utils.QUOTED)
+    output_file.write(','.join(['""'] + dates) + '\n')
+    cells = format_values(values, decimals)
+    for row, row_cells in zip(rows, cells):
+        output_file.write(','.join([_quote(row)] + row_cells.tolist())
+                          + '\n')
+
+
+def _describe(csv_path, path, description):
+    """Writes the .txt of a derived file unless it has one."""
+    txt_path = os.path.splitext(path)[0] + '.txt'
+    if os.path.exists(txt_path):
+        return
+    with atomic_io.atomic_write(txt_path) as txt_file:
+        txt_file.write('This data is derived from %s, computed by '
+                       'derived_features.py: %s. NA where the cumulative '
+                       'count is not reported.\n'
+                       % (os.path.relpath(csv_path, REPO_ROOT), description))
+
+
+def _previous_outputs(paths, rows, first, n_days):
+    """Loads the derived files written last time, or returns None if any
+    of them does not hold rows over n_days days from first."""
+    previous = {}
+    for key, path in paths.items():
+        if not os.path.exists(path):
+            return None
+        matrix = processed_matrix.load(path, mmap=False)
+        if matrix.rows != rows or len(matrix.dates) != n_days or (
+                n_days and date_utils.to_ordinal(matrix.dates[0]) != first):
+            return None
+        previous[key] = matrix.values
+    return previous
+
+
+def update(csv_path, state_dir=None, force=False):
+    """Brings the files derived from a processed csv up to date.
+
+    Args:
+        csv_path: A csv under processed_data/cases or processed_data/deaths.
+        state_dir: Where what was derived is remembered, DEFAULT_STATE_DIR
+            if None.
+        force: Recompute every day.
+
+    Returns:
+        The number of days recomputed, 0 if the files were up to date.
+    """
+    csv_name = os.path.basename(csv_path)
+    paths = output_paths(csv_path)
+    with metrics.stage('read', csv=csv_name):
+        matrix = processed_matrix.load(csv_path)
+        first, cumulative = to_calendar(matrix)
+        columns = fingerprints(cumulative)
+
+    path = state_path(csv_path, state_dir)
+    state = None if force else _read_state(path)
+    start = 0
+    previous = None
+    if state is not None and state['rows'] == matrix.rows and \
+            state['first'] == first:
+        start = len(columns)
+        for i, (old, new) in enumerate(zip(state['columns'], columns)):
+            if old != new:
+                start = i
+                break
+        start = min(start, len(state['columns']))
+        if start == len(columns) == len(state['columns']):
+            return 0
+        previous = _previous_outputs(paths, matrix.rows, first,
+                                     len(state['columns']))
+        if previous is None:
+            start = 0
+
+    # Recompute from start, with the days before it as context.
+    context = max(start - WINDOW_DAYS, 0)
+    with metrics.stage('derive', csv=csv_name):
+        seed = last_reported(cumulative[:, :context]) if context else None
+        window = derive(cumulative[:, context:], seed)
+        derived = {}
+        for key, values in window.items():
+            values = values[:, start - context:]
+            if start:
+                values = np.hstack([previous[key][:, :start], values])
+            derived[key] = values
+
+    with metrics.stage('write', csv=csv_name), \
+            file_lock.locked(*paths.values()):
+        with atomic_io.batch() as files:
+            for key, name, decimals in FEATURES:
+                os.makedirs(os.path.dirname(paths[key]), exist_ok=True)
+                with files.open(paths[key], newline='') as output_file:
+                    write_table(output_file, matrix.rows, first,
+                                derived[key], decimals)
+        for key, name, _ in FEATURES:
+            _describe(csv_path, paths[key], DESCRIPTIONS[key])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_io.atomic_write(path) as state_file:
+            json.dump({'input': os.path.abspath(csv_path),
+                       'rows': matrix.rows, 'first': first,
+                       'columns': columns}, state_file)
+    metrics.count('rows', len(matrix.rows), stage='derive', csv=csv_name)
+    return len(columns) - start
+
+
+def find_inputs():
+    """Returns the paths of every csv derived features are computed from."""
+    return [path for path in
+            processed_matrix.find_processed_csvs(PROCESSED_DATA_DIR)
+            if input_feature(path) is not None]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Derive new counts, 7-day means and doubling times from "
+                    "the cumulative case and death counts.")
+    parser.add_argument("csv_paths", nargs="*",
+                        help="default: every csv under processed_data/cases "
+                        "and processed_data/deaths")
+    parser.add_argument("--full", action="store_true",
+                        help="recompute every day")
+    args = parser.parse_args(argv)
+
+    for path in args.csv_paths or find_inputs():
+        if input_feature(path) is None:
+            print('%s - not under processed_data/cases or '
+                  'processed_data/deaths, skipping it' % path)
+            continue
+        try:
+            days = update(path, force=args.full)
+        except ValueError as error:
+            print('%s - %s' % (path, error))
+            continue
+        print('%s - %s' % (path, 'days derived: %d' % days if days
+                           else 'up to date'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Shared HTTP helpers for the scrapers.
+
+Sessions are pooled per host, so repeated calls to the same ArcGIS server
+reuse a keep-alive connection instead of opening a new one for every request.
+run_concurrently() fans a list of jobs out over a bounded thread pool; the
+work done by the scrapers is almost entirely network wait, so threads are
+enough to overlap the round trips.
+
+Every request of the scripts goes through get() or head(), so all of them
+can be pointed at another server at once: with a base url set, either with
+set_base_url() or in the COVID_DATA_BASE_URL environment variable,
+https://host/path?query is fetched from ${base_url}/host/path?query instead.
+The stub server of benchmark/stub_server.py records the live sources that
+way and replays them offline:
+
+    $ COVID_DATA_BASE_URL=http://127.0.0.1:8000 python scrapers.py
+
+Meant to be run with Python 3.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Default number of jobs allowed in flight at once.
+DEFAULT_MAX_WORKERS = 8
+# Seconds to wait for a server before giving up on a request.
+DEFAULT_TIMEOUT = 60
+# Keep-alive connections kept open per host.
+POOL_MAXSIZE = 16
+# Environment variable holding the base url requests are redirected to.
+BASE_URL_ENV = 'COVID_DATA_BASE_URL'
+
+_base_url = os.environ.get(BASE_URL_ENV) or None
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def set_base_url(base_url):
+    """Redirects every request to base_url, or stops redirecting them if
+    base_url is None."""
+    global _base_url
+    _base_url = base_url.rstrip('/') if base_url else None
+
+
+def resolve(url):
+    """Returns the url a request for url is sent to: url itself, or its
+    host, path and query appended to the base url if one is set."""
+    if _base_url is None or url.startswith(_base_url + '/'):
+        return url
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        return url
+    return '%s/%s%s%s' % (_base_url, parts.netloc, parts.path,
+                          '?' + parts.query if parts.query else '')
+
+
+def get_session(url):
+    """Returns the pooled session for the host of the given url.
+
+    Args:
+        url: Any url on the host we want to talk to.
+
+    Returns:
+        A requests.Session shared by every caller fetching from that host.
+    """
+    host = urlparse(url).netloc.lower()
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+    return session
+
+
+def get(url, **kwargs):
+    """Issues a GET through the pooled session for the url's host.
+
+    Accepts the same keyword arguments as requests.get. A default timeout is
+    applied so a hung server cannot stall a whole batch.
+    """
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    metrics.count('http_requests', host=urlparse(url).netloc.lower())
+    url = resolve(url)
+    return get_session(url).get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    """Issues a HEAD through the pooled session for the url's host, as get()
+    does a GET."""
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    metrics.count('http_requests', host=urlparse(url).netloc.lower())
+    url = resolve(url)
+    return get_session(url).head(url, **kwargs)
+
+
+def close_sessions():
+    """Closes every pooled session and forgets it."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def run_concurrently(func, jobs, max_workers=DEFAULT_MAX_WORKERS):
+    """Calls func on every job using at most max_workers threads.
+
+    Failures in one job do not stop the others. sys.exit() calls made inside
+    func are caught as well, since the scrapers use them to report errors.
+
+    Args:
+        func: Callable taking a single job.
+        jobs: Iterable of jobs to pass to func.
+        max_workers: Maximum number of jobs running at once. A value of 1
+            runs the jobs one after another in the calling thread.
+
+    Returns:
+        A list of (job, result, error) tuples in the same order as jobs.
+        error is None when the job succeeded, otherwise result is None and
+        error is the raised exception.
+    """
+    jobs = list(jobs)
+    if max_workers is None or max_workers < 1:
+        max_workers = DEFAULT_MAX_WORKERS
+
+    if max_workers == 1:
+        outcomes = []
+        for job in jobs:
+            try:
+                outcomes.append((job, func(job), None))
+            except (Exception, SystemExit) as error:
+                outcomes.append((job, None, error))
+        return outcomes
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs) or 1)) \
+            as executor:
+        futures = [executor.submit(func, job) for job in jobs]
+    outcomes = []
+    for job, future in zip(jobs, futures):
+        error = future.exception()
+        if error is None:
+            outcomes.append((job, future.result(), None))
+        else:
+            outcomes.append((job, None, error))
+    return outcomes
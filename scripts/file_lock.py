@@ -0,0 +1,129 @@
+"""
+Advisory locks on the output files, so the writers can run in parallel.
+
+Every script that reads, modifies and writes a file under processed_data/
+holds the lock of that file while it does:
+
+    with file_lock.locked(csv_path):
+        ...read csv_path, update it and write it back...
+
+The lock of a path is an fcntl.flock on a lock file in .cache/locks/, named
+after the absolute path, so nothing is added next to the data and the lock
+is dropped by the OS when its process dies. flock also excludes the threads
+of one process from each other, since each acquire opens its own descriptor;
+a thread that already holds a lock may take it again. Several paths are
+locked in sorted order, so two writers of overlapping sets of files can not
+deadlock.
+
+A writer that can not get a lock within the timeout (DEFAULT_TIMEOUT
+seconds unless given) raises LockTimeout. On platforms without fcntl the
+locks do nothing.
+
+Meant to be run with Python 3.
+"""
+import contextlib
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import metrics
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_LOCK_DIR = os.path.join(REPO_ROOT, '.cache', 'locks')
+DEFAULT_TIMEOUT = 600
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+_held = threading.local()  # held.counts maps lock file paths to depths
+
+
+class LockTimeout(Exception):
+    """Raised when a lock is not acquired within the timeout."""
+
+
+def lock_path(path, lock_dir=None):
+    """Returns the lock file guarding path."""
+    path = os.path.abspath(path)
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(lock_dir or DEFAULT_LOCK_DIR,
+                        '%s-%s.lock' % (os.path.basename(path), key))
+
+
+def _held_counts():
+    if not hasattr(_held, 'counts'):
+        _held.counts = {}
+    return _held.counts
+
+
+def _acquire(lock_file_path, timeout):
+    """Opens and flocks the lock file. Returns its descriptor."""
+    fd = os.open(lock_file_path, os.O_RDWR | os.O_CREAT, 0o666)
+    deadline = time.time() + timeout
+    interval = POLL_INTERVAL
+    waited = False
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except (IOError, OSError):
+            if time.time() >= deadline:
+                os.close(fd)
+                metrics.count('lock_timeouts')
+                raise LockTimeout('Timed out after %.1fs waiting for %s'
+                                  % (timeout, lock_file_path))
+            waited = True
+            time.sleep(min(interval, max(deadline - time.time(), 0)))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+    if waited:
+        metrics.count('lock_waits')
+    return fd
+
+
+def _release(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+@contextlib.contextmanager
+def locked(*paths, timeout=None, lock_dir=None):
+    """Holds the locks of paths for the duration of the block.
+
+    Args:
+        paths: The files to lock.
+        timeout: Seconds to wait for all the locks, DEFAULT_TIMEOUT if None.
+        lock_dir: The directory of the lock files, DEFAULT_LOCK_DIR if None.
+
+    Raises:
+        LockTimeout: If a lock is held by another writer for too long.
+    """
+    timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+    lock_dir = lock_dir or DEFAULT_LOCK_DIR
+    if fcntl is None or not paths:
+        yield
+        return
+    os.makedirs(lock_dir, exist_ok=True)
+
+    counts = _held_counts()
+    deadline = time.time() + timeout
+    acquired = []  # (lock file path, fd or None if already held)
+    try:
+        for lock_file_path in sorted(set(lock_path(path, lock_dir)
+                                         for path in paths)):
+            fd = None
+            if not counts.get(lock_file_path):
+                fd = _acquire(lock_file_path,
+                              max(deadline - time.time(), 0))
+            counts[lock_file_path] = counts.get(lock_file_path, 0) + 1
+            acquired.append((lock_file_path, fd))
+        yield
+    finally:
+        for lock_file_path, fd in reversed(acquired):
+            counts[lock_file_path] -= 1
+            if fd is not None:
+                _release(fd)
@@ -0,0 +1,214 @@
+"""
+On-disk HTTP cache shared by the fetchers.
+
+Every cached url keeps its last body on disk together with the ETag and
+Last-Modified validators the server sent. The next fetch sends them back as
+If-None-Match/If-Modified-Since, and on a 304 the body is served from disk,
+so polling an unchanged source only costs the headers. The result says
+whether the payload changed since the previous fetch, so callers can skip
+reprocessing unchanged sources.
+
+A caller that only writes its outputs after the fetch passes commit=False
+and calls response.commit() once they are written. Until then the new
+validators are not kept, so if the caller dies first the next run gets the
+payload again (changed) instead of a 304 for a version it never processed.
+
+The cache lives in .cache/http at the root of the repository and is trimmed
+after every download, dropping entries unused for more than MAX_AGE_DAYS and
+then the least recently used entries until it fits in MAX_CACHE_BYTES. The
+entry just downloaded is never dropped, even when it alone is larger than
+that, as the caller reads it from disk next.
+
+Meant to be run with Python 3.
+"""
+import hashlib
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+import atomic_io
+import fetch_utils
+import metrics
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CACHE_DIR = os.path.join(REPO_ROOT, '.cache', 'http')
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+MAX_AGE_DAYS = 30
+CHUNK_SIZE = 1024 * 1024
+
+BODY_SUFFIX = '.body'
+META_SUFFIX = '.json'
+
+
+class CachedResponse(object):
+    """The body of a fetched url and whether it changed since last time.
+
+    Attributes:
+        url: The url that was fetched.
+        path: The path of the cached body on disk. Large bodies can be read
+            from here in chunks instead of through content.
+        changed: False if the server answered 304 Not Modified.
+    """
+
+    def __init__(self, url, path, changed, entry=None, meta=None):
+        self.url = url
+        self.path = path
+        self.changed = changed
+        self._entry = entry
+        self._meta = meta  # Validators to keep once committed
+
+    def commit(self):
+        """Keeps the validators of the body, so the next fetch of the url
+        is conditional. Only needed after get(url, commit=False)."""
+        if self._meta is not None:
+            _write_meta(self._entry, self._meta)
+            self._meta = None
+
+    @property
+    def content(self):
+        """The body as bytes."""
+        with open(self.path, 'rb') as body_file:
+            return body_file.read()
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+def _entry_path(cache_dir, url):
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key)
+
+
+def _read_meta(entry):
+    try:
+        with open(entry + META_SUFFIX, 'r') as meta_file:
+            meta = json.load(meta_file)
+    except (IOError, ValueError):
+        return None
+    if not os.path.exists(entry + BODY_SUFFIX):
+        return None
+    return meta
+
+
+def _write_meta(entry, meta):
+    with atomic_io.atomic_write(entry + META_SUFFIX) as meta_file:
+        json.dump(meta, meta_file)
+
+
+def get(url, cache_dir=None, commit=True, **kwargs):
+    """Fetches url, revalidating the cached copy if there is one.
+
+    Args:
+        url: The url to fetch.
+        cache_dir: The directory holding the cache, DEFAULT_CACHE_DIR if
+            None.
+        commit: Whether to keep the validators of a changed body right
+            away. If False, call commit() on the result once the body has
+            been processed.
+        kwargs: Passed on to fetch_utils.get.
+
+    Returns:
+        A CachedResponse.
+
+    Raises:
+        requests.HTTPError: If the server answers with an error status.
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Keyed on where the body comes from, so bodies replayed by a stub
+    # server (see fetch_utils.resolve) never stand in for the live ones.
+    entry = _entry_path(cache_dir, fetch_utils.resolve(url))
+    meta = _read_meta(entry)
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    response = fetch_utils.get(url, headers=headers, stream=True, **kwargs)
+    now = time.time()
+
+    host = urlparse(url).netloc.lower()
+    if response.status_code == 304 and meta is not None:
+        response.close()
+        metrics.count('http_not_modified', host=host)
+        meta['last_used'] = now
+        _write_meta(entry, meta)
+        return CachedResponse(url, entry + BODY_SUFFIX, False)
+
+    response.raise_for_status()
+    # Stream the body to disk so large files are never held in memory.
+    with atomic_io.atomic_write(entry + BODY_SUFFIX, 'wb') as body_file:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            body_file.write(chunk)
+    size = os.path.getsize(entry + BODY_SUFFIX)
+    metrics.count('http_bytes', size, host=host)
+    meta = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'size': size,
+        'fetched': now,
+        'last_used': now,
+    }
+    if commit:
+        _write_meta(entry, meta)
+    else:
+        # No validators until committed: the next fetch is unconditional.
+        _write_meta(entry, dict(meta, etag=None, last_modified=None))
+    evict(cache_dir, keep=entry)
+    return CachedResponse(url, entry + BODY_SUFFIX, True, entry,
+                          None if commit else meta)
+
+
+def evict(cache_dir=None, max_bytes=MAX_CACHE_BYTES,
+          max_age_days=MAX_AGE_DAYS, keep=None):
+    """Removes stale entries, then the least recently used ones until the
+    cache fits in max_bytes.
+
+    Args:
+        cache_dir: The directory holding the cache, DEFAULT_CACHE_DIR if
+            None.
+        max_bytes: Maximum total size of the cached bodies.
+        max_age_days: Entries unused for longer than this are removed.
+        keep: An entry that is never removed, e.g. the one just fetched.
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return
+    oldest_allowed = time.time() - max_age_days * 24 * 60 * 60
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if not filename.endswith(META_SUFFIX):
+            continue
+        entry = os.path.join(cache_dir, filename[:-len(META_SUFFIX)])
+        if entry == keep:
+            continue
+        meta = _read_meta(entry)
+        if meta is None:
+            _remove_entry(entry)
+        elif meta.get('last_used', 0) < oldest_allowed:
+            _remove_entry(entry)
+        else:
+            entries.append((meta.get('last_used', 0), meta.get('size', 0),
+                            entry))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        _remove_entry(entry)
+        total -= size
+
+
+def _remove_entry(entry):
+    for suffix in (BODY_SUFFIX, META_SUFFIX):
+        try:
+            os.remove(entry + suffix)
+        except OSError:
+            pass
@@ -0,0 +1,174 @@
+"""
+Stage timers and counters shared by the scripts.
+
+Wrap each stage of a script in metrics.stage() and count what it handled
+with metrics.count():
+
+    with metrics.stage('fetch', source='arcgis'):
+        response = fetch_utils.get(url)
+    metrics.count('bytes', len(response.content), stage='fetch')
+
+Every finished stage is logged as one JSON object, e.g.
+
+    {"event": "stage", "stage": "fetch", "source": "arcgis",
+     "status": "ok", "seconds": 0.412, "script": "scrapers.py", ...}
+
+through the 'metrics' logger, at INFO level, so it shows up in the log files
+of the processors (log/dhProcess.log, log/boroProcess.log). The same lines
+are appended to the file named by the METRICS_LOG environment variable, if
+set. The totals (runs, errors and seconds of every stage, and every counter)
+are written in the Prometheus text format to the file named by
+METRICS_TEXTFILE, if set, when the script exits; point the node exporter's
+textfile collector at it to scrape them. configure() sets both from code.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import atomic_io
+
+PREFIX = 'covid_'
+
+logger = logging.getLogger('metrics')
+
+_lock = threading.Lock()
+_stages = {}  # Keys are (stage, labels), values are [runs, errors, seconds]
+_counters = {}  # Keys are (name, labels), values are totals
+_settings = {
+    'json_log': os.environ.get('METRICS_LOG'),
+    'textfile': os.environ.get('METRICS_TEXTFILE'),
+}
+
+
+def configure(json_log=None, textfile=None):
+    """Sets the JSON log and Prometheus textfile paths, overriding the
+    METRICS_LOG and METRICS_TEXTFILE environment variables."""
+    if json_log is not None:
+        _settings['json_log'] = json_log
+    if textfile is not None:
+        _settings['textfile'] = textfile
+
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()
+                        if value is not None))
+
+
+def _script_name():
+    return os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] \
+        else 'python'
+
+
+def log_event(event, **fields):
+    """Logs one structured event as a JSON object."""
+    record = {'event': event, 'time': round(time.time(), 3),
+              'script': _script_name()}
+    record.update(fields)
+    line = json.dumps(record, sort_keys=True)
+    logger.info(line)
+    if _settings['json_log']:
+        with _lock:
+            with open(_settings['json_log'], 'a') as json_log:
+                json_log.write(line + '\n')
+
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    """Times a stage of a script.
+
+    The stage is counted as an error if it raises (SystemExit included); the
+    exception is passed on.
+
+    Args:
+        name: str, the stage, e.g. 'fetch', 'parse', 'merge' or 'write'.
+        labels: Extra labels, e.g. source='nyc-zc'. None values are left out.
+    """
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        key = (name, _labels_key(labels))
+        with _lock:
+            totals = _stages.setdefault(key, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += status == 'error'
+            totals[2] += seconds
+        fields = dict(key[1])
+        fields.update(stage=name, status=status, seconds=round(seconds, 6))
+        log_event('stage', **fields)
+
+
+def count(name, value=1, **labels):
+    """Adds value to the counter called name, e.g. count('rows', 250,
+    stage='parse')."""
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def snapshot():
+    """Returns a copy of the stage totals and counters."""
+    with _lock:
+        return (dict((key, list(totals)) for key, totals in _stages.items()),
+                dict(_counters))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+        for key, value in labels)
+
+
+def format_prometheus():
+    """Returns the totals in the Prometheus text exposition format."""
+    stages, counters = snapshot()
+    script = (('script', _script_name()),)
+    lines = []
+    for metric, index, help_text in (
+            ('stage_runs_total', 0, 'Number of times a stage ran.'),
+            ('stage_errors_total', 1, 'Number of times a stage failed.'),
+            ('stage_seconds_total', 2, 'Time spent in a stage.')):
+        lines.append('# HELP %s%s %s' % (PREFIX, metric, help_text))
+        lines.append('# TYPE %s%s counter' % (PREFIX, metric))
+        for (name, labels), totals in sorted(stages.items()):
+            lines.append('%s%s%s %s' % (
+                PREFIX, metric,
+                _format_labels(script + (('stage', name),) + labels),
+                repr(float(totals[index])) if index == 2
+                else totals[index]))
+    for name in sorted(set(name for name, _ in counters)):
+        lines.append('# TYPE %s%s_total counter' % (PREFIX, name))
+        for (counter, labels), value in sorted(counters.items()):
+            if counter == name:
+                lines.append('%s%s_total%s %s' % (
+                    PREFIX, name, _format_labels(script + labels), value))
+    lines.append('# TYPE %slast_run_timestamp_seconds gauge' % PREFIX)
+    lines.append('%slast_run_timestamp_seconds%s %d' % (
+        PREFIX, _format_labels(script), time.time()))
+    return '\n'.join(lines) + '\n'
+
+
+def flush():
+    """Writes the Prometheus textfile, if one is configured. The file is
+    replaced atomically, as the textfile collector expects."""
+    path = _settings['textfile']
+    if not path:
+        return
+    with atomic_io.atomic_write(path) as textfile:
+        textfile.write(format_prometheus())
+
+
+atexit.register(flush)
@@ -1,5 +1,7 @@
 # Functions to help standardize data formatting
 
+import date_utils
+
 # ==============================================
 # date_string_to_quoted
 # ==============================================
@@ -11,18 +13,9 @@
 #   returns:
 #       string of form '"M/D/Y"'
 #       where M, D, Y are each 2 chars long
+#
+#   see date_utils.py, which memoizes the conversion
 
 def date_string_to_quoted(date_string):
-  month, date, year = date_string.split('/')
-  
-  if len(month) == 1:
-    month = '0' + month
-  
-  if len(date) == 1:
-    date = '0' + date
-  
-  if len(year) == 4:
-    year = year[-2:]
-  
-  return '"%s/%s/%s"' % (month, date, year)
+  return date_utils.canonical(date_string, date_utils.QUOTED)
 	
\ No newline at end of file
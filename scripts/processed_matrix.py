@@ -0,0 +1,176 @@
+"""
+Binary mirror of the wide csv files under processed_data/ and a fast loader.
+
+Loading a wide csv means parsing every quoted cell and turning the NA strings
+into missing values. This module keeps a NumPy copy of every processed csv
+next to it:
+
+    {sample}_{feature}.npy       float64 matrix, rows are locations and
+                                 columns are dates; NA (and any other
+                                 non-numeric cell, e.g. '6-10') is NaN
+    {sample}_{feature}.npy.json  row names, dates and the size/mtime of the
+                                 csv the matrix was built from
+
+load() memory-maps the .npy file, so the OS page cache is shared by every
+process loading the same data, and rebuilds the mirror first when the csv
+changed since it was built. The writers of the csvs leave the mirrors alone,
+so a write never waits on a rebuild; the first load() after it pays for one.
+Run this script to bring every mirror up to date ahead of the readers:
+
+    $ python scripts/processed_matrix.py [${csv_path} ...]
+
+The mirrors are build artifacts and are not checked in.
+"""
+import collections
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import atomic_io
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSED_DATA_DIR = os.path.join(REPO_ROOT, 'processed_data')
+
+MATRIX_SUFFIX = '.npy'
+INDEX_SUFFIX = '.npy.json'
+DTYPE = np.float64
+
+Matrix = collections.namedtuple('Matrix', ['values', 'rows', 'dates'])
+Matrix.__doc__ = """A processed csv loaded as a matrix.
+
+Attributes:
+    values: 2-D numpy array of float64, NaN where the csv holds NA.
+    rows: list of location names, in row order.
+    dates: list of dates as found in the csv header, in column order.
+"""
+
+
+def matrix_path(csv_path):
+    """Returns the path of the .npy mirror of a processed csv."""
+    return os.path.splitext(csv_path)[0] + MATRIX_SUFFIX
+
+
+def index_path(csv_path):
+    """Returns the path of the index of the .npy mirror of a processed csv."""
+    return os.path.splitext(csv_path)[0] + INDEX_SUFFIX
+
+
+def csv_signature(csv_path):
+    """Returns the size and mtime of a csv, used to detect changes."""
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_csv_matrix(csv_path):
+    """Parses a wide processed csv.
+
+    The cells are parsed by pandas in one pass; only the columns holding
+    cells that are not numbers (e.g. '6-10') are converted again.
+
+    Args:
+        csv_path: The path to the csv.
+
+    Returns:
+        A Matrix. Cells that are not numbers become NaN.
+    """
+    with open(csv_path, 'r', newline='') as csv_file:
+        header = next(csv.reader(csv_file))
+    dates = header[1:]
+    # Numbered columns, as the header can name the same date twice.
+    table = pd.read_csv(csv_path, header=None, skiprows=1,
+                        names=range(len(header)),
+                        usecols=range(len(header)), index_col=0,
+                        dtype={0: str},
+                        na_values={column: ['NA']
+                                   for column in range(1, len(header))},
+                        keep_default_na=False, float_precision='round_trip')
+    for column in table.columns[table.dtypes == object]:
+        table[column] = pd.to_numeric(table[column], errors='coerce')
+    matrix = table.to_numpy(DTYPE).reshape(len(table), len(dates))
+    return Matrix(matrix, table.index.tolist(), dates)
+
+
+def replace_with(path, write):
+    """Calls write(file_object) on a temporary file, then renames it to path
+    so that readers never see a partial file (see atomic_io.py)."""
+    atomic_io.replace_with(path, write)
+
+
+def is_stale(csv_path):
+    """Returns True if the mirror of csv_path is missing or out of date."""
+    try:
+        with open(index_path(csv_path), 'r') as index_file:
+            index = json.load(index_file)
+    except (IOError, ValueError):
+        return True
+    return index.get('csv') != csv_signature(csv_path) or \
+        not os.path.exists(matrix_path(csv_path))
+
+
+def build(csv_path):
+    """Writes the .npy mirror and index of a processed csv.
+
+    Args:
+        csv_path: The path to the csv.
+
+    Returns:
+        The Matrix that was written.
+    """
+    signature = csv_signature(csv_path)
+    matrix = read_csv_matrix(csv_path)
+    replace_with(matrix_path(csv_path),
+                 lambda f: np.save(f, matrix.values, allow_pickle=False))
+    index = {
+        'csv': signature,
+        'dtype': np.dtype(DTYPE).name,
+        'shape': list(matrix.values.shape),
+        'rows': matrix.rows,
+        'dates': matrix.dates,
+    }
+    replace_with(index_path(csv_path),
+                 lambda f: f.write(json.dumps(index).encode('utf-8')))
+    return matrix
+
+
+def load(csv_path, mmap=True):
+    """Loads a processed csv through its binary mirror.
+
+    The mirror is rebuilt first if it is missing or older than the csv.
+
+    Args:
+        csv_path: The path to the csv, e.g.
+            'processed_data/cases/US/us-county_cases.csv'.
+        mmap: Memory-map the matrix read-only instead of reading it into
+            memory.
+
+    Returns:
+        A Matrix.
+    """
+    if is_stale(csv_path):
+        build(csv_path)
+    with open(index_path(csv_path), 'r') as index_file:
+        index = json.load(index_file)
+    values = np.load(matrix_path(csv_path), mmap_mode='r' if mmap else None,
+                     allow_pickle=False)
+    return Matrix(values, index['rows'], index['dates'])
+
+
+def find_processed_csvs(directory=PROCESSED_DATA_DIR):
+    """Returns the paths of every csv under directory, sorted."""
+    paths = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith('.csv'):
+                paths.append(os.path.join(root, filename))
+    return sorted(paths)
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:] or find_processed_csvs():
+        if is_stale(path):
+            build(path)
+            print('%s - mirror rebuilt' % path)
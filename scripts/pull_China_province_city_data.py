@@ -3,59 +3,89 @@ Created by ROSEMARY HE on Apr.10
 generates four .csv files documenting COVID-19 cases and death in each province and city in CHINA, the data is updated daily and script should run daily
 to add new data
 data source from https://github.com/BlankerL/DXY-COVID-19-Crawler by BlankerL, who pulls from Ding Xiang Yuan(https://ncov.dxy.cn/ncovh5/view/pneumonia)
+
+DXYArea.csv is read in chunks with only the needed columns and compact dtypes. Each chunk is reduced to the last update per
+province/city and day as it is read, so memory stays bounded by the number of (place, day) pairs, not by the size of the file.
+All four outputs come from the same two reduced frames, and are replaced together as one atomic_io batch so an interrupted
+run never leaves a mix of old and new files. Every changed DXYArea.csv is kept in the raw archive (see raw_archive.py).
 '''
 
+import sys
 import pandas as pd
-import numpy as np
+import atomic_io
+import date_utils
+import file_lock
+import http_cache
+import metrics
+import raw_archive
 
 url = 'https://raw.githubusercontent.com/BlankerL/DXY-COVID-19-Data/master/csv/DXYArea.csv'
-df = pd.read_csv(url, index_col=False, usecols=['countryEnglishName','provinceEnglishName','province_confirmedCount','province_deadCount','updateTime','cityEnglishName','city_confirmedCount','city_deadCount'])
+chunk_size = 100000
+columns = {'countryEnglishName': 'category', 'provinceEnglishName': 'category', 'province_confirmedCount': 'float64',
+           'province_deadCount': 'float64', 'updateTime': 'str', 'cityEnglishName': 'category',
+           'city_confirmedCount': 'float64', 'city_deadCount': 'float64'}
+province_columns = ['provinceEnglishName', 'date', 'province_confirmedCount', 'province_deadCount']
+city_columns = ['cityEnglishName', 'date', 'city_confirmedCount', 'city_deadCount']
+
+##conditional request: unchanged upstream data is served from the local cache and needs no reprocessing
+with metrics.stage('fetch', source='china'):
+    response = http_cache.get(url, commit=False)
+if not response.changed:
+    print('DXYArea.csv has not changed since the last run, nothing to update.')
+    sys.exit(0)
+path = response.path
+raw_archive.store('china', path, url=url)
 
 '''
 ##use if url doesn't work, download file from github, then open locally
-url = 'DXYArea.csv'
-df = pd.read_csv(open(url,'r'), index_col=False, usecols=['countryEnglishName','provinceEnglishName','province_confirmedCount','province_deadCount','updateTime','cityEnglishName','city_confirmedCount','city_deadCount'])
+path = 'DXYArea.csv'
 '''
 
-##filter out only CHINA cases
-df = df[df.countryEnglishName == 'China']
-##get year-month-date in format MM/DD/YY
-df['date'] = [str(x[5:7]+'/'+x[8:10]+'/'+x[2:4]) for x in df['updateTime']]
-#in format YYYY-MM-DD
-#df['date'] = [x[0:10] for x in df['updateTime']]
-
-##China province confirmed count
-df_province_c = df.loc[:,['provinceEnglishName','province_confirmedCount','date']]
-df_province_c = df_province_c.drop_duplicates(subset=['provinceEnglishName','date'], keep='last')
-df_province_c = df_province_c.set_index(['provinceEnglishName','date'])
-##get header
-dates = np.unique([x[1] for x in df_province_c.index.values])
-df_province_c = df_province_c.unstack()
-
-##China province death count
-df_province_d = df.loc[:,['provinceEnglishName','province_deadCount','date']]
-df_province_d = df_province_d.drop_duplicates(subset=['provinceEnglishName','date'], keep='last')
-df_province_d = df_province_d.set_index(['provinceEnglishName','date'])
-df_province_d = df_province_d.unstack()
-
-##China city confirmed count
-df_city_c = df.loc[:,['cityEnglishName','city_confirmedCount','date']]
-df_city_c = df_city_c.drop_duplicates(subset=['cityEnglishName','date'], keep='last')
-df_city_c = df_city_c.dropna(axis=0, subset=['cityEnglishName'])
-df_city_c = df_city_c.set_index(['cityEnglishName','date'])
-##get header
-dates_city = np.unique([x[1] for x in df_city_c.index.values])
-df_city_c = df_city_c.unstack()
-
-##China city death count
-df_city_d = df.loc[:,['cityEnglishName','city_deadCount','date']]
-df_city_d = df_city_d.drop_duplicates(subset=['cityEnglishName','date'], keep='last')
-df_city_d = df_city_d.dropna(axis=0, subset=['cityEnglishName'])
-df_city_d = df_city_d.set_index(['cityEnglishName','date'])
-df_city_d = df_city_d.unstack()
-
-##export to .csv files
-df_province_c.to_csv('China_cases_by_province.csv', index_label=None, header=dates, na_rep='NA', float_format='%.0f')
-df_province_d.to_csv('China_death_by_province.csv', index_label=None, header=dates, na_rep='NA', float_format='%.0f')
-df_city_c.to_csv('China_cases_by_city.csv', index_label=None, header=dates_city, na_rep='NA', float_format='%.0f')
-df_city_d.to_csv('China_death_by_city.csv', index_label=None, header=dates_city, na_rep='NA', float_format='%.0f')
+def last_update_per_day(df, subset):
+    ##keep the last row for each place and day; rows are in file order, so this matches one pass over the whole file
+    return df.drop_duplicates(subset=subset, keep='last')
+
+province = []
+city = []
+with metrics.stage('parse', source='china'):
+    for chunk in pd.read_csv(path, index_col=False, usecols=list(columns), dtype=columns, chunksize=chunk_size):
+        metrics.count('rows', len(chunk), stage='parse', source='china')
+        ##filter out only CHINA cases
+        chunk = chunk[chunk.countryEnglishName == 'China']
+        ##get year-month-date in format MM/DD/YY
+        update_time = chunk['updateTime'].str
+        chunk = chunk.assign(date=update_time[5:7] + '/' + update_time[8:10] + '/' + update_time[2:4])
+        #in format YYYY-MM-DD
+        #chunk = chunk.assign(date=update_time[0:10])
+
+        ##object, not str: a missing province stays NaN (written as NA, like before) instead of becoming 'nan'
+        chunk_province = chunk[province_columns].astype({'provinceEnglishName': object})
+        province.append(last_update_per_day(chunk_province, ['provinceEnglishName', 'date']))
+        chunk_city = chunk[city_columns].dropna(subset=['cityEnglishName']).astype({'cityEnglishName': 'str'})
+        city.append(last_update_per_day(chunk_city, ['cityEnglishName', 'date']))
+
+with metrics.stage('merge', source='china'):
+    df_province = last_update_per_day(pd.concat(province, ignore_index=True), ['provinceEnglishName', 'date'])
+    df_province = df_province.set_index(['provinceEnglishName', 'date'])
+    df_city = last_update_per_day(pd.concat(city, ignore_index=True), ['cityEnglishName', 'date'])
+    df_city = df_city.set_index(['cityEnglishName', 'date'])
+
+##China province confirmed/death count, China city confirmed/death count
+##unstack sorts places and dates (as MM/DD/YY strings), which gives the header
+outputs = [(df_province, 'province_confirmedCount', 'China_cases_by_province.csv'),
+           (df_province, 'province_deadCount', 'China_death_by_province.csv'),
+           (df_city, 'city_confirmedCount', 'China_cases_by_city.csv'),
+           (df_city, 'city_deadCount', 'China_death_by_city.csv')]
+
+##export to .csv files, holding their locks so parallel runs can not interleave
+with file_lock.locked(*[filename for _, _, filename in outputs]), atomic_io.batch() as output_files:
+    for df, count_column, filename in outputs:
+        with metrics.stage('write', source='china', output=filename):
+            df_count = df[count_column].unstack()
+            with output_files.open(filename, newline='') as output_file:
+                ##header dates as quoted MM/DD/YY cells, like every processed file; to_csv would leave them bare
+                output_file.write(','.join([df.index.names[0]] + date_utils.header_cells(df_count.columns)) + '\n')
+                df_count.to_csv(output_file, header=False, na_rep='NA', float_format='%.0f')
+        metrics.count('rows', len(df_count), stage='write', source='china', output=filename)
+##only now is this version of DXYArea.csv processed; a run that died before gets it again
+response.commit()
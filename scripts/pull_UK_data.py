@@ -5,33 +5,229 @@ data source from https://github.com/tomwhite/covid-19-uk-data by tomwhite, who p
  https://www.gov.uk/guidance/coronavirus-covid-19-information-for-the-public#number-of-cases
  www.gov.scot/coronavirus-covid-19
  for full list of documentation please visit his repository https://github.com/tomwhite/covid-19-uk-data
+
+The upstream file only grows at the end, so after a full run the byte offset of the last line processed (and the line itself) is
+saved in .cache/uk/state.json. The next run asks for the rest of the file with an HTTP Range request, parses only those new rows
+in chunks and merges them into the existing UK_cases_by_zip.csv. When they only hold days after the last one processed
+(last_date in the state) for areas already in the csv, their columns are appended to the lines of the csv as text,
+without parsing it; otherwise the csv is read back and merged. Either way the csv is rewritten, so a run costs a pass
+over the output, but not a parse of the whole upstream file. It falls back to a full rebuild when the server ignores the
+range, when the saved line no longer sits at the saved offset (upstream rewrote history), or when run with --full.
+A full download is kept in the raw archive (see raw_archive.py) under 'uk'. Each fetched tail is kept under 'uk-tail', with the
+offset it starts at, so 'uk' only holds whole files and raw_archive.py cat uk gives a file that can be read as is.
 '''
 
-import numpy as np
+import argparse
+import io
+import json
+import os
 import pandas as pd
+import atomic_io
+import date_utils
+import fetch_utils
+import file_lock
+import http_cache
+import metrics
+import raw_archive
 
 
 url = 'https://raw.githubusercontent.com/tomwhite/covid-19-uk-data/master/data/covid-19-cases-uk.csv'
-df = pd.read_csv(url, index_col=False, usecols=['Date','AreaCode','TotalCases'])
+output_filename = 'UK_cases_by_zip.csv'
+state_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache', 'uk', 'state.json')
+usecols = ['Date', 'AreaCode', 'TotalCases']
+chunk_size = 100000
+tail_bytes = 64 * 1024
 
 '''
-##use if url doesn't work, download file from github, then open locally
+##use if url doesn't work, download file from github, then open locally, and run with --full
 url = 'covid-19-cases-uk.csv'
-df = pd.read_csv(open(url,'r'), index_col=False, usecols=['Date','AreaCode','TotalCases'])
 '''
 
-##keep last information if same area published more than once daily
-df = df.drop_duplicates(subset=['AreaCode','Date'], keep='last')
-##get rid of any cases without area code
-df = df.dropna(subset=['AreaCode'])
-##place date in MM/DD/YY format
-df['date'] = [str(x[5:7] + '/' + str(x[8:10] + '/' + str(x[2:4]))) for x in df['Date']]
-df = df.set_index(['AreaCode','date'], drop=True)
-df = df.drop(['Date'], axis=1)
-
-##get header
-dates = np.unique([x[1] for x in df.index.values])
-df = df.unstack()
-
-##export to .csv file
-df.to_csv('UK_cases_by_zip.csv', index_label=None, header=dates, na_rep='NA', float_format='%.0f')
\ No newline at end of file
+
+def read_rows(source, **kwargs):
+    '''reads the rows in chunks, keeping the last row of an area published more than once daily'''
+    rows = []
+    for chunk in pd.read_csv(source, index_col=False, usecols=usecols, dtype=str, chunksize=chunk_size, **kwargs):
+        ##get rid of any cases without area code
+        chunk = chunk.dropna(subset=['AreaCode'])
+        rows.append(chunk.drop_duplicates(subset=['AreaCode', 'Date'], keep='last'))
+    if not rows:
+        return pd.DataFrame(columns=usecols)
+    return pd.concat(rows, ignore_index=True).drop_duplicates(subset=['AreaCode', 'Date'], keep='last')
+
+
+def format_cases(cases):
+    '''formats counts as whole numbers and missing counts as NA, as to_csv(na_rep='NA', float_format='%.0f') does'''
+    numbers = pd.to_numeric(cases, errors='coerce')
+    formatted = cases.where(numbers.isnull(), numbers.map(lambda x: '%.0f' % x))
+    return formatted.fillna('NA')
+
+
+def pivot(rows):
+    '''area x date table of formatted counts, NaN where an area has no row for a date'''
+    ##place date in MM/DD/YY format
+    dates = rows['Date'].str[5:7] + '/' + rows['Date'].str[8:10] + '/' + rows['Date'].str[2:4]
+    index = pd.MultiIndex.from_arrays([rows['AreaCode'].values, dates.values], names=['AreaCode', 'date'])
+    return pd.Series(format_cases(rows['TotalCases']).values, index=index, dtype=object).unstack()
+
+
+def merge(table, new_table):
+    '''cells of new_table replace those of table; areas are sorted, and dates in calendar order'''
+    areas = table.index.union(new_table.index)
+    dates = table.columns.union(new_table.columns)
+    dates = dates[date_utils.to_ordinals(list(dates)).argsort(kind='stable')]
+    merged = table.reindex(index=areas, columns=dates).astype(object)
+    merged.update(new_table)
+    merged.index.name = 'AreaCode'
+    return merged.fillna('NA')
+
+
+def read_output():
+    return pd.read_csv(output_filename, index_col=0, dtype=str, keep_default_na=False)
+
+
+def write_output(table):
+    ##header dates as quoted MM/DD/YY cells, like every processed file; to_csv would leave them bare
+    with atomic_io.atomic_write(output_filename, newline='') as output_file:
+        output_file.write(','.join([table.index.name] + date_utils.header_cells(table.columns)) + '\n')
+        table.to_csv(output_file, header=False)
+
+
+def append_columns(new_table):
+    '''appends the columns of new_table, days after every day of the output, to its lines as they are; returns the
+    number of rows written, or None if new_table has areas the output does not have or days that are not after all of
+    its days (e.g. a tail fetched again because the last run died between writing the output and saving the state)'''
+    with open(output_filename, 'r', newline='') as output_file:
+        lines = output_file.read().splitlines()
+    areas = [line.split(',', 1)[0] for line in lines[1:]]
+    ##quoted area codes could hold commas, leave those to merge()
+    if any(line.startswith('"') for line in lines) or not set(new_table.index) <= set(areas):
+        return None
+    dates = sorted(new_table.columns, key=date_utils.to_ordinal)
+    ##days already in the output, or before its last day, have to be merged in place
+    header = lines[0].split(',')
+    if len(header) > 1 and date_utils.to_ordinals(header[1:]).max() >= date_utils.to_ordinal(dates[0]):
+        return None
+    cells = new_table.reindex(index=areas, columns=dates).fillna('NA').values.tolist()
+    with atomic_io.atomic_write(output_filename, newline='') as output_file:
+        output_file.write(','.join([lines[0]] + date_utils.header_cells(dates)) + '\n')
+        for line, row in zip(lines[1:], cells):
+            output_file.write(','.join([line] + row) + '\n')
+    return len(areas)
+
+
+def last_line(path):
+    '''returns the offset after the last complete line of path, and that line'''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as body:
+        body.seek(max(size - tail_bytes, 0))
+        tail = body.read()
+    end = tail.rfind(b'\n') + 1
+    start = tail.rfind(b'\n', 0, max(end - 1, 0)) + 1
+    return size - len(tail) + end, tail[start:end].decode('utf-8')
+
+
+def load_state():
+    try:
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+    except (IOError, ValueError):
+        return None
+    if state.get('url') != url or state.get('output') != os.path.abspath(output_filename) \
+            or not os.path.exists(output_filename):
+        return None
+    return state
+
+
+def save_state(state):
+    if not os.path.isdir(os.path.dirname(state_path)):
+        os.makedirs(os.path.dirname(state_path))
+    state.update(url=url, output=os.path.abspath(output_filename))
+    with atomic_io.atomic_write(state_path) as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+
+
+def fetch_tail(state):
+    '''returns the bytes appended upstream since the saved offset, or None if they can not be fetched that way'''
+    anchor = state['line'].encode('utf-8')
+    response = fetch_utils.get(url, headers={'Range': 'bytes=%d-' % (state['offset'] - len(anchor)),
+                                             'Accept-Encoding': 'identity'})
+    if response.status_code != 206 or not response.content.startswith(anchor):
+        return None
+    metrics.count('http_bytes', len(response.content), source='uk')
+    return response.content[len(anchor):]
+
+
+def run_full():
+    ##conditional request: unchanged upstream data is served from the local cache and needs no reprocessing
+    with metrics.stage('fetch', source='uk'):
+        response = http_cache.get(url, commit=False)
+    if not response.changed and load_state() is not None:
+        print('covid-19-cases-uk.csv has not changed since the last run, nothing to update.')
+        return
+    if response.changed:
+        raw_archive.store('uk', response.path, url=url)
+    with metrics.stage('parse', source='uk'):
+        rows = read_rows(response.path)
+    metrics.count('rows', len(rows), stage='parse', source='uk')
+    with metrics.stage('merge', source='uk'):
+        table = merge(pd.DataFrame(), pivot(rows))
+    with metrics.stage('write', source='uk'), file_lock.locked(output_filename):
+        write_output(table)
+        with open(response.path, 'r') as body:
+            columns = body.readline().rstrip('\r\n').split(',')
+        offset, line = last_line(response.path)
+        save_state({'offset': offset, 'line': line, 'columns': columns,
+                    'last_date': rows['Date'].max() if len(rows) else None})
+    response.commit()
+    metrics.count('rows', len(table), stage='write', source='uk')
+
+
+def run_incremental(state):
+    '''merges the rows appended upstream into the output; returns False if they can not be fetched incrementally'''
+    with metrics.stage('fetch', source='uk'):
+        tail = fetch_tail(state)
+    if tail is None:
+        return False
+    ##only whole lines, a partly written last line is read next time
+    tail = tail[:tail.rfind(b'\n') + 1]
+    if not tail:
+        print('covid-19-cases-uk.csv has no new rows since the last run, nothing to update.')
+        return True
+    raw_archive.store('uk-tail', tail, url=url, offset=state['offset'])
+    with metrics.stage('parse', source='uk'):
+        rows = read_rows(io.BytesIO(tail), header=None, names=state['columns'])
+    metrics.count('rows', len(rows), stage='parse', source='uk')
+    new_table = pivot(rows)
+    with file_lock.locked(output_filename):
+        written = None
+        if state.get('last_date') and len(rows) and rows['Date'].min() > state['last_date']:
+            with metrics.stage('write', source='uk'):
+                written = append_columns(new_table)
+        if written is None:
+            with metrics.stage('merge', source='uk'):
+                table = merge(read_output(), new_table)
+            with metrics.stage('write', source='uk'):
+                write_output(table)
+            written = len(table)
+        with metrics.stage('write', source='uk'):
+            line = tail[tail.rfind(b'\n', 0, len(tail) - 1) + 1:].decode('utf-8')
+            state.update(offset=state['offset'] + len(tail), line=line,
+                         last_date=max([state.get('last_date') or ''] + list(rows['Date'])))
+            save_state(state)
+    metrics.count('rows', written, stage='write', source='uk')
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Updates UK_cases_by_zip.csv, in the current directory, from covid-19-cases-uk.csv.')
+    parser.add_argument('--full', action='store_true', help='rebuild the csv from the whole upstream file')
+    args = parser.parse_args(argv)
+
+    state = None if args.full else load_state()
+    if state is None or not run_incremental(state):
+        run_full()
+
+
+if __name__ == '__main__':
+    main()
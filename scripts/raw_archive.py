@@ -0,0 +1,243 @@
+"""
+Compressed, content-addressed archive of the raw payloads of every source.
+
+Each payload a fetcher downloads is stored once, gzip-compressed, under the
+SHA-256 of its uncompressed bytes, so the many days on which a source
+publishes the same file cost one blob. A per-source index maps each day to
+the blob fetched for it:
+
+    raw_data/archive/blobs/<sha[:2]>/<sha>.gz
+    raw_data/archive/index/<source>.jsonl    one entry per line:
+        {"date": "04/16/2020", "blob": "<sha>", "size": 1234,
+         "fetched": 1587076289.0, "url": "https://..."}
+
+Blobs are read back as streams, decompressed on the fly, so archived sources
+can be reprocessed at disk speed without the network (see --from-archive in
+scrapers.py):
+
+    entry = raw_archive.find('nyc-zc', '4/16/20')
+    with raw_archive.open_blob(entry['blob']) as payload:
+        ...
+
+The sources of scrapers.py can be replayed that way, and boroProcess.py
+reads the boro days from the archive alone, as it no longer writes its
+own copy of each file. The UK and China payloads are archived too, but
+their scripts have no --from-archive path; `cat` gives back the files they
+would read. pull_UK_data.py archives the rows it fetches with a Range
+request under 'uk-tail', apart from the full downloads under 'uk', so 'uk'
+only ever holds whole files.
+
+The archive is checked in, like the raw files it replaces (the boro files
+that were in raw_data/boro_data now live here). Payloads already on disk
+are added with
+
+    $ python scripts/raw_archive.py add ${source} ${M/D/Y date} ${path}
+
+and `list` and `cat` show what is archived.
+
+Meant to be run with Python 3.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import atomic_io
+import date_utils
+import file_lock
+import metrics
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ARCHIVE_DIR = os.path.join(REPO_ROOT, 'raw_data', 'archive')
+BLOB_SUFFIX = '.gz'
+INDEX_SUFFIX = '.jsonl'
+CHUNK_SIZE = 1024 * 1024
+COMPRESS_LEVEL = 6
+
+
+def _archive_dir(archive_dir):
+    return archive_dir or DEFAULT_ARCHIVE_DIR
+
+
+def blob_path(digest, archive_dir=None):
+    """Returns the path of the blob with the given SHA-256 hex digest."""
+    return os.path.join(_archive_dir(archive_dir), 'blobs', digest[:2],
+                        digest + BLOB_SUFFIX)
+
+
+def index_path(source, archive_dir=None):
+    """Returns the path of the index of a source."""
+    return os.path.join(_archive_dir(archive_dir), 'index',
+                        source + INDEX_SUFFIX)
+
+
+def _chunks(payload):
+    """Yields the bytes of payload, given as bytes or as the path of a
+    file, in chunks."""
+    if isinstance(payload, bytes):
+        for start in range(0, len(payload), CHUNK_SIZE):
+            yield payload[start:start + CHUNK_SIZE]
+        return
+    with open(payload, 'rb') as payload_file:
+        for chunk in iter(lambda: payload_file.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+def store_blob(payload, archive_dir=None):
+    """Compresses payload into the archive unless it is already there.
+
+    Args:
+        payload: bytes, or the path of a file.
+        archive_dir: The archive, DEFAULT_ARCHIVE_DIR if None.
+
+    Returns:
+        digest, size
+        the SHA-256 hex digest and the uncompressed size of the payload.
+    """
+    blobs_dir = os.path.join(_archive_dir(archive_dir), 'blobs')
+    os.makedirs(blobs_dir, exist_ok=True)
+    sha = hashlib.sha256()
+    size = 0
+    # The digest is only known at the end, so compress into a temporary
+    # file while hashing and give it its name once the name is known.
+    with atomic_io.temp_file(blobs_dir) as tmp:
+        with gzip.GzipFile(fileobj=tmp.file, mode='wb',
+                           compresslevel=COMPRESS_LEVEL, mtime=0) as blob:
+            for chunk in _chunks(payload):
+                sha.update(chunk)
+                size += len(chunk)
+                blob.write(chunk)
+        digest = sha.hexdigest()
+        path = blob_path(digest, archive_dir)
+        if os.path.exists(path):
+            metrics.count('archive_duplicates')
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp.path = path
+    if tmp.path is not None:
+        metrics.count('archive_bytes', os.path.getsize(path))
+    return digest, size
+
+
+def store(source, payload, date=None, url=None, archive_dir=None, **extra):
+    """Archives a raw payload of a source and indexes it under date.
+
+    Args:
+        source: str, the name of the source.
+        payload: bytes, or the path of a file.
+        date: The day the payload holds data for, in any form
+            date_utils.to_ordinal() accepts; today if None.
+        url: str, where the payload came from.
+        archive_dir: The archive, DEFAULT_ARCHIVE_DIR if None.
+        extra: Other fields to keep in the index entry.
+
+    Returns:
+        dict, the index entry.
+    """
+    digest, size = store_blob(payload, archive_dir)
+    entry = {
+        'date': date_utils.to_date(date or time.strftime('%m/%d/%Y'))
+        .strftime('%m/%d/%Y'),
+        'blob': digest,
+        'size': size,
+        'fetched': round(time.time(), 3),
+        'url': url,
+    }
+    entry.update(extra)
+    path = index_path(source, archive_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with file_lock.locked(path):
+        with open(path, 'a') as index_file:
+            index_file.write(json.dumps(entry, sort_keys=True) + '\n')
+            index_file.flush()
+            os.fsync(index_file.fileno())
+    return entry
+
+
+def entries(source, archive_dir=None):
+    """Returns the index entries of a source, oldest first. A torn last
+    line is ignored."""
+    try:
+        with open(index_path(source, archive_dir), 'r') as index_file:
+            lines = index_file.readlines()
+    except IOError:
+        return []
+    result = []
+    for line in lines:
+        if line.endswith('\n'):
+            result.append(json.loads(line))
+    return result
+
+
+def latest_per_day(source, archive_dir=None):
+    """Returns the last entry archived for each day, in calendar order."""
+    days = {}
+    for entry in entries(source, archive_dir):
+        days[date_utils.to_ordinal(entry['date'])] = entry
+    return [days[ordinal] for ordinal in sorted(days)]
+
+
+def find(source, date, archive_dir=None):
+    """Returns the last entry archived for the day of date, or None."""
+    ordinal = date_utils.to_ordinal(date)
+    found = None
+    for entry in entries(source, archive_dir):
+        if date_utils.to_ordinal(entry['date']) == ordinal:
+            found = entry
+    return found
+
+
+def open_blob(digest, archive_dir=None):
+    """Opens a blob for reading its uncompressed bytes as a stream."""
+    return gzip.open(blob_path(digest, archive_dir), 'rb')
+
+
+def read_blob(digest, archive_dir=None):
+    """Returns the uncompressed bytes of a blob."""
+    with open_blob(digest, archive_dir) as blob:
+        return blob.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Add to, list or read the archive of raw payloads.")
+    parser.add_argument("--archive-dir", help="default: raw_data/archive")
+    commands = parser.add_subparsers(dest="command")
+    add = commands.add_parser("add", help="archive files of a source")
+    add.add_argument("source")
+    add.add_argument("date", help="M/D/Y day the files hold data for")
+    add.add_argument("paths", nargs="+")
+    listing = commands.add_parser("list", help="list the days of a source")
+    listing.add_argument("source")
+    cat = commands.add_parser("cat", help="write the payload of a day to "
+                              "stdout")
+    cat.add_argument("source")
+    cat.add_argument("date")
+    args = parser.parse_args(argv)
+
+    if args.command == "add":
+        for path in args.paths:
+            entry = store(args.source, path, args.date,
+                          archive_dir=args.archive_dir,
+                          path=os.path.basename(path))
+            print('%s - %s %s' % (path, entry['date'], entry['blob']))
+    elif args.command == "list":
+        for entry in latest_per_day(args.source, args.archive_dir):
+            print('%s %s %d' % (entry['date'], entry['blob'], entry['size']))
+    elif args.command == "cat":
+        entry = find(args.source, args.date, args.archive_dir)
+        if entry is None:
+            sys.exit("ERROR: nothing archived for %s on %s"
+                     % (args.source, args.date))
+        with open_blob(entry['blob'], args.archive_dir) as blob:
+            shutil.copyfileobj(blob, sys.stdout.buffer, CHUNK_SIZE)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
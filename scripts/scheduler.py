@@ -0,0 +1,257 @@
+"""
+Long-running scheduler for the sources in sources.json.
+
+Instead of running every scraper by hand at the right time of day, the
+scheduler polls a cheap change marker for each source on the source's own
+cadence and only runs the full fetch and write (scrapers.run_source) when
+the marker moved:
+
+    arcgis  the layer's editingInfo.lastEditDate (a ?f=json request)
+    etag    the ETag or Last-Modified header of a HEAD request
+    daily   the current date, i.e. run once a day
+
+The cadence is set by an optional "schedule" entry of each source:
+
+    "schedule": {"every_minutes": 30, "after": "15:00", "before": "23:59",
+                 "probe": "etag"}
+
+every_minutes defaults to DEFAULT_EVERY_MINUTES, after/before (local time)
+restrict polling to a window of the day, and probe defaults to the one
+matching the source's fetcher. Failed polls back off exponentially up to
+MAX_BACKOFF_MINUTES, and every delay is spread by +/- JITTER so sources on the
+same server do not poll in lockstep.
+
+What was last seen for every source is kept in a state file, so restarting
+the scheduler does not refetch unchanged sources:
+
+    $ python scheduler.py [--once] [--source ${name} ...]
+
+Meant to be run with Python 3.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import arcgis_utils
+import atomic_io
+import fetch_utils
+import metrics
+import scrapers
+
+DEFAULT_STATE_PATH = os.path.join(scrapers.REPO_ROOT, '.cache', 'scheduler',
+                                  'state.json')
+DEFAULT_EVERY_MINUTES = 60
+MAX_BACKOFF_MINUTES = 24 * 60
+JITTER = 0.1
+# Longest time the loop sleeps at once, so a stopped scheduler exits soon.
+MAX_SLEEP_SECONDS = 60
+
+PROBES = {}
+DEFAULT_PROBES = {
+    'arcgis': 'arcgis',
+    'csv': 'etag',
+    'html_table': 'etag',
+}
+
+
+def register_probe(name):
+    """Registers function(source) -> token as the probe called name. The
+    token is any JSON value that changes when the source has new data, or
+    None if the source can not tell."""
+    def decorator(function):
+        PROBES[name] = function
+        return function
+    return decorator
+
+
+@register_probe('arcgis')
+def probe_arcgis(source):
+    return arcgis_utils.metadata.get_last_edit(source['url'])
+
+
+@register_probe('etag')
+def probe_etag(source):
+    response = fetch_utils.head(source['url'], allow_redirects=True)
+    response.raise_for_status()
+    return response.headers.get('ETag') or \
+        response.headers.get('Last-Modified')
+
+
+@register_probe('daily')
+def probe_daily(source):
+    return datetime.now().strftime('%Y-%m-%d')
+
+
+def get_schedule(source):
+    """Returns the schedule of a source with the defaults filled in."""
+    schedule = dict(source.get('schedule') or {})
+    schedule.setdefault('every_minutes', DEFAULT_EVERY_MINUTES)
+    schedule.setdefault('after', None)
+    schedule.setdefault('before', None)
+    schedule.setdefault('probe',
+                        DEFAULT_PROBES.get(source['fetcher'], 'daily'))
+    return schedule
+
+
+def in_window(schedule, now):
+    """Returns True if the local time of now is inside the polling window."""
+    clock = datetime.fromtimestamp(now).strftime('%H:%M')
+    if schedule['after'] is not None and clock < schedule['after']:
+        return False
+    if schedule['before'] is not None and clock > schedule['before']:
+        return False
+    return True
+
+
+def next_delay(schedule, failures, rng=random):
+    """Returns the number of seconds until the next poll of a source.
+
+    Args:
+        schedule: The source's schedule, see get_schedule().
+        failures: Number of polls that failed in a row.
+        rng: The random number generator used for the jitter.
+    """
+    minutes = min(schedule['every_minutes'] * 2 ** failures,
+                  max(MAX_BACKOFF_MINUTES, schedule['every_minutes']))
+    return minutes * 60 * (1 + rng.uniform(-JITTER, JITTER))
+
+
+def load_state(path=DEFAULT_STATE_PATH):
+    """Returns the saved state, a dict keyed by source name."""
+    try:
+        with open(path, 'r') as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(state, path=DEFAULT_STATE_PATH):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with atomic_io.atomic_write(path) as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+
+
+def poll_source(source, entry, now, date=None):
+    """Probes a source and runs it if it changed since the last run.
+
+    Args:
+        source: The source's entry in the config.
+        entry: The source's saved state.
+        now: The current time, in seconds since the epoch.
+        date: An M/D/Y date overriding the source's date stage.
+
+    Returns:
+        (status, token) where status is 'outside window', 'unchanged',
+        'skipped' or 'updated' and token is the probe's marker.
+    """
+    schedule = get_schedule(source)
+    if not in_window(schedule, now):
+        return 'outside window', entry.get('token')
+    with metrics.stage('probe', source=source['name']):
+        token = PROBES[schedule['probe']](source)
+    if token is not None and token == entry.get('token'):
+        return 'unchanged', token
+    try:
+        scrapers.run_source(source, date)
+    except scrapers.SkippedSource:
+        return 'skipped', token
+    return 'updated', token
+
+
+def poll_due_sources(sources, state, now, date=None,
+                     max_workers=fetch_utils.DEFAULT_MAX_WORKERS, rng=random):
+    """Polls every source whose next poll time has come and updates state.
+
+    Returns:
+        The number of sources that were polled.
+    """
+    due = [source for source in sources
+           if state.get(source['name'], {}).get('next_poll', 0) <= now]
+    arcgis_utils.metadata.prefetch(
+        [source['url'] for source in due
+         if get_schedule(source)['probe'] == 'arcgis' and
+         in_window(get_schedule(source), now)])
+    outcomes = fetch_utils.run_concurrently(
+        lambda source: poll_source(source, state.get(source['name'], {}),
+                                   now, date),
+        due, max_workers)
+    for source, result, error in outcomes:
+        entry = state.setdefault(source['name'], {})
+        entry['last_poll'] = now
+        if error is None:
+            status, entry['token'] = result
+            metrics.count('polls', source=source['name'], status=status)
+            entry['failures'] = 0
+            if status in ('updated', 'skipped'):
+                entry['last_run'] = now
+            if status != 'outside window':
+                print("%s - %s" % (source['name'], status))
+        else:
+            entry['failures'] = entry.get('failures', 0) + 1
+            metrics.count('polls', source=source['name'], status='error')
+            print("%s - ERROR (%d in a row): %s" %
+                  (source['name'], entry['failures'], error))
+        entry['next_poll'] = now + next_delay(get_schedule(source),
+                                              entry['failures'], rng)
+    return len(due)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Poll the sources in sources.json and scrape the ones "
+        "that changed.")
+    parser.add_argument("--config", default=scrapers.DEFAULT_CONFIG_PATH,
+                        help="source config file (default: %(default)s)")
+    parser.add_argument("--state", default=DEFAULT_STATE_PATH,
+                        help="state file (default: %(default)s)")
+    parser.add_argument("--source", action="append", dest="sources",
+                        metavar="NAME", help="only poll this source; may be "
+                        "repeated")
+    parser.add_argument("--group", help="only poll the sources in this group")
+    parser.add_argument("--once", action="store_true",
+                        help="poll the due sources once and exit")
+    parser.add_argument("--max-workers", type=int,
+                        default=fetch_utils.DEFAULT_MAX_WORKERS,
+                        help="maximum number of sources polled at once "
+                        "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    try:
+        sources = scrapers.select_sources(
+            scrapers.load_sources(args.config), args.sources, args.group)
+        for source in sources:
+            probe = get_schedule(source)['probe']
+            if probe not in PROBES:
+                raise ValueError('%s - unknown probe %r' %
+                                 (source['name'], probe))
+    except ValueError as error:
+        sys.exit("ERROR: %s" % error)
+    if not sources:
+        sys.exit("ERROR: no sources selected")
+
+    state = load_state(args.state)
+    try:
+        while True:
+            if poll_due_sources(sources, state, time.time(),
+                                max_workers=args.max_workers):
+                save_state(state, args.state)
+                metrics.flush()
+            if args.once:
+                break
+            next_poll = min(state.get(source['name'], {}).get('next_poll', 0)
+                            for source in sources)
+            time.sleep(min(max(next_poll - time.time(), 1),
+                           MAX_SLEEP_SECONDS))
+    except KeyboardInterrupt:
+        save_state(state, args.state)
+    finally:
+        fetch_utils.close_sessions()
+
+
+if __name__ == "__main__":
+    main()
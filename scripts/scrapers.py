@@ -0,0 +1,607 @@
+"""
+Registry of scraper plugins and a single runner for every configured source.
+
+Sources are described in sources.json, one entry per source:
+
+    {
+      "name": "sarpy-nebraska",            used in messages and --source
+      "group": "arcgis",                   optional, selects sources by --group
+      "fetcher": "arcgis",                 how to get the rows, see FETCHERS
+      "url": "https://...",                the url the fetcher reads
+      "fields": {"location": ..., "value": ...},
+                                           field names (or column indices)
+                                           holding locations and values
+      "date": {"type": "arcgis_last_edit", "url": "https://..."},
+                                           how to date the snapshot, see
+                                           DATE_SOURCES
+      "transform": {"type": "case_counts"},
+                                           how to clean the values, see
+                                           TRANSFORMS
+      "output": "processed_data/cases/US/sarpy-nebraska_cases.csv",
+      "on_existing_date": "overwrite",     or "skip" (the default) to leave a
+                                           date that is already there alone
+      "quote_locations": true,             quote the location names
+      "archive": true                      or false to not keep the raw
+                                           payloads
+    }
+
+Every source goes through the same stages: fetch the rows, date them,
+transform the values and append the snapshot to the output csv through
+series_store.py. Sources are run concurrently over the pooled sessions of
+fetch_utils.py, so adding another ArcGIS county only takes a new entry in
+sources.json. New kinds of sources register their own stage functions with
+the register_fetcher, register_date_source and register_transform
+decorators.
+
+Run every source, or only some of them, from the scripts directory:
+
+    $ python scrapers.py [--source ${name} ...] [--group ${group}]
+
+The raw payload of every run is kept in the archive of raw_archive.py, and
+--from-archive reprocesses every archived day of the selected sources
+without the network, with a single write per source. Missed days are also
+backfilled from long csv files with date, location and value
+columns (the raw values, before the source's transform), all merged into the
+source's csv with a single write:
+
+    $ python scrapers.py --source ${name} --backfill ${csv_path} [...]
+
+Meant to be run with Python 3.
+"""
+import argparse
+import collections
+import csv
+import io
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from html.parser import HTMLParser
+
+import arcgis_utils
+import date_utils
+import fetch_utils
+import file_lock
+import http_cache
+import metrics
+import raw_archive
+import series_store
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'sources.json')
+
+FETCHERS = {}
+DATE_SOURCES = {}
+TRANSFORMS = {}
+
+Snapshot = collections.namedtuple('Snapshot', ['rows', 'date', 'raw'],
+                                  defaults=(None,))
+Snapshot.__doc__ = """The rows fetched for a source.
+
+Attributes:
+    rows: list of (location, value) pairs as found in the source.
+    date: str, the update date given by the source itself (M/D/Y), or None.
+    raw: the payload the rows were parsed from, as bytes or as the path of
+        a file, to be archived; or None.
+"""
+
+
+class SkippedSource(Exception):
+    """Raised when a source has nothing new to write."""
+
+
+def _register(registry, name):
+    def decorator(function):
+        registry[name] = function
+        return function
+    return decorator
+
+
+def register_fetcher(name):
+    """Registers function(source, raw=None) -> Snapshot as the fetcher called
+    name. Given raw, an archived payload, the fetcher parses it instead of
+    fetching."""
+    return _register(FETCHERS, name)
+
+
+def register_date_source(name):
+    """Registers function(source, spec, snapshot) -> 'M/D/Y' as the date
+    source called name. spec is the source's "date" entry."""
+    return _register(DATE_SOURCES, name)
+
+
+def register_transform(name):
+    """Registers function(source, spec, rows) -> rows as the transform called
+    name. spec is the source's "transform" entry and the returned values must
+    be strings formatted as they should appear in the csv."""
+    return _register(TRANSFORMS, name)
+
+
+def load_sources(config_path=DEFAULT_CONFIG_PATH):
+    """Reads the list of sources from a config file.
+
+    Raises:
+        ValueError: If a source names a stage that is not registered.
+    """
+    with open(config_path, 'r') as config_file:
+        sources = json.load(config_file)['sources']
+    for source in sources:
+        for stage, name, registry in (
+                ('fetcher', source['fetcher'], FETCHERS),
+                ('date source', source['date']['type'], DATE_SOURCES),
+                ('transform', source['transform']['type'], TRANSFORMS)):
+            if name not in registry:
+                raise ValueError('%s - unknown %s %r' %
+                                 (source['name'], stage, name))
+    return sources
+
+
+def output_path(source):
+    """Returns the absolute path of the csv a source writes to."""
+    return os.path.join(REPO_ROOT, source['output'])
+
+
+# ===========================================
+# Fetchers
+# ===========================================
+
+@register_fetcher('arcgis')
+def fetch_arcgis(source, raw=None):
+    """Reads every feature of an ArcGIS layer query, page by page. The raw
+    payload is the list of features as JSON."""
+    location_field = source['fields']['location']
+    value_field = source['fields']['value']
+    if raw is None:
+        features = list(arcgis_utils.iter_features(source['url']))
+        raw = json.dumps(features, sort_keys=True,
+                         separators=(',', ':')).encode('utf-8')
+    else:
+        features = json.loads(raw.decode('utf-8'))
+    rows = []
+    try:
+        for feature in features:
+            attributes = feature[u'attributes']
+            if attributes[location_field] is not None:
+                rows.append((attributes[location_field],
+                             attributes[value_field]))
+    except (KeyError, ValueError):
+        raise ValueError("could not extract 'features' field from JSON. URL "
+                         "may be incorrect or field names may have changed.")
+    return Snapshot(rows, None, raw)
+
+
+def _fetch_text(source, raw):
+    """Returns the text of raw, or of the source's url fetched through the
+    local HTTP cache, and the payload to archive."""
+    if raw is None:
+        response = http_cache.get(source['url'])
+        return response.text, response.path
+    return raw.decode('utf-8'), raw
+
+
+@register_fetcher('csv')
+def fetch_csv(source, raw=None):
+    """Reads a csv file, revalidated against the local HTTP cache. Fields
+    are column indices; the header row is skipped."""
+    location_column = source['fields']['location']
+    value_column = source['fields']['value']
+    text, raw = _fetch_text(source, raw)
+    reader = csv.reader(io.StringIO(text.strip()))
+    next(reader, None)
+    rows = [(row[location_column], row[value_column]) for row in reader
+            if row]
+    return Snapshot(rows, None, raw)
+
+
+class _TableParser(HTMLParser):
+    """Collects the text of the cells of the first table of a page, and the
+    text of the whole page."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.rows = []
+        self.text = []
+        self._tables_seen = 0
+        self._in_table = False
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self._tables_seen += 1
+            self._in_table = self._tables_seen == 1
+        elif self._in_table and tag == 'tr':
+            self.rows.append([])
+        elif self._in_table and tag in ('td', 'th') and self.rows:
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if tag == 'table':
+            self._in_table = False
+        elif tag in ('td', 'th') and self._cell is not None:
+            self.rows[-1].append(' '.join(''.join(self._cell).split()))
+            self._cell = None
+
+    def handle_data(self, data):
+        self.text.append(data)
+        if self._cell is not None:
+            self._cell.append(data)
+
+
+@register_fetcher('html_table')
+def fetch_html_table(source, raw=None):
+    """Reads the first table of a static html page, revalidated against the
+    local HTTP cache. Fields are column indices; rows whose value is not a
+    number (e.g. the header) are skipped. The update date is taken from the
+    first 'Updated ... M/D/Y' found in the text of the page."""
+    location_column = source['fields']['location']
+    value_column = source['fields']['value']
+    text, raw = _fetch_text(source, raw)
+    parser = _TableParser()
+    parser.feed(text)
+    parser.close()
+
+    cases = collections.OrderedDict()
+    for row in parser.rows:
+        if len(row) > max(location_column, value_column) and \
+                row[value_column].replace(',', '').isdigit():
+            cases[row[location_column]] = row[value_column].replace(',', '')
+    match = re.search(r'Updated\D*?(\d{1,2}/\d{1,2}/\d{2,4})',
+                      ' '.join(parser.text))
+    return Snapshot(sorted(cases.items()),
+                    match.group(1) if match else None, raw)
+
+
+# ===========================================
+# Date sources
+# ===========================================
+
+@register_date_source('today')
+def date_today(source, spec, snapshot):
+    """Dates the snapshot with the day of the run."""
+    return datetime.fromtimestamp(time.time()).strftime('%m/%d/%Y')
+
+
+@register_date_source('page')
+def date_from_page(source, spec, snapshot):
+    """Uses the update date the fetcher found next to the data."""
+    if snapshot.date is None:
+        raise ValueError('no update date found on the page')
+    return snapshot.date
+
+
+@register_date_source('arcgis_last_edit')
+def get_update_date(source, spec, snapshot):
+    """Reads editingInfo.lastEditDate from the ?f=json description of the
+    source's layer (or of the layer at spec["url"]), through the shared
+    arcgis_utils.metadata client. Dates are converted to local time (i.e.
+    time in LA)."""
+    last_edit = arcgis_utils.metadata.get_last_edit(
+        spec.get('url', source['url']))
+    if last_edit is None:
+        raise ValueError('layer does not report a last edit date')
+    return datetime.fromtimestamp(last_edit / 1000.0).strftime('%m/%d/%Y')
+
+
+# ===========================================
+# Transforms
+# ===========================================
+
+@register_transform('none')
+def transform_none(source, spec, rows):
+    """Keeps the values as they are."""
+    return [(location, str(value)) for location, value in rows]
+
+
+@register_transform('integers')
+def transform_integers(source, spec, rows):
+    """Keeps the rows whose value is an integer."""
+    result = []
+    for location, value in rows:
+        try:
+            result.append((location, str(int(value))))
+        except ValueError:
+            pass
+    return result
+
+
+@register_transform('case_counts')
+def transform_case_counts(source, spec, rows):
+    """Turns suppressed and negative counts into NA and adds up the counts
+    of duplicate locations. Other strings are kept as they are."""
+    counts = collections.OrderedDict()
+    for location, case_count in rows:
+        if case_count == 'Data Suppressed':
+            case_count = 'NA'
+        else:
+            try:
+                case_count = int(case_count)
+                if case_count < 0:
+                    case_count = 'NA'
+            except (TypeError, ValueError):
+                pass  # (can switch to "case_count = 'NA'" if we wish to remove strings)
+        if location in counts:
+            counts[location] = int(counts[location]) + case_count
+        else:
+            counts[location] = case_count
+    return [(location, str(count)) for location, count in counts.items()]
+
+
+@register_transform('per_capita')
+def transform_per_capita(source, spec, rows):
+    """Scales rates per spec["per"] people back to counts, using the
+    population of each location read from spec["population_csv"]. Locations
+    without a population are dropped."""
+    population = {}
+    with open(os.path.join(REPO_ROOT, spec['population_csv']), 'r') as \
+            population_file:
+        population_file.readline()  # Get rid of header
+        for line in population_file:
+            values = line.strip().split(',')
+            population[values[spec['location_column']]] = \
+                int(values[spec['population_column']])
+    return [(location, str(int(round(float(rate) * population[location] /
+                                         spec['per']))))
+            for location, rate in rows if location in population]
+
+
+# ===========================================
+# Runner
+# ===========================================
+
+def format_date(source, date):
+    """Formats an M/D/Y date as it should appear in the csv header."""
+    return date_utils.canonical(date, date_utils.QUOTED)
+
+
+def _quote_locations(source, rows):
+    if source.get('quote_locations', True):
+        return [('"%s"' % location, value) for location, value in rows]
+    return rows
+
+
+def _overwrites(source):
+    return source.get('on_existing_date', 'skip') == 'overwrite'
+
+
+def write_snapshot(source, date, rows):
+    """Appends a dated snapshot to the output csv of a source.
+
+    The lock of the csv is held from the check for the date to the write, so
+    two runs of the same source can not both append it. The day is looked up
+    by its ordinal, so a column spelled differently (e.g. '"4/1/2020"') is
+    found and overwritten in place.
+
+    Raises:
+        SkippedSource: If the date is already there and the source does not
+            overwrite existing dates.
+        ValueError: If a location appears more than once.
+    """
+    file_path = output_path(source)
+    rows = _quote_locations(source, rows)
+    with file_lock.locked(file_path):
+        stored_date = None
+        if not os.path.exists(file_path):
+            print("%s - Creating csv file at %s" % (source['name'],
+                                                    file_path))
+        else:
+            stored_date = series_store.find_date(file_path, date)
+        if stored_date is not None:
+            if not _overwrites(source):
+                raise SkippedSource(
+                    "This date has already been updated. May need to check "
+                    "if multiple updates were made in the same day.")
+            print("%s - WARNING: data has already been updated today... "
+                  "overwriting data for today with recently fetched data." %
+                  source['name'])
+            date = stored_date  # Keep the column as it is spelled
+        series_store.append_snapshot(file_path, date, rows)
+
+
+def run_source(source, date=None):
+    """Fetches, dates, transforms and writes one source.
+
+    Args:
+        source: dict, the source's entry in the config.
+        date: str, an M/D/Y date overriding the source's date stage.
+
+    Returns:
+        str, the date written to the csv header.
+    """
+    name = source['name']
+    with metrics.stage('fetch', source=name):
+        snapshot = FETCHERS[source['fetcher']](source)
+    metrics.count('rows', len(snapshot.rows), stage='fetch', source=name)
+    if date is None:
+        date_spec = source['date']
+        with metrics.stage('date', source=name):
+            date = DATE_SOURCES[date_spec['type']](source, date_spec,
+                                                   snapshot)
+    if snapshot.raw is not None and source.get('archive', True):
+        with metrics.stage('archive', source=name):
+            raw_archive.store(name, snapshot.raw, date, source['url'])
+    transform_spec = source['transform']
+    with metrics.stage('parse', source=name):
+        rows = TRANSFORMS[transform_spec['type']](source, transform_spec,
+                                                  snapshot.rows)
+    metrics.count('rows', len(rows), stage='parse', source=name)
+    header_date = format_date(source, date)
+    with metrics.stage('write', source=name):
+        write_snapshot(source, header_date, rows)
+    print("%s - Finished scraping data" % source['name'])
+    return header_date
+
+
+def backfill(source, snapshots):
+    """Merges many dated snapshots of a source into its csv with one write.
+
+    Meant for catching up on missed days, or for onboarding a source with
+    its history: every snapshot is transformed as in run_source(), days
+    already in the csv are skipped or overwritten according to
+    on_existing_date, and the csv is rewritten once at the end instead of
+    once per day.
+
+    Args:
+        source: dict, the source's entry in the config.
+        snapshots: iterable of Snapshot, holding the rows as a fetcher
+            returns them and an M/D/Y date. A later snapshot of a day
+            replaces an earlier one.
+
+    Returns:
+        list of str, the dates written to the csv header.
+    """
+    name = source['name']
+    transform_spec = source['transform']
+    days = collections.OrderedDict()  # Day ordinal -> (header date, rows)
+    with metrics.stage('parse', source=name):
+        for snapshot in snapshots:
+            rows = TRANSFORMS[transform_spec['type']](source, transform_spec,
+                                                      snapshot.rows)
+            days[date_utils.to_ordinal(snapshot.date)] = (
+                format_date(source, snapshot.date),
+                _quote_locations(source, rows))
+
+    file_path = output_path(source)
+    with metrics.stage('write', source=name), file_lock.locked(file_path):
+        stored_dates = {}
+        if os.path.exists(file_path):
+            dates = series_store.get_dates(file_path)
+            stored_dates = dict(zip(date_utils.to_ordinals(dates).tolist(),
+                                    dates))
+        snapshots = []
+        for ordinal, (date, rows) in days.items():
+            if ordinal in stored_dates:
+                if not _overwrites(source):
+                    print("%s - %s is already there, skipping it" %
+                          (name, date))
+                    continue
+                date = stored_dates[ordinal]  # Keep the column's spelling
+            snapshots.append((date, rows))
+        series_store.append_snapshots(file_path, snapshots)
+    metrics.count('snapshots', len(snapshots), stage='write', source=name)
+    print("%s - Backfilled %d days" % (name, len(snapshots)))
+    return [date for date, _ in snapshots]
+
+
+def replay_archive(source):
+    """Yields a Snapshot for every day archived for a source, parsed from
+    the raw payload kept for it and dated with the day it was archived
+    under."""
+    fetcher = FETCHERS[source['fetcher']]
+    for entry in raw_archive.latest_per_day(source['name']):
+        snapshot = fetcher(source, raw_archive.read_blob(entry['blob']))
+        yield Snapshot(snapshot.rows, entry['date'])
+
+
+def read_backfill_file(path):
+    """Reads the snapshots held in a long csv file.
+
+    The file has a header and three columns: an M/D/Y date, a location and
+    its raw value. Rows of one date do not need to be next to each other.
+
+    Returns:
+        list of Snapshot, in the order their dates first appear.
+    """
+    snapshots = collections.OrderedDict()
+    with open(path, 'r', newline='') as backfill_file:
+        reader = csv.reader(backfill_file)
+        next(reader, None)  # Get rid of header
+        for row in reader:
+            if row:
+                date, location, value = row[:3]
+                snapshots.setdefault(date, []).append((location, value))
+    return [Snapshot(rows, date) for date, rows in snapshots.items()]
+
+
+def select_sources(sources, names=None, group=None):
+    """Returns the sources matching the given names and group, in config
+    order.
+
+    Raises:
+        ValueError: If a name does not match any source.
+    """
+    known = set(source['name'] for source in sources)
+    for name in names or []:
+        if name not in known:
+            raise ValueError('unknown source %r' % name)
+    return [source for source in sources
+            if (not names or source['name'] in names) and
+            (group is None or source.get('group') == group)]
+
+
+def run_sources(sources, date=None, max_workers=fetch_utils.DEFAULT_MAX_WORKERS):
+    """Runs every source concurrently.
+
+    Returns:
+        A list of the names of the sources that failed.
+    """
+    if date is None:
+        arcgis_utils.metadata.prefetch(
+            [source['date'].get('url', source['url']) for source in sources
+             if source['date']['type'] == 'arcgis_last_edit'])
+    outcomes = fetch_utils.run_concurrently(
+        lambda source: run_source(source, date), sources, max_workers)
+    fetch_utils.close_sessions()
+
+    failed = []
+    for source, _, error in outcomes:
+        if isinstance(error, SkippedSource):
+            print("%s - %s" % (source['name'], error))
+        elif error is not None:
+            print("%s - ERROR: %s" % (source['name'], error))
+            failed.append(source['name'])
+    return failed
+
+
+def main(argv=None, description="Scrape COVID-19 counts for the sources "
+         "listed in sources.json."):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH,
+                        help="source config file (default: %(default)s)")
+    parser.add_argument("--source", action="append", dest="sources",
+                        metavar="NAME", help="only scrape this source; may be "
+                        "repeated")
+    parser.add_argument("--group", help="only scrape the sources in this "
+                        "group")
+    parser.add_argument("--date", help="date the snapshots with this M/D/Y "
+                        "date instead of asking each source")
+    parser.add_argument("--max-workers", type=int,
+                        default=fetch_utils.DEFAULT_MAX_WORKERS,
+                        help="maximum number of sources scraped at once "
+                        "(default: %(default)s)")
+    parser.add_argument("--backfill", action="append", metavar="CSV",
+                        help="instead of scraping, merge the snapshots in "
+                        "this date,location,value csv into the csv of the "
+                        "one selected source; may be repeated")
+    parser.add_argument("--from-archive", action="store_true",
+                        help="instead of scraping, reprocess every day "
+                        "archived for the selected sources")
+    args = parser.parse_args(argv)
+
+    try:
+        sources = select_sources(load_sources(args.config), args.sources,
+                                 args.group)
+    except ValueError as error:
+        sys.exit("ERROR: %s" % error)
+    if args.backfill:
+        if len(sources) != 1:
+            sys.exit("ERROR: --backfill needs exactly one source, got %d"
+                     % len(sources))
+        snapshots = []
+        for path in args.backfill:
+            snapshots.extend(read_backfill_file(path))
+        backfill(sources[0], snapshots)
+        return
+    if args.from_archive:
+        for source in sources:
+            backfill(source, replay_archive(source))
+        return
+    failed = run_sources(sources, args.date, args.max_workers)
+    if failed:
+        sys.exit("Failed to scrape: %s" % ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,530 @@
+"""
+Incremental storage for the wide {sample}_{feature}.csv files.
+
+The scrapers used to read a whole wide csv (rows are locations, columns are
+dates) into memory and write every row back out just to add one column. This
+module keeps an append-only long-format log of (location, date, value)
+entries instead, which is the source of truth for the wide file. Adding a
+day's snapshot appends its rows to the log, so the cost of an update depends
+on the number of new rows only. The wide csv is materialized from the log
+when asked to, and skipped when it is already up to date.
+
+The log for processed_data/<path>.csv lives in .cache/series_log/<path>.log
+and holds one tab separated entry per line:
+
+    #corner<TAB><first header cell>
+    #snapshot<TAB><date>
+    <location><TAB><date><TAB><value>
+
+Locations, dates and values are stored exactly as they appear in the wide
+csv (e.g. '"68007"', '"04/16/20"', '5'), so materializing a file reproduces
+its existing formatting. A #snapshot line starts a new snapshot for a date
+and replaces any earlier snapshot for that date. The csv's columns are in
+calendar order, so a day added late (see append_snapshots) lands in place. Locations missing from a
+snapshot are written as NA, as are dates before a location first appeared.
+A side file (<path>.dates) lists the dates in the log so that checking for a
+date does not need to read the whole log, and <path>.materialized records the
+size of the log when the csv was last written, and the size and mtime of the
+csv it wrote. Since the log only grows, the csv is up to date when that size
+matches. Otherwise only the log past that size is read, and its snapshots
+are merged into the rows of the csv, so an update costs a pass over the csv
+and not over the whole history in the log. The whole log is only replayed
+with force=True.
+
+The first time a wide csv is updated through this module, its existing
+contents are imported into a new log. So is a csv changed by hand since it
+was last written (its size or mtime differ from the stamp), so the edit is
+kept instead of being overwritten from the log. The logs are therefore not
+checked in (.cache/ is ignored): the csvs are, and a fresh checkout rebuilds
+each log from its csv on the first update.
+
+Appends are written in one go and fsynced. If one is cut short anyway (e.g.
+by a power cut), the partial last line is ignored by readers and cut off
+before the next append. The csv and the other side files are replaced
+atomically (see atomic_io.py). Appending and materializing hold the lock of
+the csv (see file_lock.py), so several scrapers can update files at once.
+"""
+import json
+import os
+import re
+
+import atomic_io
+import date_utils
+import file_lock
+import metrics
+import processed_matrix
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSED_DATA_DIR = os.path.join(REPO_ROOT, 'processed_data')
+SERIES_LOG_DIR = os.path.join(REPO_ROOT, '.cache', 'series_log')
+
+MISSING_VALUE = 'NA'
+CORNER_TAG = '#corner'
+# The first cell of a wide csv line, quoted (with "" escapes) or not.
+_FIRST_CELL = re.compile(r'"(?:[^"]|"")*"|[^,]*')
+SNAPSHOT_TAG = '#snapshot'
+
+
+def log_path(csv_path):
+    """Returns the path of the log backing the given wide csv."""
+    csv_path = os.path.abspath(csv_path)
+    base = os.path.splitext(csv_path)[0]
+    if base.startswith(PROCESSED_DATA_DIR + os.sep):
+        return os.path.join(SERIES_LOG_DIR,
+                            os.path.relpath(base, PROCESSED_DATA_DIR)) + '.log'
+    return base + '.log'
+
+
+def _dates_path(csv_path):
+    return os.path.splitext(log_path(csv_path))[0] + '.dates'
+
+
+def _stamp_path(csv_path):
+    return os.path.splitext(log_path(csv_path))[0] + '.materialized'
+
+
+def _read_stamp(csv_path):
+    """Returns what was recorded when the csv was last materialized, a dict
+    with the 'log_size' and the 'csv' signature (None if unknown), or
+    None."""
+    try:
+        with open(_stamp_path(csv_path), 'r') as stamp_file:
+            text = stamp_file.read().strip()
+    except IOError:
+        return None
+    try:
+        stamp = json.loads(text)
+    except ValueError:
+        return None
+    if isinstance(stamp, int):  # Stamps used to hold the log size only
+        return {'log_size': stamp, 'csv': None}
+    return stamp
+
+
+def _write_stamp(csv_path, log_size):
+    with atomic_io.atomic_write(_stamp_path(csv_path)) as stamp_file:
+        json.dump({'log_size': log_size,
+                   'csv': processed_matrix.csv_signature(csv_path)},
+                  stamp_file, sort_keys=True)
+        stamp_file.write('\n')
+
+
+def _edited_by_hand(csv_path):
+    """Returns True if the csv changed since it was last materialized."""
+    stamp = _read_stamp(csv_path)
+    return stamp is not None and stamp['csv'] is not None and \
+        os.path.exists(csv_path) and \
+        processed_matrix.csv_signature(csv_path) != stamp['csv']
+
+
+def _split_row(line):
+    """Splits a wide csv line into cells, keeping quoted cells intact."""
+    if '"' not in line:
+        return line.split(',')
+    # A comma inside quotes leaves an odd number of quotes in the cell.
+    cells = []
+    cell = None
+    for piece in line.split(','):
+        cell = piece if cell is None else cell + ',' + piece
+        if cell.count('"') % 2 == 0:
+            cells.append(cell)
+            cell = None
+    if cell is not None:
+        cells.append(cell)
+    return cells
+
+
+def _line_terminator(csv_path):
+    """Returns the line terminator used by the given csv, '\\n' by default."""
+    try:
+        with open(csv_path, 'r', newline='') as csv_file:
+            first_line = csv_file.readline()
+    except IOError:
+        return '\n'
+    return '\r\n' if first_line.endswith('\r\n') else '\n'
+
+
+def _import_wide_csv(csv_path):
+    """Creates the log for a wide csv from the csv's current contents."""
+    path = log_path(csv_path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    corner = ''
+    dates = []
+    rows = []
+    if os.path.exists(csv_path):
+        with open(csv_path, 'r') as csv_file:
+            header = _split_row(csv_file.readline().rstrip('\r\n'))
+            corner, dates = header[0], header[1:]
+            for line in csv_file:
+                line = line.rstrip('\r\n')
+                if line:
+                    rows.append(_split_row(line))
+
+    with atomic_io.batch() as files:
+        with files.open(path) as log_file:
+            log_file.write('%s\t%s\n' % (CORNER_TAG, corner))
+            for i, date in enumerate(dates):
+                log_file.write('%s\t%s\n' % (SNAPSHOT_TAG, date))
+                for row in rows:
+                    value = row[i + 1] if i + 1 < len(row) else MISSING_VALUE
+                    log_file.write('%s\t%s\t%s\n' % (row[0], date, value))
+        with files.open(_dates_path(csv_path)) as dates_file:
+            for date in dates:
+                dates_file.write(date + '\n')
+
+
+def _append(path, text):
+    """Appends text to path and fsyncs it, first cutting off the partial
+    last line an interrupted append may have left."""
+    with open(path, 'ab+') as append_file:
+        size = append_file.seek(0, os.SEEK_END)
+        if size:
+            append_file.seek(max(size - 1, 0))
+            if append_file.read(1) != b'\n':
+                append_file.seek(0)
+                end = append_file.read().rfind(b'\n') + 1
+                append_file.truncate(end)
+        append_file.write(text.encode('utf-8'))
+        append_file.flush()
+        os.fsync(append_file.fileno())
+
+
+def _complete_lines(lines):
+    """Yields the lines that end with a newline; see _append."""
+    for line in lines:
+        if not line.endswith('\n'):
+            return
+        yield line
+
+
+def _ensure_log(csv_path):
+    """Imports the csv into its log if it has none yet, or if the csv was
+    edited by hand since it was last materialized."""
+    if not os.path.exists(log_path(csv_path)) or _edited_by_hand(csv_path):
+        with file_lock.locked(csv_path):
+            if not os.path.exists(log_path(csv_path)):
+                _import_wide_csv(csv_path)
+            elif _edited_by_hand(csv_path):
+                # Snapshots appended since the csv was last written are
+                # replayed on top of the edited csv.
+                tail = _read_log_tail(csv_path, _read_stamp(csv_path))
+                _import_wide_csv(csv_path)
+                _write_stamp(csv_path, os.path.getsize(log_path(csv_path)))
+                if tail:  # None if it can not be told apart
+                    _append(log_path(csv_path), ''.join(tail))
+                    _append(_dates_path(csv_path), ''.join(
+                        line.rstrip('\n').split('\t')[1] + '\n'
+                        for line in tail if line.startswith(SNAPSHOT_TAG)))
+
+
+def get_dates(csv_path):
+    """Returns the list of dates stored for a wide csv, in the order they
+    were first added.
+
+    Args:
+        csv_path: The path to the wide csv.
+    """
+    _ensure_log(csv_path)
+    dates = []
+    seen = set()
+    with open(_dates_path(csv_path), 'r') as dates_file:
+        for line in _complete_lines(dates_file):
+            date = line.rstrip('\n')
+            if date not in seen:
+                seen.add(date)
+                dates.append(date)
+    return dates
+
+
+def find_date(csv_path, date):
+    """Returns the header cell of the wide csv holding the same day as date,
+    or None. The day may be spelled differently, e.g. '"4/16/2020"' for
+    '"04/16/20"'.
+
+    Args:
+        csv_path: The path to the wide csv.
+        date: The date, in any form date_utils.to_ordinal() accepts.
+    """
+    dates = get_dates(csv_path)
+    ordinal = date_utils.to_ordinal(date)
+    for stored, stored_ordinal in zip(dates,
+                                      date_utils.to_ordinals(dates).tolist()):
+        if stored_ordinal == ordinal:
+            return stored
+    return None
+
+
+def has_date(csv_path, date):
+    """Returns True if the wide csv already holds data for the day of date.
+
+    Args:
+        csv_path: The path to the wide csv.
+        date: The date, e.g. '"04/16/20"'.
+    """
+    return find_date(csv_path, date) is not None
+
+
+def append_snapshot(csv_path, date, values, update_csv=True):
+    """Records one day's values for a wide csv.
+
+    If the date is already present, the new snapshot replaces it.
+
+    Args:
+        csv_path: The path to the wide csv.
+        date: The date as it should appear in the csv header.
+        values: List of (location, value) pairs, formatted as they should
+            appear in the csv.
+        update_csv: Whether to materialize the wide csv right away. Several
+            snapshots can be appended before materializing once.
+
+    Raises:
+        ValueError: If a location appears more than once in values.
+    """
+    append_snapshots(csv_path, [(date, values)], update_csv)
+
+
+def append_snapshots(csv_path, snapshots, update_csv=True):
+    """Records the values of many days for a wide csv in one append.
+
+    Each snapshot replaces any earlier one for its date, including earlier
+    ones in snapshots. Nothing is written if a snapshot is invalid.
+
+    Args:
+        csv_path: The path to the wide csv.
+        snapshots: List of (date, values) pairs, as for append_snapshot.
+        update_csv: Whether to materialize the wide csv once all the
+            snapshots are appended.
+
+    Raises:
+        ValueError: If a location appears more than once in a snapshot.
+    """
+    lines = []
+    for date, values in snapshots:
+        seen = set()
+        for location, _ in values:
+            if location in seen:
+                raise ValueError('Duplicate location %s in snapshot for %s'
+                                 % (location, date))
+            seen.add(location)
+        lines.append('%s\t%s\n' % (SNAPSHOT_TAG, date))
+        lines.extend('%s\t%s\t%s\n' % (location, date, value)
+                     for location, value in values)
+
+    with file_lock.locked(csv_path):
+        _ensure_log(csv_path)
+        if lines:
+            _append(log_path(csv_path), ''.join(lines))
+            _append(_dates_path(csv_path), ''.join(
+                date + '\n' for date, _ in snapshots))
+
+        if update_csv:
+            materialize(csv_path)
+
+
+def read_log(csv_path):
+    """Replays the log of a wide csv.
+
+    Args:
+        csv_path: The path to the wide csv.
+
+    Returns:
+        corner, dates, data
+        where corner is the first header cell, dates is the list of dates in
+        column order and data maps each location to a dict of date -> value.
+    """
+    _ensure_log(csv_path)
+    dates = []
+    data = {}
+    with open(log_path(csv_path), 'r') as log_file:
+        corner = _replay(_complete_lines(log_file), dates, data)
+    return corner, dates, data
+
+
+def _read_log_tail(csv_path, stamp):
+    """Returns the complete lines of the log written after the stamp, or
+    None if the stamp is not at the start of a line (a torn line was cut
+    off since)."""
+    with open(log_path(csv_path), 'rb') as log_file:
+        if stamp['log_size']:
+            log_file.seek(stamp['log_size'] - 1)
+            if log_file.read(1) != b'\n':
+                return None
+        text = log_file.read().decode('utf-8')
+    return list(_complete_lines(text.splitlines(True)))
+
+
+def _replay(lines, dates, data):
+    """Applies log lines to dates and data. Returns the corner cell found
+    in the lines, '' if none."""
+    corner = ''
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if fields[0] == CORNER_TAG:
+            corner = fields[1]
+        elif fields[0] == SNAPSHOT_TAG:
+            date = fields[1]
+            if date in dates:
+                for location_data in data.values():
+                    location_data.pop(date, None)
+            else:
+                dates.append(date)
+        else:
+            location, date, value = fields
+            data.setdefault(location, {})[date] = value
+    return corner
+
+
+def _calendar_order(dates):
+    """Sorts header dates by day. Dates that do not all parse are left in
+    the order of the log."""
+    try:
+        ordinals = date_utils.to_ordinals(dates)
+    except ValueError:
+        return dates
+    return [dates[i] for i in ordinals.argsort(kind='stable')]
+
+
+def rename_dates(csv_path, rename):
+    """Respells dates throughout the log of a wide csv and rewrites the csv.
+
+    Args:
+        csv_path: The path to the wide csv.
+        rename: dict mapping old header cells to new ones. Dates not in it
+            are kept.
+    """
+    with file_lock.locked(csv_path):
+        _ensure_log(csv_path)
+        path = log_path(csv_path)
+        with open(path, 'r') as log_file:
+            lines = list(_complete_lines(log_file))
+        with atomic_io.batch() as files:
+            with files.open(path) as log_file:
+                for line in lines:
+                    fields = line.rstrip('\n').split('\t')
+                    if fields[0] != CORNER_TAG:
+                        fields[1] = rename.get(fields[1], fields[1])
+                    log_file.write('\t'.join(fields) + '\n')
+            with files.open(_dates_path(csv_path)) as dates_file:
+                for date in get_dates(csv_path):
+                    dates_file.write(rename.get(date, date) + '\n')
+        materialize(csv_path, force=True)
+
+
+def _first_cell(line):
+    return _FIRST_CELL.match(line).group(0)
+
+
+def _merge_tail(csv_path, tail):
+    """Merges log lines into the rows of the wide csv.
+
+    When the log lines only add days after the last column, the new cells
+    are appended to each line as it is; otherwise the lines are split.
+
+    Returns:
+        corner, dates, rows
+        where rows are the csv lines without their terminators, sorted by
+        location, as materializing the whole log would write them.
+    """
+    with open(csv_path, 'r', newline='') as csv_file:
+        header = _split_row(csv_file.readline().rstrip('\r\n'))
+        lines = [line.rstrip('\r\n') for line in csv_file
+                 if line.rstrip('\r\n')]
+    corner, old_dates = header[0], header[1:]
+    dates = list(old_dates)
+    data = {}
+    _replay(tail, dates, data)
+    # Columns given a new snapshot in the tail drop their old values.
+    replaced = set(line.rstrip('\n').split('\t')[1] for line in tail
+                   if line.startswith(SNAPSHOT_TAG + '\t'))
+    dates = _calendar_order(dates)
+    old_columns = dict((date, i + 1) for i, date in enumerate(old_dates))
+    appended = dates[:len(old_dates)] == old_dates and \
+        not replaced.intersection(old_dates)
+    new_dates = dates[len(old_dates):]
+
+    merged = []
+    for line in lines:
+        location = _first_cell(line)
+        location_data = data.pop(location, {})
+        if appended and line.count(',', len(location)) == len(old_dates):
+            merged.append((location, ','.join(
+                [line] + [location_data.get(date, MISSING_VALUE)
+                          for date in new_dates])))
+            continue
+        cells = _split_row(line)
+        row = [location]
+        for date in dates:
+            column = None if date in replaced else old_columns.get(date)
+            if column is None:
+                row.append(location_data.get(date, MISSING_VALUE))
+            else:
+                row.append(cells[column] if column < len(cells)
+                           else MISSING_VALUE)
+        merged.append((location, ','.join(row)))
+    for location, location_data in data.items():
+        merged.append((location, ','.join(
+            [location] + [location_data.get(date, MISSING_VALUE)
+                          for date in dates])))
+    merged.sort(key=lambda row: row[0])
+    return corner, dates, [row for _, row in merged]
+
+
+def materialize(csv_path, force=False):
+    """Writes the wide csv from its log.
+
+    If the csv is as it was last written, only the part of the log written
+    since is read and merged into it; otherwise the whole log is replayed.
+
+    Args:
+        csv_path: The path to the wide csv.
+        force: Rewrite the csv from the whole log even if it is already up
+            to date.
+
+    Returns:
+        True if the csv was written, False if it was already up to date.
+    """
+    with file_lock.locked(csv_path):
+        _ensure_log(csv_path)
+        log_size = os.path.getsize(log_path(csv_path))
+        stamp = _read_stamp(csv_path)
+        if not force and os.path.exists(csv_path) and stamp is not None and \
+                stamp['log_size'] == log_size:
+            return False
+        incremental = not force and stamp is not None and \
+            os.path.exists(csv_path) and stamp['csv'] is not None and \
+            stamp['log_size'] < log_size and \
+            processed_matrix.csv_signature(csv_path) == stamp['csv']
+
+        tail = _read_log_tail(csv_path, stamp) if incremental else None
+
+        line_terminator = _line_terminator(csv_path)
+        csv_name = os.path.basename(csv_path)
+        with metrics.stage('merge', csv=csv_name):
+            if tail is not None:
+                corner, dates, rows = _merge_tail(csv_path, tail)
+            else:
+                corner, dates, data = read_log(csv_path)
+                dates = _calendar_order(dates)
+                rows = [','.join([location] + [
+                    data[location].get(date, MISSING_VALUE)
+                    for date in dates]) for location in sorted(data.keys())]
+        with metrics.stage('write', csv=csv_name):
+            with atomic_io.atomic_write(csv_path, newline='') as csv_file:
+                csv_file.write(','.join([corner] + dates) + line_terminator)
+                for row in rows:
+                    csv_file.write(row + line_terminator)
+        metrics.count('rows', len(rows), stage='write', csv=csv_name)
+        _write_stamp(csv_path, log_size)
+        return True
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python series_store.py ${csv_path} [${csv_path} ...]'
+                 '\nRewrites each wide csv from its log.')
+    for path in sys.argv[1:]:
+        if materialize(path, force=True):
+            print('%s - materialized' % path)
@@ -0,0 +1,142 @@
+"""
+Cache of parsed raw snapshot files.
+
+The processors re-read every historical raw snapshot on each run, even though
+those files never change once written. SnapshotCache keeps the parsed form of
+each file (a pandas DataFrame or any other picklable value) in a binary file,
+and a manifest recording the size and modification time of the raw file it
+came from. A file is only parsed again when it is new or its size or
+modification time changed, so a daily run only parses the day's new file.
+
+DataFrames are stored with DataFrame.to_pickle, which keeps the data as typed
+column blocks rather than text, so loading them skips csv parsing entirely.
+
+The caches live in .cache/snapshots/<name>/ at the root of the repository.
+Bump the version passed to SnapshotCache whenever the parsed form of a file
+changes, so stale entries are not reused.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+import pandas as pd
+
+import atomic_io
+import utils
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CACHE_DIR = os.path.join(REPO_ROOT, '.cache', 'snapshots')
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class SnapshotCache(object):
+    """Parsed snapshots of the raw files of one processor.
+
+    Only the process owning the cache should call store() and save(); worker
+    processes should just parse files and hand the results back.
+    """
+
+    def __init__(self, name, version=1, cache_dir=None):
+        """
+        Args:
+            name: str, the name of the cache, e.g. 'boro'
+            version: int, the version of the parsed form. Entries written
+                     with another version are ignored.
+            cache_dir: str, the directory holding all snapshot caches,
+                       DEFAULT_CACHE_DIR if None
+        """
+        self.directory = os.path.join(cache_dir or DEFAULT_CACHE_DIR, name)
+        self.version = version
+        self.manifest = {}
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILENAME)) as \
+                    manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == version:
+                self.manifest = manifest.get('files', {})
+        except (IOError, ValueError):
+            pass
+
+    def _blob_path(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.pkl')
+
+    def contains(self, path):
+        """Returns True if an up to date parsed form of path is cached."""
+        entry = self.manifest.get(os.path.abspath(path))
+        return entry is not None and \
+            entry['signature'] == _file_signature(path) and \
+            os.path.exists(self._blob_path(path))
+
+    def load(self, path):
+        """Returns the cached parsed form of path."""
+        blob_path = self._blob_path(path)
+        if self.manifest[os.path.abspath(path)].get('frame'):
+            return pd.read_pickle(blob_path)
+        with open(blob_path, 'rb') as blob_file:
+            return pickle.load(blob_file)
+
+    def store(self, path, value):
+        """Caches the parsed form of path."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        blob_path = self._blob_path(path)
+        is_frame = isinstance(value, pd.DataFrame)
+        with atomic_io.atomic_write(blob_path, 'wb') as blob_file:
+            if is_frame:
+                value.to_pickle(blob_file)
+            else:
+                pickle.dump(value, blob_file, pickle.HIGHEST_PROTOCOL)
+        self.manifest[os.path.abspath(path)] = {
+            'signature': _file_signature(path),
+            'frame': is_frame,
+        }
+
+    def save(self):
+        """Writes the manifest, dropping entries whose raw file is gone."""
+        for path in list(self.manifest):
+            if not os.path.exists(path):
+                del self.manifest[path]
+                try:
+                    os.remove(self._blob_path(path))
+                except OSError:
+                    pass
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        manifest_path = os.path.join(self.directory, MANIFEST_FILENAME)
+        with atomic_io.atomic_write(manifest_path) as manifest_file:
+            json.dump({'version': self.version, 'files': self.manifest},
+                      manifest_file, indent=1, sort_keys=True)
+
+
+def map_cached(cache, function, paths, workers=1):
+    """Applies a parse function to every path, reusing cached results.
+
+    Only the paths missing from the cache are parsed, in parallel when
+    workers > 1 (see utils.mapInParallel). Successful results are stored and
+    the manifest is saved before returning.
+
+    Args:
+        cache: SnapshotCache, the cache to use
+        function: a top-level function parsing a single path. It returns
+                  None when the file can not be parsed.
+        paths: list of str, the raw files to parse
+        workers: int, the maximum number of worker processes
+
+    Returns:
+        list, the parsed form of every path, in the order of paths
+    """
+    stale = [path for path in paths if not cache.contains(path)]
+    parsed = dict(zip(stale, utils.mapInParallel(function, stale, workers)))
+    for path in stale:
+        if parsed[path] is not None:
+            cache.store(path, parsed[path])
+    cache.save()
+    return [parsed[path] if path in parsed else cache.load(path)
+            for path in paths]
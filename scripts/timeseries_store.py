@@ -0,0 +1,189 @@
+"""
+Dense, memory-mapped time series store for the processed csv files.
+
+The wide csvs only hold the dates that were scraped, in whatever format the
+scraper used ('1/22/20', '"04/16/20"', '4/1/2020', ...). This module lays
+each {sample}_{feature} dataset out as a float64 matrix with one row per
+location and one column per calendar day, from the first to the last date in
+the csv, with NaN for NA and for days that were never scraped:
+
+    {sample}_{feature}.days.npy   the location x day matrix
+    {sample}_{feature}.days.json  the first day, the location -> row map and
+                                  the size/mtime of the csv it came from
+
+Since columns are consecutive days, finding a date is a subtraction and
+finding a location is a dict lookup, so reading a point or a date window of
+one location is a single seek into the memory-mapped file:
+
+    >>> store = TimeSeriesStore('processed_data/cases/US/nyc-zc_cases.csv')
+    >>> store.get('10001', '04/16/20')
+    242.0
+    >>> store.series('"10001"', '4/1/20', '4/7/20')
+    array([113.,  nan, 136., 146., 158., 158., 170.])
+
+The store is rebuilt from the csv (through processed_matrix.py) whenever the
+csv changes. The files are build artifacts and are not checked in.
+"""
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+
+import date_utils
+import processed_matrix
+
+DAYS_MATRIX_SUFFIX = '.days.npy'
+DAYS_INDEX_SUFFIX = '.days.json'
+
+
+def parse_date(date):
+    """Returns a date given as 'M/D/YY' or 'M/D/YYYY' (optionally quoted and
+    zero padded) or as a datetime.date."""
+    return date_utils.to_date(date)
+
+
+def _paths(csv_path):
+    base = os.path.splitext(csv_path)[0]
+    return base + DAYS_MATRIX_SUFFIX, base + DAYS_INDEX_SUFFIX
+
+
+def build(csv_path):
+    """Writes the dense day matrix and index for a processed csv.
+
+    When the csv holds the same day more than once (e.g. as both '4/1/2020'
+    and '04/01/20'), values from the later column win unless they are NaN.
+
+    Args:
+        csv_path: The path to the csv.
+    """
+    matrix_file_path, index_file_path = _paths(csv_path)
+    signature = processed_matrix.csv_signature(csv_path)
+    matrix = processed_matrix.load(csv_path)
+
+    ordinals = date_utils.to_ordinals(matrix.dates).tolist()
+    if ordinals:
+        first_day = min(ordinals)
+        num_days = max(ordinals) - first_day + 1
+    else:
+        first_day = datetime.date.today().toordinal()
+        num_days = 0
+
+    days = np.full((len(matrix.rows), num_days), np.nan,
+                   dtype=processed_matrix.DTYPE)
+    for column, ordinal in enumerate(ordinals):
+        values = matrix.values[:, column]
+        present = ~np.isnan(values)
+        days[present, ordinal - first_day] = values[present]
+
+    index = {
+        'csv': signature,
+        'first_day': datetime.date.fromordinal(first_day).isoformat(),
+        'shape': list(days.shape),
+        'rows': dict((name, row) for row, name in enumerate(matrix.rows)),
+    }
+    processed_matrix.replace_with(
+        matrix_file_path, lambda f: np.save(f, days, allow_pickle=False))
+    processed_matrix.replace_with(
+        index_file_path, lambda f: f.write(json.dumps(index).encode('utf-8')))
+
+
+def is_stale(csv_path):
+    """Returns True if the store of csv_path is missing or out of date."""
+    matrix_file_path, index_file_path = _paths(csv_path)
+    try:
+        with open(index_file_path, 'r') as index_file:
+            index = json.load(index_file)
+    except (IOError, ValueError):
+        return True
+    return index.get('csv') != processed_matrix.csv_signature(csv_path) or \
+        not os.path.exists(matrix_file_path)
+
+
+class TimeSeriesStore(object):
+    """Point and window lookups into one processed dataset.
+
+    Attributes:
+        values: the memory-mapped location x day matrix.
+        first_day: datetime.date of the first column.
+        rows: dict mapping location names to row offsets.
+    """
+
+    def __init__(self, csv_path):
+        """
+        Args:
+            csv_path: The path to the processed csv. The store is (re)built
+                if it is missing or older than the csv.
+        """
+        if is_stale(csv_path):
+            build(csv_path)
+        matrix_file_path, index_file_path = _paths(csv_path)
+        with open(index_file_path, 'r') as index_file:
+            index = json.load(index_file)
+        self.values = np.load(matrix_file_path, mmap_mode='r',
+                              allow_pickle=False)
+        self.first_day = datetime.date(
+            *[int(part) for part in index['first_day'].split('-')])
+        self.rows = index['rows']
+
+    @property
+    def locations(self):
+        """The location names, in row order."""
+        return sorted(self.rows, key=self.rows.get)
+
+    @property
+    def last_day(self):
+        """datetime.date of the last column."""
+        return self.first_day + datetime.timedelta(self.values.shape[1] - 1)
+
+    def row(self, location):
+        """Returns the row offset of a location; quotes are ignored.
+
+        Raises:
+            KeyError: If the location is not in the dataset.
+        """
+        return self.rows[location.strip('"')]
+
+    def column(self, date):
+        """Returns the column offset of a date, which may be out of range."""
+        return date_utils.to_ordinal(date) - self.first_day.toordinal()
+
+    def get(self, location, date):
+        """Returns the value of a location on a date, NaN if missing."""
+        column = self.column(date)
+        if column < 0 or column >= self.values.shape[1]:
+            return np.nan
+        return float(self.values[self.row(location), column])
+
+    def series(self, location, start=None, end=None):
+        """Returns the values of a location from start to end, inclusive.
+
+        Args:
+            location: The location name.
+            start: The first date, defaults to the first day in the store.
+            end: The last date, defaults to the last day in the store.
+
+        Returns:
+            A read-only 1-D array view with one value per day. Days outside
+            the range of the store are left out.
+        """
+        first = 0 if start is None else max(self.column(start), 0)
+        stop = self.values.shape[1] if end is None else \
+            max(self.column(end) + 1, 0)
+        return self.values[self.row(location), first:stop]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('Usage: python timeseries_store.py ${csv_path} ${location} '
+                 '[${start_date} [${end_date}]]')
+    store = TimeSeriesStore(sys.argv[1])
+    start = sys.argv[3] if len(sys.argv) > 3 else None
+    end = sys.argv[4] if len(sys.argv) > 4 else None
+    first = store.first_day + datetime.timedelta(
+        0 if start is None else max(store.column(start), 0))
+    for offset, value in enumerate(store.series(sys.argv[2], start, end)):
+        day = first + datetime.timedelta(offset)
+        print('%s,%s' % (day.strftime('%m/%d/%y'),
+                         'NA' if np.isnan(value) else '%g' % value))
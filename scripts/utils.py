@@ -1,12 +1,19 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import datetime
+import multiprocessing
 import os
 
+import date_utils
+
 
 def getDays(year, month, day):
     """Fetches all days from given start date to the execution day.
 
+    The days are sliced from the calendar table of date_utils.py instead of
+    being formatted one by one, in the canonical MM/DD/YY spelling (quote
+    them with date_utils.header_cells for a header).
+
     Args:
         year: int, the year of the start date
         month: int, the month of the start date
@@ -15,21 +22,12 @@ def getDays(year, month, day):
     Returns:
         list of str, all the formatted time between the start date
                      to the execution day. An example of list element
-                     is '4/8/20'.
+                     is '04/08/20'.
 
     """
-    now = datetime.datetime.now()
-    start_date = datetime.date(year, month, day)
-    end_date = datetime.date(now.year, now.month, now.day)
-    delta = datetime.timedelta(days=1)
-    days = []
-
-    while start_date <= end_date:
-        time = str(start_date.month) + '/' + str(start_date.day) + '/' \
-            + str(start_date.year)[-2:]
-        start_date += delta
-        days.append(time)
-    return days
+    return date_utils.day_range(datetime.date(year, month, day),
+                                datetime.datetime.now().date(),
+                                date_utils.PADDED)
 
 
 def fetchFilenamesFromDirectory(directory):
@@ -42,4 +40,51 @@ def fetchFilenamesFromDirectory(directory):
         list of str, the name of all files in the specified directory
 
     """
-    return os.listdir(directory)
\ No newline at end of file
+    return os.listdir(directory)
+
+
+def fetchWorkerCount(value=None):
+    """Parses a worker count given on the command line.
+
+    Args:
+        value: str or None, the requested number of worker processes. None
+               or '0' means one worker per CPU core.
+
+    Returns:
+        int, the number of worker processes to use
+
+    """
+    if value is None or int(value) <= 0:
+        return multiprocessing.cpu_count()
+    return int(value)
+
+
+def mapInParallel(function, arguments, workers=1):
+    """Applies a function to every argument using a pool of processes.
+
+    The results are returned in the order of the arguments, so merging them
+    is deterministic regardless of which worker finishes first. Falls back
+    to running serially in this process if workers is 1 or a process pool
+    can not be created.
+
+    Args:
+        function: a top-level function taking a single argument
+        arguments: list, the arguments to apply the function to
+        workers: int, the maximum number of worker processes
+
+    Returns:
+        list, the result of the function for every argument
+
+    """
+    arguments = list(arguments)
+    if workers <= 1 or len(arguments) <= 1:
+        return [function(argument) for argument in arguments]
+    try:
+        pool = multiprocessing.Pool(min(workers, len(arguments)))
+    except (OSError, ImportError, NotImplementedError):
+        return [function(argument) for argument in arguments]
+    try:
+        return pool.map(function, arguments)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,23 @@
+import datetime
+
+import pytest
+
+import date_utils
+
+APRIL_1 = datetime.date(2020, 4, 1).toordinal()
+
+
+@pytest.mark.parametrize('date', ['4/1/20', '04/01/20', '4/1/2020',
+                                  '04/01/2020', '"4/1/20"', '"04/01/20"'])
+def test_to_ordinal_spellings(date):
+    assert date_utils.to_ordinal(date) == APRIL_1
+
+
+def test_to_ordinals_keeps_order():
+    ordinals = date_utils.to_ordinals(['"04/02/20"', '4/1/20', '12/31/2019'])
+    assert list(ordinals) == [APRIL_1 + 1, APRIL_1, APRIL_1 - 92]
+
+
+def test_header_cells_are_quoted_and_padded():
+    assert date_utils.header_cells(['4/1/20', '04/02/2020']) == \
+        ['"04/01/20"', '"04/02/20"']
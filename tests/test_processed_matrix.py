@@ -0,0 +1,31 @@
+import math
+
+import processed_matrix
+
+CSV = ',"04/01/20","04/02/20","04/03/20"\n' \
+      'NA,1,NA,3\n' \
+      'Bronx,NA,NA,NA\n' \
+      'Queens,4.5,6-10,7\n'
+
+
+def test_round_trip_with_na_cells(tmp_path):
+    csv_path = str(tmp_path / 'sample_cases.csv')
+    with open(csv_path, 'w') as csv_file:
+        csv_file.write(CSV)
+
+    matrix = processed_matrix.load(csv_path, mmap=False)
+    assert matrix.rows == ['NA', 'Bronx', 'Queens']
+    assert matrix.dates == ['04/01/20', '04/02/20', '04/03/20']
+    values = matrix.values.tolist()
+    assert values[0][0] == 1 and values[0][2] == 3
+    assert math.isnan(values[0][1])
+    assert all(math.isnan(value) for value in values[1])
+    assert values[2][0] == 4.5 and math.isnan(values[2][1])
+    assert values[2][2] == 7
+
+    # The mirror is reused, then rebuilt once the csv changes.
+    assert not processed_matrix.is_stale(csv_path)
+    with open(csv_path, 'w') as csv_file:
+        csv_file.write(CSV.replace('Bronx,NA,NA,NA', 'Bronx,NA,2,NA'))
+    assert processed_matrix.is_stale(csv_path)
+    assert processed_matrix.load(csv_path).values[1, 1] == 2
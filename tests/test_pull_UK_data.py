@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+import pull_UK_data
+
+OUTPUT = 'AreaCode,"04/01/20","04/02/20"\nE1,1,2\nE2,NA,3\n'
+
+
+@pytest.fixture
+def output_path(tmp_path, monkeypatch):
+    path = tmp_path / 'UK_cases_by_zip.csv'
+    path.write_text(OUTPUT)
+    monkeypatch.setattr(pull_UK_data, 'output_filename', str(path))
+    return path
+
+
+def test_append_columns_skips_days_already_written(output_path):
+    # A replayed tail: the state was not saved after the last write.
+    new_table = pd.DataFrame({'04/02/20': ['2', '3'], '04/03/20': ['5', '6']},
+                             index=['E1', 'E2'])
+    assert pull_UK_data.append_columns(new_table) is None
+    assert output_path.read_text() == OUTPUT
+
+
+def test_append_columns_appends_new_days(output_path):
+    new_table = pd.DataFrame({'04/03/20': ['5']}, index=['E1'])
+    assert pull_UK_data.append_columns(new_table) == 2
+    assert output_path.read_text() == \
+        'AreaCode,"04/01/20","04/02/20","04/03/20"\nE1,1,2,5\nE2,NA,3,NA\n'
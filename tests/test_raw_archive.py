@@ -0,0 +1,25 @@
+import raw_archive
+
+
+def test_store_and_find(tmp_path):
+    archive_dir = str(tmp_path / 'archive')
+    first = raw_archive.store('boro', b'a,b\n1,2\n', '4/1/20',
+                              archive_dir=archive_dir)
+    payload_path = tmp_path / 'boro04022020'
+    payload_path.write_bytes(b'a,b\n1,2\n')
+    second = raw_archive.store('boro', str(payload_path), '04/02/2020',
+                               archive_dir=archive_dir)
+    later = raw_archive.store('boro', b'a,b\n3,4\n', '"04/01/20"',
+                              archive_dir=archive_dir)
+
+    # Same content, one blob.
+    assert first['blob'] == second['blob'] != later['blob']
+    assert first['date'] == '04/01/2020' and first['size'] == 8
+    assert raw_archive.find('boro', '4/1/2020', archive_dir) == later
+    assert raw_archive.find('boro', '4/2/20', archive_dir) == second
+    assert raw_archive.find('boro', '4/3/20', archive_dir) is None
+    assert raw_archive.find('uk', '4/1/20', archive_dir) is None
+    assert raw_archive.read_blob(later['blob'], archive_dir) == b'a,b\n3,4\n'
+    assert [entry['date'] for entry in
+            raw_archive.latest_per_day('boro', archive_dir)] == \
+        ['04/01/2020', '04/02/2020']